@@ -16,10 +16,11 @@ import numpy as np
 import healpy as H
 
 
-def window2vecttens(window_scal, mask=None, lmax=None, mmax=None):
+def window2vecttens(window_scal, mask=None, lmax=None, mmax=None, wlm=None):
     '''
     Calculates the vector/tensor windows needed in the pure Cl
-    calculation
+    calculation. If the alms of the scalar window (times the mask) are
+    already known they can be given as wlm to avoid recalculating them.
 
     Notes
     -----
@@ -38,7 +39,8 @@ def window2vecttens(window_scal, mask=None, lmax=None, mmax=None):
     else:
         window_scal = window_scal * mask
 
-    wlm = H.map2alm(window_scal, lmax=lmax, mmax=mmax)
+    if wlm is None:
+        wlm = H.map2alm(window_scal, lmax=lmax, mmax=mmax)
 
     if lmax is None:
         lmax = H.Alm.getlmax(len(wlm))
@@ -109,6 +111,44 @@ def _nfunc(ells, spin):
     return nfact
 
 
+def alm2lmajor(alm, lmax=None):
+    '''
+    Repacks Healpix alms (ordered by m, then l) so that the alms of each l
+    are contiguous, ordered by m = 0..l
+
+    Parameters
+    ----------
+    alm : array-like (..., nalm)
+        Healpix alms with mmax = lmax. Leading axes are kept.
+
+    lmax : int, optional
+        Maximum l of the alms
+
+    Returns
+    -------
+    alm_l : array-like (..., nalm)
+        Repacked alms
+
+    offsets : array-like (lmax+2)
+        The alms of l are alm_l[..., offsets[l]:offsets[l+1]], so the m = 0
+        alm of l is at offsets[l]
+    '''
+
+    alm = np.asarray(alm)
+
+    if lmax is None:
+        lmax = H.Alm.getlmax(alm.shape[-1])
+
+    ells = np.arange(lmax+1)
+    offsets = np.zeros(lmax+2, dtype=int)
+    offsets[1:] = np.cumsum(ells+1)
+
+    ell = np.repeat(ells, ells+1)
+    m = np.arange(offsets[-1]) - offsets[ell]
+
+    return alm[..., H.Alm.getidx(lmax, ell, m)], offsets
+
+
 def apodizedqu2pureeb(polxscal, polxvect, polxtens, lmax=None, mmax=None):
     '''
     Constructs the pure E/B alms from polarization maps apodized by the
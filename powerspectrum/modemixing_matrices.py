@@ -5,9 +5,21 @@
 
 '''
 Calculation of modemixing matrices using Python application of these
-matrices to Cls. Parallelization is done using MPI.
+matrices to Cls. Parallelization is done using MPI, or a local process pool
+if no MPI communicator is given.
 '''
 
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import traceback
+from concurrent import futures
+
 import numpy as np
 import healpy as H
 
@@ -231,33 +243,53 @@ def apply_coupling(cls_in, Mscal, Mpol, Mcross, inverse=True):
     return cls_out
 
 
-def _get_wEBlm(window_scal, lmax=None, maps=False):
+def _get_wEBlm(window_scal, lmax=None, maps=False, harmonic=False):
     '''
     Calculate the E/B-type alms from the vector and tensor windows.
     Constructs the vector and tensor windows from the scalar wlms and
     then masks the resulting maps. This masking results in non-zero B-mode
     type wlms.
+
+    If harmonic is True the vector and tensor windows are taken to already
+    vanish where the scalar window is zero, so that masking them does
+    nothing. Their alms are then calculated straight from the scalar wlms,
+    without going to maps and back, and the B-type wlms are zero.
     '''
 
     mask = np.ones_like(window_scal)
     mask[window_scal == 0] = 0
 
-    window_vect, window_tens = H_ext.window2vecttens(window_scal, mask=mask,
-                                                     lmax=lmax)
-
+    # The window is already zero outside of the mask, so these are also the
+    # wlms of the masked window that window2vecttens needs
     wlm = H.map2alm(window_scal, lmax=lmax)
 
     n = len(wlm)
     wEBlm = np.empty([5, n], dtype=complex)
     wEBlm[0, :] = -wlm
 
-    wlm_tmp = H.map2alm_spin(window_vect, 1, lmax=lmax)
-    wEBlm[1, :] = wlm_tmp[0]
-    wEBlm[-1, :] = wlm_tmp[1]
+    if harmonic:
+        wEBlm[1, :], wEBlm[-1, :] = H_ext.wlm_scalar2spin(wlm, 1)
+        wEBlm[2, :], wEBlm[-2, :] = H_ext.wlm_scalar2spin(wlm, 2)
+
+        if maps:
+            nside = H.npix2nside(len(window_scal))
+            lmax = H.Alm.getlmax(n)
+            window_vect = H.alm2map_spin(H_ext.wlm_scalar2spin(wlm, 1),
+                                         nside, 1, lmax)
+            window_tens = H.alm2map_spin(H_ext.wlm_scalar2spin(wlm, 2),
+                                         nside, 2, lmax)
+    else:
+        window_vect, window_tens = H_ext.window2vecttens(window_scal,
+                                                         mask=mask,
+                                                         lmax=lmax, wlm=wlm)
+
+        wlm_tmp = H.map2alm_spin(window_vect, 1, lmax=lmax)
+        wEBlm[1, :] = wlm_tmp[0]
+        wEBlm[-1, :] = wlm_tmp[1]
 
-    wlm_tmp = H.map2alm_spin(window_tens, 2, lmax=lmax)
-    wEBlm[2, :] = wlm_tmp[0]
-    wEBlm[-2, :] = wlm_tmp[1]
+        wlm_tmp = H.map2alm_spin(window_tens, 2, lmax=lmax)
+        wEBlm[2, :] = wlm_tmp[0]
+        wEBlm[-2, :] = wlm_tmp[1]
 
     if maps:
         window_vect = window_vect[0] + 1j*window_vect[1]
@@ -267,16 +299,67 @@ def _get_wEBlm(window_scal, lmax=None, maps=False):
         return wEBlm
 
 
+def _wigner_rows(l1, l2_vals, tm1, tm2, table=None):
+    '''
+    Wigner 3j families (l1 l2 l3; m1 m2 -m1-m2) over all valid l3 for every
+    l2 in l2_vals. All of the families are calculated in one batched
+    recursion and returned as a list of views, one per l2.
+
+    Every (l1, l2, m1, m2) family is only needed once in a run, so the
+    families are not cached. If a precomputed Wigner3jTable is given the
+    families are read from it instead, and only run up to the lmax of the
+    table. The table can also be a Wigner3jAsymptotic, that
+    approximates the families at high l. The m1 = m2 = 0 families are
+    evaluated from their closed form.
+    '''
+
+    if table is not None:
+        return table.families(2*l1, 2*np.asarray(l2_vals), tm1, tm2)
+
+    l2_vals = np.asarray(l2_vals)
+
+    if tm1 == 0 and tm2 == 0:
+        wigvals, jmin, Nj = wc.wigner3j_000_batch(2*l1, 2*l2_vals)
+    else:
+        wigvals, jmin, Nj = wc.wigner3j_vect_batch(2*l1, 2*l2_vals, tm1, tm2)
+
+    return [wigvals[i, :Nj[i]] for i in range(len(l2_vals))]
+
+
+def _wigner_pm_rows(l1, l2_vals, tm1, tm2, table=None):
+    '''
+    Sums and differences Jp, Jm of the Wigner 3j families for (m1, m2) and
+    (-m1, -m2) for every l2 in l2_vals, as a list of (Jp, Jm) pairs. Only
+    the (m1, m2) families are calculated (or read from the table).
+    '''
+
+    if table is not None:
+        return table.pm_families(2*l1, 2*np.asarray(l2_vals), tm1, tm2)
+
+    l2_vals = np.asarray(l2_vals)
+
+    Jp, Jm, jmin, Nj = wc.wigner3j_pm_vect_batch(2*l1, 2*l2_vals, tm1, tm2)
+
+    return [(Jp[i, :Nj[i]], Jm[i, :Nj[i]]) for i in range(len(l2_vals))]
+
+
 def calc_modemixing(comm, window, cl_type='pseudo', lmax=None, scal=True,
-                    pol=True, cross=True, verbose=True):
+                    pol=True, cross=True, verbose=True, wigner_table=None,
+                    wigner_tol=None, wigner_lmin=wc.ASYMPTOTIC_LMIN,
+                    symmetric=True, schedule='cyclic', reduce='all',
+                    nthreads=1, harmonic_window=False, checkpoint_dir=None,
+                    checkpoint_interval=600.0, cache=None):
     '''
     Calculates the mode-mixing matrices given an input full sky window in
     Healpix format
 
     Parameters
     ----------
-    comm : mpi4py.MPI.Intracomm
-        MPI communicator (normally COMM_WORLD)
+    comm : mpi4py.MPI.Intracomm, concurrent.futures.Executor, or None
+        MPI communicator (normally COMM_WORLD). If an Executor is given
+        instead the rows are calculated in chunks by it, and if None by a
+        local process pool with one process per core, without MPI. schedule
+        and reduce are then ignored.
 
     window : array-like
         Healpix scalar window
@@ -296,6 +379,75 @@ def calc_modemixing(comm, window, cl_type='pseudo', lmax=None, scal=True,
     cross : bool, optional
         Whether to calculate the mode-mixing matrix for temp-pol
 
+    wigner_table : str or wignercoupling.Wigner3jTable, optional
+        Precomputed Wigner 3j table (see wignercoupling.build_wigner3j_table)
+        to read the Wigner 3j symbols from instead of calculating them. Its
+        lmax must be at least lmax. A wignercoupling.Wigner3jAsymptotic can
+        be given instead.
+
+    wigner_tol : float, optional
+        If given, the Wigner 3j symbols with min(l1, l2) >= wigner_lmin are
+        calculated with their semiclassical approximation to this tolerance
+        (relative to their local amplitude) instead of exactly. Tolerances
+        around 1e-6 are possible at high l. Cannot be combined with
+        wigner_table.
+
+    wigner_lmin : int, optional
+        Smallest min(l1, l2) for which the approximation is used when
+        wigner_tol is given
+
+    symmetric : bool, optional
+        Whether to only calculate the l2 >= l1 half of the matrix blocks for
+        which M[l1, l2] / (2*l2+1) is symmetric, and fill the other half
+        from it. These are all of the blocks for pseudo Cls and Mscal for
+        pure and hybrid Cls.
+
+    schedule : 'cyclic', 'static', or 'dynamic', optional
+        How the rows l1 are distributed over the ranks. 'cyclic' deals them
+        out in turn, 'static' balances a model of the cost of each row over
+        the ranks, and 'dynamic' has the ranks take chunks of rows, most
+        expensive first, as they finish their previous chunk. The matrices
+        do not depend on the schedule. 'dynamic' is not exception safe: an
+        error in the rows of one rank aborts all of the ranks.
+
+    reduce : 'all', 'root', or 'rows', optional
+        How the matrices are combined over the ranks. 'all' sums them in
+        place on all ranks. 'root' only sums them on rank 0 and 'rows' only
+        gathers the rows calculated by each rank on rank 0, in which case the
+        other ranks return None for every matrix.
+
+    nthreads : int, optional
+        Number of threads that each rank, or each worker of the process pool
+        if comm is None or an Executor, uses for its rows. The threads share
+        the matrices of the rank (the rows of the chunk of the worker) and
+        write to disjoint rows of them.
+
+    harmonic_window : bool, optional
+        Whether the vector and tensor windows, the derivatives of the scalar
+        window, can be taken to vanish wherever the window is zero. Their
+        alms are then calculated straight from the scalar window alms,
+        skipping the spherical harmonic transforms to maps and back that
+        mask them. Only use this for windows that are apodized to zero
+        smoothly.
+
+    checkpoint_dir : str, optional
+        Directory to save the finished rows of each rank to, so that an
+        interrupted calculation can be resumed. If it already has
+        checkpoints of the same calculation their rows are not calculated
+        again. The directory can be shared by the ranks or local to each
+        node.
+
+    checkpoint_interval : float, optional
+        Minimum time in seconds between the checkpoints of each rank
+
+    cache : str or ModeMixingCache, optional
+        Cache (or directory of a cache) of mode-mixing matrices. Requested
+        matrices that are in the cache are loaded from it as read-only
+        memory maps instead of being calculated, and the ones that are
+        calculated are added to it. With MPI the directory must be shared by
+        all of the ranks, and with reduce='root' or 'rows' the other ranks
+        return None for the cached matrices as well.
+
     Returns
     -------
     Mout : list
@@ -307,369 +459,1296 @@ def calc_modemixing(comm, window, cl_type='pseudo', lmax=None, scal=True,
         nside = H.npix2nside(len(window))
         lmax = 3*nside - 1
 
-    wEBlm = _get_wEBlm(window, lmax=lmax)
+    if isinstance(wigner_table, str):
+        wigner_table = wc.Wigner3jTable(wigner_table)
+
+    if (wigner_table is not None) and (wigner_table.lmax is not None) and \
+            (wigner_table.lmax < lmax):
+        raise ValueError("The lmax of the Wigner 3j table is smaller than lmax")
+
+    if wigner_tol is not None:
+        if wigner_table is not None:
+            raise ValueError("wigner_tol cannot be used with a wigner_table")
+        wigner_table = wc.Wigner3jAsymptotic(tol=wigner_tol,
+                                             lmin=wigner_lmin)
+
+    use_mpi = not (comm is None or isinstance(comm, futures.Executor))
+
+    names = [name for name, calc in zip(_MATRIX_NAMES, (scal, pol, cross))
+             if calc]
+    cached = {}
+
+    if cache is not None:
+        if isinstance(cache, str):
+            cache = ModeMixingCache(cache)
+
+        key = cache.key(window, lmax, cl_type, _wigner_key(wigner_table),
+                        harmonic_window)
+
+        def _load(names):
+            loaded = [(name, cache.load(key, name, cl_type))
+                      for name in names]
+            return dict((name, M) for name, M in loaded if M is not None)
+
+        # Each matrix is loaded once and a failed load is a miss. With MPI
+        # rank 0 loads first and the other ranks only try what it loaded.
+        # Like the calculated matrices, the ones from the cache are only
+        # returned on rank 0 unless they are reduced to all of the ranks.
+        if not use_mpi or comm.Get_rank() == 0:
+            cached = _load(names)
+        if use_mpi:
+            found = comm.bcast(sorted(cached) if comm.Get_rank() == 0
+                               else None, root=0)
+
+            if comm.Get_rank() != 0:
+                cached = _load(found) if reduce == 'all' else \
+                    dict.fromkeys(found)
+
+            # Only the matrices that all of the ranks have are cache hits,
+            # so that all of the ranks calculate the same matrices
+            loaded = comm.allgather(set(cached))
+            cached = dict((name, cached[name]) for name in found
+                          if all(name in names_rank for names_rank in loaded))
+
+        if len(cached) == len(names):
+            return [cached[name] for name in names]
+
+        scal, pol, cross = [calc and name not in cached for name, calc in
+                            zip(_MATRIX_NAMES, (scal, pol, cross))]
+
+    # Only the spectra of the window alms are needed. With MPI the window
+    # transforms are done on rank 0 and the spectra are broadcast.
+    if not use_mpi:
+        wEBlm = _get_wEBlm(window, lmax=lmax, harmonic=harmonic_window)
+        spectra = _window_spectra(wEBlm, lmax, pol or cross)
+    else:
+        spectra = _bcast_window_spectra(comm, window, lmax, pol or cross,
+                                        harmonic_window)
 
-    Mout = []
+    Mout = _calc_Mall(comm, None, lmax=lmax, cl_type=cl_type, scal=scal,
+                      pol=pol, cross=cross, verbose=verbose,
+                      table=wigner_table, symmetric=symmetric,
+                      schedule=schedule, reduce=reduce, nthreads=nthreads,
+                      spectra=spectra, checkpoint_dir=checkpoint_dir,
+                      checkpoint_interval=checkpoint_interval)
 
-    if scal:
-        Mscal = _calc_Mscal(comm, wEBlm, lmax=lmax, verbose=verbose)
-        Mout.append(Mscal)
+    if cache is not None:
+        calculated = dict(zip([name for name in names if name not in cached],
+                              Mout))
 
-    if pol:
-        Mpol = _calc_Mpol(comm, wEBlm, lmax=lmax, cl_type=cl_type,
-                          verbose=verbose)
-        Mout.append(Mpol)
+        if not use_mpi or comm.Get_rank() == 0:
+            for name, M in calculated.items():
+                cache.store(key, name, M, cl_type)
 
-    if cross:
-        Mcross = _calc_Mcross(comm, wEBlm, lmax=lmax, cl_type=cl_type,
-                              verbose=verbose)
-        Mout.append(Mcross)
+        Mout = [cached[name] if name in cached else calculated[name]
+                for name in names]
 
     return Mout
 
 
-def _calc_Mscal(comm, wEBlm, lmax=None, verbose=True):
-    '''Calculate the temperature/V polarization mode-mixing matrix
+_MATRIX_NAMES = ('scal', 'pol', 'cross')
+
+# Digest of the code that calculates the matrices, set by _code_version
+_code_digest = None
+
+
+def _code_version():
+    '''Digest of the sources of the modules that calculate the mode-mixing
+    matrices and of the healpy version, for the keys of ModeMixingCache.
+    Any change to the code gives new keys, so that stale matrices are never
+    loaded.
     '''
 
-    rank = comm.Get_rank()
-    size = comm.Get_size()
+    global _code_digest
 
-    if lmax is None:
-        lmax = H.Alm.getlmax(len(wEBlm[0, :]))
+    if _code_digest is None:
+        digest = hashlib.sha1(H.__version__.encode())
+        for module_file in (__file__, wc.__file__, H_ext.__file__):
+            with open(module_file, 'rb') as fin:
+                digest.update(fin.read())
+        _code_digest = digest.hexdigest()
 
-    Mscal = np.zeros([lmax+1, lmax+1])
-    wl = H.alm2cl(wEBlm[0, :])
+    return _code_digest
 
-    for l1 in range(2+rank, lmax+1, size):
-        if verbose:
-            print("Scal l1 = ", l1)
-        for l2 in range(2, lmax+1):
-            l3min = np.abs(l1-l2)
-            l3max = np.abs(l1+l2)
+_MMCACHE_MAGIC = b'CMBMMMAT'
+_MMCACHE_VERSION = 1
+_MMCACHE_HEADER = '<8sIII8s'
 
-            l3vals = np.arange(l3min, l3max+1)
 
-            # Calculates Wigner 3j symbol for all valid l3
-            JT = wc.wigner3j_vect(2*l1, 2*l2, 0, 0)
+class ModeMixingCache(object):
+    '''On-disk cache of mode-mixing matrices
 
-            # Since we only have wl up to lmax we must ignore all terms that
-            # have l3 > lmax
-            idx = l3vals <= lmax
+    The matrices are keyed on a hash of the window, lmax, cl_type, the
+    Wigner 3j backend and the code that calculates them, and each one is
+    stored in its own file with a short header. They are loaded as
+    read-only memory maps, so that only the rows that are used are read.
+    When the files take up more than maxbytes the least recently used ones
+    are deleted.
 
-            Mscal[l1, l2] = np.sum((2*l3vals[idx]+1)*wl[l3vals[idx]] *
-                                   JT[idx]**2)
+    Parameters
+    ----------
+    directory : str
+        Cache directory
 
-            normfact = (2.0*l2+1.0) / (4.0*np.pi)
-            Mscal[l1, l2] *= normfact
+    maxbytes : int, optional
+        Maximum number of bytes of matrices that are kept
+    '''
 
-    Mscal = comm.allreduce(Mscal)
+    def __init__(self, directory, maxbytes=16*2**30):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.maxbytes = int(maxbytes)
+
+    def key(self, window, lmax, cl_type, wigner=None, harmonic_window=False):
+        '''Returns the key of the matrices of a window'''
+
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(window, dtype='<f8').tobytes())
+        digest.update(json.dumps([int(lmax), cl_type, wigner,
+                                  bool(harmonic_window),
+                                  _code_version()]).encode())
+
+        return digest.hexdigest()
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, '%s_%s.mmx' % (key, name))
+
+    def load(self, key, name, cl_type=None):
+        '''Returns matrix name ('scal', 'pol' or 'cross') stored under key
+        as a read-only memory map, or None if it is not in the cache (or
+        was stored for another cl_type, if cl_type is given)'''
+
+        path = self._path(key, name)
+        header_size = struct.calcsize(_MMCACHE_HEADER)
+
+        # The memory map is made from the open file, so it stays valid if
+        # another process evicts the file in the meantime
+        try:
+            with open(path, 'rb') as fin:
+                header = fin.read(header_size)
+                if len(header) != header_size:
+                    return None
+
+                magic, version, lmax, nblocks, stored_cl_type = \
+                    struct.unpack(_MMCACHE_HEADER, header)
+
+                if magic != _MMCACHE_MAGIC or version != _MMCACHE_VERSION:
+                    return None
+
+                if cl_type is not None and \
+                        stored_cl_type.rstrip(b'\0') != cl_type.encode():
+                    return None
+
+                n = nblocks*(lmax+1)
+                if os.fstat(fin.fileno()).st_size != header_size + 8*n*n:
+                    return None
+
+                M = np.memmap(fin, dtype='<f8', mode='r', offset=header_size,
+                              shape=(n, n))
+        except OSError:
+            return None
+
+        # Mark it as recently used. This fails on read-only file systems, in
+        # which case the eviction order is the order the files were stored.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return M
+
+    def store(self, key, name, M, cl_type=''):
+        '''Adds matrix name ('scal', 'pol' or 'cross') to the cache under
+        key and evicts the least recently used matrices if needed'''
+
+        M = np.asarray(M)
+        nbytes = struct.calcsize(_MMCACHE_HEADER) + 8*M.size
+        if nbytes > self.maxbytes:
+            return
+
+        nblocks = (1, 3, 2)[_MATRIX_NAMES.index(name)]
+        lmax = len(M) // nblocks - 1
+
+        path = self._path(key, name)
+        with open(path + '.tmp', 'wb') as fout:
+            fout.write(struct.pack(_MMCACHE_HEADER, _MMCACHE_MAGIC,
+                                   _MMCACHE_VERSION, lmax, nblocks,
+                                   cl_type.encode()))
+            fout.write(M.astype('<f8').tobytes())
+        os.replace(path + '.tmp', path)
+
+        self.evict()
+
+    def evict(self):
+        '''Deletes the least recently used matrices until the cache is
+        within maxbytes'''
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.mmx'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+
+        for mtime, size, path in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        '''Deletes all of the matrices in the cache'''
+
+        maxbytes = self.maxbytes
+        self.maxbytes = -1
+        self.evict()
+        self.maxbytes = maxbytes
+
+
+# Fixed cost of the Mpol and Mcross work for each (l1, l2) in the model of
+# _row_costs, in units of one Wigner 3j symbol
+_L2_OVERHEAD = 300
+
+
+def _calc_Mscal(comm, wEBlm, lmax=None, verbose=True, table=None):
+    '''Calculate the temperature/V polarization mode-mixing matrix
+    '''
 
-    return Mscal
+    return _calc_Mall(comm, wEBlm, lmax=lmax, scal=True, pol=False,
+                      cross=False, verbose=verbose, table=table)[0]
 
 
-def _calc_Mpol(comm, wEBlm, lmax=None, cl_type='pseudo', verbose=True):
+def _calc_Mpol(comm, wEBlm, lmax=None, cl_type='pseudo', verbose=True,
+               table=None):
     '''Calculate the polarization mode mixing matrix
     '''
 
-    rank = comm.Get_rank()
-    size = comm.Get_size()
+    return _calc_Mall(comm, wEBlm, lmax=lmax, cl_type=cl_type, scal=False,
+                      pol=True, cross=False, verbose=verbose, table=table)[0]
+
+
+def _calc_Mcross(comm, wEBlm, lmax=None, cl_type='pseudo', verbose=True,
+                 table=None):
+    '''Calculate the temp-pol mode-mixing matrix.
+    '''
+
+    return _calc_Mall(comm, wEBlm, lmax=lmax, cl_type=cl_type, scal=False,
+                      pol=False, cross=True, verbose=verbose, table=table)[0]
+
+
+def _calc_Mall(comm, wEBlm, lmax=None, cl_type='pseudo', scal=True, pol=True,
+               cross=True, verbose=True, table=None, symmetric=False,
+               schedule='cyclic', reduce='all', nthreads=1, spectra=None,
+               checkpoint_dir=None, checkpoint_interval=600.0):
+    '''Calculate the requested mode-mixing matrices (Mscal, Mpol, Mcross
+    in that order) in a single pass over (l1, l2)
+
+    The Wigner 3j families of each l1 are calculated once and shared between
+    the matrices: the m = 0 families by Mscal and Mcross and the (-2+m, 2)
+    families by Mpol and Mcross. The matrices are combined over the ranks
+    as given by reduce (see _reduce_matrices).
+
+    The sums over m of products of the window alms in Mpol and Mcross only
+    depend on l3, so they are taken once from the cross-spectra of the
+    window alms (_window_cross_spectra) and every matrix element is a sum
+    over l3 of those times products of Wigner 3j symbols. This makes the
+    cost O(lmax**3) instead of O(lmax**4).
+
+    If symmetric is True only l2 >= l1 is calculated for Mscal, and for all
+    of the matrices if cl_type is 'pseudo', and the rest is filled in by
+    _mirror_blocks.
+
+    The rows l1 are split over the ranks as given by schedule (see
+    _l1_schedule), and over nthreads threads in each rank or pool worker.
+
+    If spectra is given it must be the (wl, Cw) from _window_spectra, and
+    wEBlm is not used.
+
+    If checkpoint_dir is given the finished rows are saved there every
+    checkpoint_interval seconds, and rows that are already there are not
+    calculated again (see _Checkpoint).
+    '''
+
+    if reduce not in ('all', 'root', 'rows'):
+        raise ValueError("Unknown reduce: " + str(reduce))
 
     if lmax is None:
         lmax = H.Alm.getlmax(len(wEBlm[0, :]))
-    
-    l, m = H.Alm.getlm(lmax)
 
-    Mpol = np.zeros([3*lmax+3, 3*lmax+3])
+    # For pseudo Cls all of the blocks of all of the matrices are symmetric,
+    # otherwise only Mscal is
+    half_all = symmetric and (cl_type == 'pseudo')
 
-    a0 = 1.0
-    a1 = 2.0
-    a2 = 1.0
+    if spectra is None:
+        spectra = _window_spectra(wEBlm, lmax, pol or cross)
+
+    wl, Cw = spectra
+
+    overhead = _L2_OVERHEAD if (pol or cross) else 0
+    costs = _row_costs(lmax, half_all, overhead)
+
+    Mall = _new_matrices(lmax, scal, pol, cross)
+    row_args = (lmax, cl_type, symmetric, wl, Cw, table, verbose)
+
+    use_mpi = not (comm is None or isinstance(comm, futures.Executor))
+
+    checkpoint = None
+    l1_skip = set()
+    l1_resumed = []
+    if checkpoint_dir is not None:
+        key = _checkpoint_key(lmax, cl_type, Mall, symmetric, spectra, table)
+        checkpoint = _Checkpoint(checkpoint_dir, comm.Get_rank() if use_mpi
+                                 else 0, key, Mall, lmax, checkpoint_interval)
+        l1_skip, l1_resumed = checkpoint.resume(comm if use_mpi else None)
 
-    l1_vals = range(2+rank, lmax+1, size)
+        # The rows that are done are not scheduled again
+        costs[np.array(sorted(l1_skip), dtype=int)-2] = 0
+
+    done_callback = None if checkpoint is None else checkpoint.row_done
+
+    if not use_mpi:
+        _pool_fill_rows(comm, Mall, row_args, costs, l1_skip, done_callback,
+                        nthreads)
+        if checkpoint is not None:
+            checkpoint.flush()
+    else:
+        l1_vals = _l1_schedule(comm, lmax, schedule, costs)
+        l1_vals = (l1 for l1 in l1_vals if l1 not in l1_skip)
+
+        try:
+            if nthreads > 1:
+                l1_done = _thread_fill_rows(Mall, l1_vals, row_args,
+                                            nthreads, done_callback)
+            else:
+                l1_done = _fill_rows(Mall, l1_vals, *row_args,
+                                     done_callback=done_callback)
+        except Exception:
+            # The other ranks keep taking rows from the shared counter and
+            # then wait for this one to free its window, so they can only
+            # be stopped by aborting
+            if schedule == 'dynamic' and comm.Get_size() > 1:
+                traceback.print_exc()
+                sys.stderr.flush()
+                comm.Abort(1)
+            raise
+
+        if checkpoint is not None:
+            checkpoint.flush()
+
+        if not _reduce_matrices(comm, [M for M in Mall if M is not None],
+                                l1_done + l1_resumed, lmax, reduce):
+            return [None] * (scal + pol + cross)
+
+    Mscal, Mpol, Mcross = Mall
+
+    if symmetric:
+        if scal:
+            _mirror_blocks(Mscal, lmax)
+        if half_all and pol:
+            _mirror_blocks(Mpol, lmax)
+        if half_all and cross:
+            _mirror_blocks(Mcross, lmax)
+
+    return [M for M in Mall if M is not None]
+
+
+def _new_matrices(lmax, scal, pol, cross):
+    '''Zero Mscal, Mpol, and Mcross, or None for those that are not needed
+    '''
+
+    Mscal = np.zeros([lmax+1, lmax+1]) if scal else None
+    Mpol = np.zeros([3*lmax+3, 3*lmax+3]) if pol else None
+    Mcross = np.zeros([2*lmax+2, 2*lmax+2]) if cross else None
+
+    return [Mscal, Mpol, Mcross]
+
+
+def _fill_rows(Mall, l1_vals, lmax, cl_type, symmetric, wl, Cw, table,
+               verbose, done_callback=None):
+    '''Fills the rows l1 in l1_vals of the matrices in Mall (Mscal, Mpol,
+    Mcross, None for those that are not needed), in every block row, and
+    returns the l1 that were filled. If done_callback is given it is called
+    with each l1 once its row is finished.
+    '''
+
+    Mscal, Mpol, Mcross = Mall
+    scal = Mscal is not None
+    pol = Mpol is not None
+    cross = Mcross is not None
+
+    pure = (cl_type == 'pure') or (cl_type == 'hybrid')
+    half_all = symmetric and (cl_type == 'pseudo')
 
     # Don't need to calculate this if we are looking at pseudo Cls, but it
     # is not the bottleneck in the calculation so I don't care
-    Nl12 = H_ext._nfunc(l1_vals, 2)
-    Nl11 = H_ext._nfunc(l1_vals, 1)
-    Nl10 = H_ext._nfunc(l1_vals, 0)
+    Nl12 = H_ext._nfunc(range(2, lmax+1), 2)
+    Nl11 = H_ext._nfunc(range(2, lmax+1), 1)
+    Nl10 = H_ext._nfunc(range(2, lmax+1), 0)
     fact0s = Nl10 / Nl12
     fact1s = Nl11 / Nl12
 
-    for l1, fact0, fact1 in zip(l1_vals, fact0s, fact1s):
+    if pol or cross:
+        Cpad = np.zeros(Cw.shape[:2] + (2*lmax+1, ))
+        Cpad[:, :, :lmax+1] = Cw
+
+    l1_done = []
+
+    for l1 in _report_rows(l1_vals, l1_done, done_callback):
         if verbose:
-            print("Pol l1 = ", l1)
+            print("l1 = ", l1)
 
-        for l2 in range(2, lmax+1):
-            l3min = np.abs(l1-l2)
-            l3max = np.abs(l1+l2)
+        fact0 = fact0s[l1-2]
+        fact1 = fact1s[l1-2]
 
-            # Minimum l3 for when m3 is 1 or 2
-            l3min2 = np.max([l3min, 2])
-            l3min1 = np.max([l3min, 1])
+        l2_vals = range(l1 if half_all else 2, lmax+1)
+        l2_scal = range(l1 if symmetric else 2, lmax+1)
 
-            # Wigner Symbols that we need are
-            # (l1   l2 l3 ) and (l1   l2 l3) for m=0 (pseudo)
-            # (-2+m 2  -m )     (2-m  -2 m ) and m=1,2 (pure)
+        # Wigner Symbols that we need are
+        # (l1 l2 l3) for Mscal and Mcross and
+        # (l1   l2 l3 ) and (l1   l2 l3) for m=0 (pseudo)
+        # (-2+m 2  -m )     (2-m  -2 m ) and m=1,2 (pure)
+        # for Mpol and Mcross. They are calculated for all l2 at once. Only
+        # the first of each pair is calculated, the second one is the first
+        # times (-1)**(l1+l2+l3).
+        if scal or cross:
+            JT_rows = _wigner_rows(l1, l2_vals if cross else l2_scal, 0, 0,
+                                   table)
 
-            # m=0 term needed for pseudo and pure
-            wc_0 = wc.wigner3j_vect(2*l1, 2*l2, -2*2, 2*2)
-            wc_1 = wc.wigner3j_vect(2*l1, 2*l2, 2*2, -2*2)
-            Jp0 = wc_0 + wc_1
-            Jm0 = wc_0 - wc_1
+        if pol or cross:
+            pm_0_rows = _wigner_pm_rows(l1, l2_vals, -2*2, 2*2, table)
 
             # m=1,2 terms are only needed for pure modes
-            if (cl_type == 'pure') or (cl_type == 'hybrid'):
-                wc_0 = wc.wigner3j_vect(2*l1, 2*l2, (-2+1)*2, 2*2)
-                wc_1 = wc.wigner3j_vect(2*l1, 2*l2, (2-1)*2, -2*2)
-                Jp1 = wc_0 + wc_1
-                Jm1 = wc_0 - wc_1
-
-                wc_0 = wc.wigner3j_vect(2*l1, 2*l2, (-2+2)*2, 2*2)
-                wc_1 = wc.wigner3j_vect(2*l1, 2*l2, (2-2)*2, -2*2)
-                Jp2 = wc_0 + wc_1
-                Jm2 = wc_0 - wc_1
-
-            # This allows us to remove any sum over m or l3
-            idx = np.all([l >= l3min, l <= l3max], axis=0)
-            l_tmp = l[idx]
-            m_tmp = m[idx]
-            m0 = m_tmp == 0
-
-            wEBlm_tmp = wEBlm[:, idx]
-
-            # Calculate the correct index in the Jp and Jm terms
-            idx_l3_0 = np.array(l_tmp - l3min, dtype=int)  # Jp0, Jm0
-            idx_l3_1 = np.array(l_tmp - l3min1, dtype=int)  # Jp1, Jm1
-            idx_l3_2 = np.array(l_tmp - l3min2, dtype=int)  # Jp2, Jm2
-
-            # When l3min is 0 or 1 and take the whole range, Jp1(Jm1) and/or
-            # Jp2(Jm2) get non-zero values when they should be zero (when l3 =
-            # 0 or 1) because negative indices in idx_l3_1 and idx_l3_2 wrap
-            # around to the end
-            idx1 = l_tmp >= l3min1
-            idx2 = l_tmp >= l3min2
-
-            # EE,EE and BB,BB (2/9)
-            termE = a2 * wEBlm_tmp[0, :] * Jp0[idx_l3_0]
-            termB = np.zeros_like(termE)
-
-            if cl_type == 'pseudo' or cl_type == 'hybrid':
-                Mpol[l1, l2] = 2*np.sum(termE*np.conj(termE))
-                Mpol[l1, l2] -= np.sum(termE[m0]*np.conj(termE[m0]))
-
-            if cl_type == 'pure' or cl_type == 'hybrid':
-                termE[idx1] += a1*fact1*wEBlm_tmp[1, idx1]*Jp1[idx_l3_1][idx1]
-                termE[idx2] += a0*fact0*wEBlm_tmp[2, idx2]*Jp2[idx_l3_2][idx2]
-                termB[idx1] += a1*fact1*wEBlm_tmp[-1, idx1]*Jm1[idx_l3_1][idx1]
-                termB[idx2] += a0*fact0*wEBlm_tmp[-2, idx2]*Jm2[idx_l3_2][idx2]
-
-            Mpol[l1+lmax+1, l2+lmax+1] = 2*np.sum(termE*np.conj(termE) +
-                                                  termB*np.conj(termB))
-            Mpol[l1+lmax+1, l2+lmax+1] -= np.sum(termE[m0]*np.conj(termE[m0]) +
-                                                 termB[m0]*np.conj(termB[m0]))
-
-            if cl_type == 'pure':
-                Mpol[l1, l2] = Mpol[l1+lmax+1, l2+lmax+1]
-
-            # EE,BB and BB,EE (4/9)
-            termE = a2 * wEBlm_tmp[0, :] * Jm0[idx_l3_0]
-            termB = np.zeros_like(termE)
-
-            if cl_type == 'pseudo' or cl_type == 'hybrid':
-                Mpol[l1, l2+lmax+1] = 2*np.sum(termE*np.conj(termE))
-                Mpol[l1, l2+lmax+1] -= np.sum(termE[m0]*np.conj(termE[m0]))
-
-            if cl_type == 'pseudo':
-                Mpol[l1+lmax+1, l2] = Mpol[l1, l2+lmax+1]
-
-            if cl_type == 'pure' or cl_type == 'hybrid':
-                termE[idx1] += a1*fact1*wEBlm_tmp[1, idx1]*Jm1[idx_l3_1][idx1]
-                termE[idx2] += a0*fact0*wEBlm_tmp[2, idx2]*Jm2[idx_l3_2][idx2]
-                termB[idx1] += a1*fact1*wEBlm_tmp[-1, idx1]*Jp1[idx_l3_1][idx1]
-                termB[idx2] += a0*fact0*wEBlm_tmp[-2, idx2]*Jp2[idx_l3_2][idx2]
-
-                Mpol[l1+lmax+1, l2] = 2*np.sum(termE*np.conj(termE) +
-                                               termB*np.conj(termB))
-                Mpol[l1+lmax+1, l2] -= np.sum(termE[m0]*np.conj(termE[m0]) +
-                                              termB[m0]*np.conj(termB[m0]))
-
-            if cl_type == 'pure':
-                Mpol[l1, l2+lmax+1] = Mpol[l1+lmax+1, l2]
-
-            # EB,EB (5/9)
-            if cl_type == 'pseudo' or cl_type == 'pure':
-                # EE,EE - EE,BB
-                Mpol[l1+2*lmax+2, l2+2*lmax+2] = Mpol[l1, l2] - Mpol[l1, l2+lmax+1]
+            if pure:
+                pm_1_rows = _wigner_pm_rows(l1, l2_vals, (-2+1)*2, 2*2, table)
+                pm_2_rows = _wigner_pm_rows(l1, l2_vals, (-2+2)*2, 2*2, table)
+
+        if scal:
+            # l2_scal is the end of l2_vals
+            _fill_Mscal_row(Mscal, l1, l2_scal, lmax, wl,
+                            JT_rows[len(JT_rows)-len(l2_scal):])
+
+        if not (pol or cross):
+            continue
+
+        # The (l1, l2) elements are filled for blocks of l2 at once, with
+        # the families as (l2, l3) slabs on l3 grids that start at
+        # l3min = |l1-l2| for each l2. Since we only have the window alms up
+        # to lmax, the cross-spectra are zero above it and the terms with
+        # l3 > lmax drop out.
+        l2_arr = np.asarray(l2_vals)
+        l3min = np.abs(l1-l2_arr)
+
+        for start in range(0, len(l2_arr), _l2_block(l1, lmax)):
+            block = slice(start, start+_l2_block(l1, lmax))
+            l2 = l2_arr[block]
+
+            width = min(2*min(l1, l2[-1]) + 1,
+                        lmax - np.min(l3min[block]) + 1)
+            cols = l3min[block, None] + np.arange(width)
+            Cl3 = Cpad[:, :, cols]
+
+            # The m=1,2 families start at l3 = 1, 2 when l3min is lower
+            Jp0, Jm0 = [_l3_slab(J, 0, width)
+                        for J in zip(*pm_0_rows[block])]
+            if pure:
+                Jp1, Jm1 = [_l3_slab(J, np.maximum(l3min[block], 1) -
+                                     l3min[block], width)
+                            for J in zip(*pm_1_rows[block])]
+                Jp2, Jm2 = [_l3_slab(J, np.maximum(l3min[block], 2) -
+                                     l3min[block], width)
+                            for J in zip(*pm_2_rows[block])]
             else:
-                termE = np.zeros_like(Jp0[idx_l3_0], dtype=np.float64)
-                termE[idx2] += a0*fact0*(Jp0[idx_l3_0]*Jp2[idx_l3_2]-Jm0[idx_l3_0]*Jm2[idx_l3_2])[idx2] * np.real(wEBlm_tmp[0, idx2]*np.conj(wEBlm_tmp[2, idx2]))
-                termE[idx1] += a1*fact1*(Jp0[idx_l3_0]*Jp1[idx_l3_1]-Jm0[idx_l3_0]*Jm1[idx_l3_1])[idx1] * np.real(wEBlm_tmp[0, idx1]*np.conj(wEBlm_tmp[1, idx1]))
-                termE += a2 * (Jp0[idx_l3_0]*Jp0[idx_l3_0] - Jm0[idx_l3_0]*Jm0[idx_l3_0]) * np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[0, :]))
-                Mpol[l1+2*lmax+2, l2+2*lmax+2] = 2*np.sum(termE) - np.sum(termE[m0])
-
-            # EE,EB and BB,EB (7/9)
-            if cl_type == 'pure' or cl_type == 'hybrid':
-                termE = np.zeros_like(Jp0[idx_l3_0], dtype=np.float64)
-                # only non-zero for pure (and B is pure in hybrid).
-                termE[idx2] += a0*a0*fact0*fact0*(Jp2[idx_l3_2]*Jp2[idx_l3_2]*np.real(wEBlm_tmp[2, :]*np.conj(wEBlm_tmp[-2, :]))
-                                                  - Jm2[idx_l3_2]*Jm2[idx_l3_2]*np.real(wEBlm_tmp[-2, :]*np.conj(wEBlm_tmp[2, :])))[idx2]
-                termE[idx2] += a0*a1*fact0*fact1*(Jp2[idx_l3_2]*Jp1[idx_l3_1]*np.real(wEBlm_tmp[2, :]*np.conj(wEBlm_tmp[-1, :]))
-                                                  - Jm2[idx_l3_2]*Jm1[idx_l3_1]*np.real(wEBlm_tmp[-2, :]*np.conj(wEBlm_tmp[1, :])))[idx2]
-                termE[idx2] += a0*a2*fact0*(-Jm2[idx_l3_2]*Jm0[idx_l3_0]*np.real(wEBlm_tmp[-2, :]*np.conj(wEBlm_tmp[0, :])))[idx2]
-                termE[idx2] += a1*a0*fact1*fact0*(Jp1[idx_l3_1]*Jp2[idx_l3_2]*np.real(wEBlm_tmp[1, :]*np.conj(wEBlm_tmp[-2, :]))
-                                                  - Jm1[idx_l3_1]*Jm2[idx_l3_2]*np.real(wEBlm_tmp[-1, :]*np.conj(wEBlm_tmp[2, :])))[idx2]
-                termE[idx1] += a1*a1*fact1*fact1*(Jp1[idx_l3_1]*Jp1[idx_l3_1]*np.real(wEBlm_tmp[1, :]*np.conj(wEBlm_tmp[-1, :]))
-                                                  - Jm1[idx_l3_1]*Jm1[idx_l3_1]*np.real(wEBlm_tmp[-1, :]*np.conj(wEBlm_tmp[1, :])))[idx1]
-                termE[idx1] += a1*a2*fact1*(-Jm1[idx_l3_1]*Jm0[idx_l3_0]*np.real(wEBlm_tmp[-1, :]*np.conj(wEBlm_tmp[0, :])))[idx1]
-                termE[idx2] += a2*a0*fact0*(Jp0[idx_l3_0]*Jp2[idx_l3_2]*np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[-2, :])))[idx2]
-                termE[idx1] += a2*a1*fact1*(Jp0[idx_l3_0]*Jp1[idx_l3_1]*np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[-1, :])))[idx1]
-
-                Mpol[l1+lmax+1, l2+2*lmax+2] = 2*np.sum(termE) - np.sum(termE[m0])
-
-            if cl_type == 'pure':
-                Mpol[l1, l2+2*lmax+2] = Mpol[l1+lmax+1, l2+2*lmax+2]
-
-            # EB,EE and EB,BB (9/9)
-            if cl_type == 'pure':
-                Mpol[l1+2*lmax+2, l2] = Mpol[l1, l2+2*lmax+2]
-                Mpol[l1+2*lmax+2, l2+lmax+1] = Mpol[l1, l2+2*lmax+2]
-            elif cl_type == 'hybrid':
-                termE = np.zeros_like(Jp0[idx_l3_0], dtype=np.float64)
-                termE[idx2] += a0*fact0*(Jp0[idx_l3_0]*Jp2[idx_l3_2]*np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[-2, :])))[idx2]
-                termE[idx1] += a1*fact1*(Jp0[idx_l3_0]*Jp1[idx_l3_1]*np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[-1, :])))[idx1]
-
-                termB = np.zeros_like(Jm0[idx_l3_0], dtype=np.float64)
-                termB[idx2] += a0*fact0*(Jm0[idx_l3_0]*Jm2[idx_l3_2]*np.real(wEBlm_tmp[-2, :]*np.conj(wEBlm_tmp[0, :])))[idx2]
-                termB[idx1] += a1*fact1*(Jm0[idx_l3_0]*Jm1[idx_l3_1]*np.real(wEBlm_tmp[-1, :]*np.conj(wEBlm_tmp[0, :])))[idx1]
-
-                Mpol[l1+2*lmax+2, l2] = 2*np.sum(termE) - np.sum(termE[m0])
-                Mpol[l1+2*lmax+2, l2+lmax+1] = 2*np.sum(termB) - np.sum(termB[m0])
-
-            normfact = (2.0*l2+1.0) / (4.0*np.pi)
-            Mpol[l1, l2] *= normfact / 4.0
-            Mpol[l1+lmax+1, l2+lmax+1] *= normfact / 4.0
-            Mpol[l1, l2+lmax+1] *= normfact / 4.0
-            Mpol[l1+lmax+1, l2] *= normfact / 4.0
-            Mpol[l1+2*lmax+2, l2+2*lmax+2] *= normfact / 4.0
-            Mpol[l1, l2+2*lmax+2] *= normfact / 2.0
-            Mpol[l1+lmax+1, l2+2*lmax+2] *= -normfact / 2.0
-            Mpol[l1+2*lmax+2, l2] *= -normfact / 4.0
-            Mpol[l1+2*lmax+2, l2+lmax+1] *= normfact / 4.0
-
-    Mpol = comm.allreduce(Mpol)
-
-    return Mpol
-
-
-def _calc_Mcross(comm, wEBlm, lmax=None, cl_type='pseudo', verbose=True):
-    '''Calculate the temp-pol mode-mixing matrix.
+                Jp1, Jm1, Jp2, Jm2 = None, None, None, None
+
+            Jpm = (Jp0, Jm0, Jp1, Jm1, Jp2, Jm2)
+
+            if pol:
+                _fill_Mpol(Mpol, l1, l2, lmax, cl_type, fact0, fact1, Jpm,
+                           Cl3)
+
+            if cross:
+                _fill_Mcross(Mcross, l1, l2, lmax, cl_type, fact0, fact1,
+                             _l3_slab(JT_rows[block], 0, width), Jpm, Cl3)
+
+    return l1_done
+
+
+def _report_rows(l1_vals, l1_done, done_callback):
+    '''Yields the l1 in l1_vals to the loop of _fill_rows and adds each of
+    them to l1_done, and calls done_callback with it, when the loop asks for
+    the next one, which is when its row is finished
+    '''
+
+    for l1 in l1_vals:
+        yield l1
+
+        l1_done.append(l1)
+        if done_callback is not None:
+            done_callback(l1)
+
+
+def _thread_fill_rows(Mall, l1_vals, row_args, nthreads, done_callback=None):
+    '''Fills the rows l1 in l1_vals of the matrices in Mall with nthreads
+    threads, that take the rows one at a time and write to disjoint rows of
+    the shared matrices. Returns the l1 that were filled.
+
+    Most of the work of the kernels is in NumPy operations on whole slabs of
+    (l2, l3) or batches of Wigner 3j families, which release the GIL.
+    '''
+
+    l1_iter = iter(l1_vals)
+    lock = threading.Lock()
+
+    def _next_rows():
+        while True:
+            with lock:
+                l1 = next(l1_iter, None)
+            if l1 is None:
+                return
+            yield l1
+
+    with futures.ThreadPoolExecutor(nthreads) as executor:
+        tasks = [executor.submit(_fill_rows, Mall, _next_rows(), *row_args,
+                                 done_callback=done_callback)
+                 for i in range(nthreads)]
+
+        return [l1 for task in tasks for l1 in task.result()]
+
+
+def _pool_fill_rows(executor, Mall, row_args, costs, l1_skip=(),
+                    done_callback=None, nthreads=1):
+    '''Fills the matrices in Mall by sending chunks of rows l1, most
+    expensive first, to executor, or to a local process pool if executor is
+    None. The rows in l1_skip are left out, and done_callback is called with
+    each l1 when its row has been filled, if it is given. Each worker fills
+    the rows of a chunk with nthreads threads.
+
+    Only the window power spectrum and cross-spectra are sent to the
+    workers, not the window alms. Each worker fills and returns just the
+    rows of its chunk (see _RowBuffer), which are scattered into Mall here,
+    so the full matrices only exist in this process.
+    '''
+
+    lmax = row_args[0]
+    flags = [M is not None for M in Mall]
+
+    rows = np.arange(2, lmax+1)[np.argsort(-costs, kind='stable')]
+    rows = rows[~np.isin(rows, list(l1_skip))]
+    chunk = max(nthreads, len(rows) // (16*(os.cpu_count() or 1)))
+
+    own_pool = executor is None
+    if own_pool:
+        executor = futures.ProcessPoolExecutor()
+
+    try:
+        tasks = [executor.submit(_pool_rows, rows[i:i+chunk], flags,
+                                 row_args, nthreads)
+                 for i in range(0, len(rows), chunk)]
+
+        for task in futures.as_completed(tasks):
+            l1_vals, Mrows = task.result()
+            for M, Mrow in zip([M for M in Mall if M is not None], Mrows):
+                M[_block_rows(M, l1_vals, lmax)] = Mrow
+
+            if done_callback is not None:
+                for l1 in l1_vals:
+                    done_callback(l1)
+    finally:
+        if own_pool:
+            executor.shutdown()
+
+
+def _pool_rows(l1_vals, flags, row_args, nthreads=1):
+    '''Calculates the rows l1 in l1_vals of the requested matrices (flags
+    for Mscal, Mpol, Mcross) in a pool worker and returns them, in the order
+    of _block_rows, with l1_vals
+    '''
+
+    lmax = row_args[0]
+    Mall = [_RowBuffer(lmax, nblocks, l1_vals) if flag else None
+            for flag, nblocks in zip(flags, (1, 3, 2))]
+
+    if nthreads > 1:
+        _thread_fill_rows(Mall, l1_vals, row_args, nthreads)
+    else:
+        _fill_rows(Mall, l1_vals, *row_args)
+
+    return l1_vals, [M.rows for M in Mall if M is not None]
+
+
+class _RowBuffer(object):
+    '''Stand-in for a matrix with nblocks x nblocks blocks of size lmax+1 in
+    _fill_rows, that only holds the rows l1 in l1_vals of every block row.
+    It is indexed with [row, columns] of the full matrix, for rows l1 in
+    l1_vals plus a multiple of lmax+1.
+
+    The rows are kept in the order of _block_rows(M, l1_vals, lmax).
+    '''
+
+    def __init__(self, lmax, nblocks, l1_vals):
+        self.lmax = lmax
+        self.nrows = len(l1_vals)
+        self.rows = np.zeros([nblocks*self.nrows, nblocks*(lmax+1)])
+
+        self._index = np.full(lmax+1, -1)
+        self._index[np.asarray(l1_vals, dtype=int)] = np.arange(self.nrows)
+
+    def _row(self, row):
+        block, l1 = divmod(row, self.lmax+1)
+        if self._index[l1] < 0:
+            raise IndexError("Row %d is not in the buffer" % row)
+        return block*self.nrows + self._index[l1]
+
+    def __getitem__(self, key):
+        row, cols = key
+        return self.rows[self._row(row), cols]
+
+    def __setitem__(self, key, value):
+        row, cols = key
+        self.rows[self._row(row), cols] = value
+
+
+def _block_rows(M, l1_vals, lmax):
+    '''Indices of the rows l1 in l1_vals in every block row of M
+    '''
+
+    nblocks = len(M) // (lmax+1)
+    return (np.asarray(l1_vals, dtype=int)[None, :] +
+            (lmax+1)*np.arange(nblocks)[:, None]).ravel()
+
+
+def _checkpoint_key(lmax, cl_type, Mall, symmetric, spectra, table):
+    '''Description of a mode-mixing matrix calculation that its checkpoints
+    are checked against before they are resumed
+    '''
+
+    digest = hashlib.sha1()
+    for spectrum in spectra:
+        if spectrum is not None:
+            digest.update(np.ascontiguousarray(spectrum).tobytes())
+
+    return {'lmax': int(lmax), 'cl_type': cl_type,
+            'matrices': [M is not None for M in Mall],
+            'symmetric': bool(symmetric), 'window': digest.hexdigest(),
+            'wigner': _wigner_key(table)}
+
+
+def _wigner_key(table):
+    '''Description of the source of the Wigner 3j symbols (None when they
+    are calculated exactly) for the keys of checkpoints and cached matrices
+    '''
+
+    if table is None:
+        return None
+
+    return [type(table).__name__, getattr(table, 'filename', None),
+            getattr(table, 'tol', None), getattr(table, 'lmin', None)]
+
+
+class _Checkpoint(object):
+    '''Checkpoints of the rows of the mode-mixing matrices that a rank has
+    finished
+
+    The rows are saved to files rank<rank>_<n>.npz in directory, at most
+    every interval seconds. Each rank lists its files, the l1 in each and
+    the key of the calculation in manifest_rank<rank>.json. The files and
+    the manifest are replaced atomically, so a checkpoint that is
+    interrupted while it is written is simply not there.
+
+    Parameters
+    ----------
+    directory : str
+        Checkpoint directory
+
+    rank : int
+        Rank of this process
+
+    key : dict
+        Description of the calculation (see _checkpoint_key)
+
+    Mall : list
+        Mscal, Mpol, Mcross, None for those that are not calculated
+
+    lmax : int
+        Maximum l of the matrices
+
+    interval : float
+        Minimum time in seconds between checkpoints
+    '''
+
+    def __init__(self, directory, rank, key, Mall, lmax, interval):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.rank = rank
+        self.key = key
+        self.Mout = [M for M in Mall if M is not None]
+        self.lmax = lmax
+        self.interval = interval
+
+        self.files = []
+        self.pending = []
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def resume(self, comm=None):
+        '''Loads the rows that are already in the checkpoint directory into
+        the matrices. Rank r reads the manifests of the ranks k with
+        k % size == r, and a row that more than one rank finds is only kept
+        by the lowest of them, so that every row is only loaded once.
+        Returns the set of l1 that were loaded on any rank and the list of
+        those loaded on this rank.
+        '''
+
+        size = 1 if comm is None else comm.Get_size()
+
+        found = {}
+        mismatch = False
+        for name in sorted(os.listdir(self.directory)):
+            match = re.match(r'manifest_rank(\d+)\.json$', name)
+            if match is None or int(match.group(1)) % size != self.rank:
+                continue
+
+            with open(os.path.join(self.directory, name)) as fin:
+                manifest = json.load(fin)
+
+            if manifest['key'] != self.key:
+                mismatch = True
+                break
+
+            if int(match.group(1)) == self.rank:
+                self.files = manifest['files']
+
+            for filename, l1_vals in manifest['files']:
+                for i, l1 in enumerate(l1_vals):
+                    found.setdefault(l1, (filename, i))
+
+        # All of the ranks raise the error together
+        if comm is not None:
+            mismatch = any(comm.allgather(mismatch))
+
+        if mismatch:
+            raise ValueError("The checkpoints in %s are of a different "
+                             "calculation" % self.directory)
+
+        l1_found = sorted(found)
+        l1_ranks = [l1_found] if comm is None else comm.allgather(l1_found)
+
+        owner = {}
+        for rank, l1_vals in enumerate(l1_ranks):
+            for l1 in l1_vals:
+                owner.setdefault(l1, rank)
+
+        l1_loaded = [l1 for l1 in l1_found if owner[l1] == self.rank]
+
+        for filename in set(found[l1][0] for l1 in l1_loaded):
+            with np.load(os.path.join(self.directory, filename)) as data:
+                for l1 in l1_loaded:
+                    if found[l1][0] != filename:
+                        continue
+                    for k, M in enumerate(self.Mout):
+                        M[_block_rows(M, [l1], self.lmax)] = \
+                            data['M%d' % k][found[l1][1]]
+
+        return set(owner), l1_loaded
+
+    def row_done(self, l1):
+        '''Records that the row of l1 is finished, and saves the finished
+        rows if the last checkpoint is older than the interval
+        '''
+
+        with self.lock:
+            self.pending.append(int(l1))
+            if time.time() - self.last >= self.interval:
+                self._save()
+
+    def flush(self):
+        '''Saves all of the finished rows that are not saved yet'''
+
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        '''Writes the pending rows to a new file and adds it to the
+        manifest'''
+
+        self.last = time.time()
+
+        if len(self.pending) == 0:
+            return
+
+        filename = 'rank%d_%d.npz' % (self.rank, len(self.files))
+        rows = {}
+        for k, M in enumerate(self.Mout):
+            rows['M%d' % k] = np.array([M[_block_rows(M, [l1], self.lmax)]
+                                        for l1 in self.pending])
+
+        path = os.path.join(self.directory, filename)
+        with open(path + '.tmp', 'wb') as fout:
+            np.savez(fout, l1=self.pending, **rows)
+        os.replace(path + '.tmp', path)
+
+        self.files.append([filename, self.pending])
+        self.pending = []
+
+        path = os.path.join(self.directory,
+                            'manifest_rank%d.json' % self.rank)
+        with open(path + '.tmp', 'w') as fout:
+            json.dump({'key': self.key, 'files': self.files}, fout)
+        os.replace(path + '.tmp', path)
+
+
+def _reduce_matrices(comm, Mout, l1_done, lmax, reduce):
+    '''Combines the matrices calculated by each rank for the rows l1 in
+    l1_done, in place, with buffer based MPI calls
+
+    If reduce is 'all' the matrices are summed on all ranks with Allreduce,
+    if it is 'root' they are only summed on rank 0 with Reduce, and if it is
+    'rows' only the rows of the l1 of each rank (l1 in every block row) are
+    sent to rank 0 with Gatherv. Returns whether this rank has the combined
+    matrices.
+    '''
+
+    from mpi4py import MPI
+
+    rank = comm.Get_rank()
+
+    if reduce == 'all':
+        for M in Mout:
+            comm.Allreduce(MPI.IN_PLACE, M, op=MPI.SUM)
+        return True
+
+    if reduce == 'root':
+        for M in Mout:
+            if rank == 0:
+                comm.Reduce(MPI.IN_PLACE, M, op=MPI.SUM, root=0)
+            else:
+                comm.Reduce(M, None, op=MPI.SUM, root=0)
+        return rank == 0
+
+    sendbuf = np.concatenate([M[_block_rows(M, l1_done, lmax)].ravel()
+                              for M in Mout])
+
+    l1_ranks = comm.gather(l1_done, root=0)
+
+    if rank != 0:
+        comm.Gatherv(sendbuf, None, root=0)
+        return False
+
+    counts = [sum(len(_block_rows(M, l1_vals, lmax))*M.shape[1]
+                  for M in Mout) for l1_vals in l1_ranks]
+    recvbuf = np.empty(sum(counts))
+    comm.Gatherv(sendbuf, [recvbuf, counts], root=0)
+
+    offset = 0
+    for l1_vals in l1_ranks:
+        for M in Mout:
+            rows = _block_rows(M, l1_vals, lmax)
+            M[rows] = recvbuf[offset:offset+len(rows)*M.shape[1]].reshape(
+                len(rows), M.shape[1])
+            offset += len(rows)*M.shape[1]
+
+    return True
+
+
+def _row_costs(lmax, half, overhead):
+    '''Model of the relative cost of the rows l1 = 2..lmax of the
+    mode-mixing matrices
+
+    The cost of each (l1, l2) is taken as the length of its Wigner 3j
+    families, 2*min(l1, l2)+1, plus a fixed overhead for the per-l2 work
+    of Mpol and Mcross. If half is True only l2 >= l1 is calculated.
+    '''
+
+    l1 = np.arange(2, lmax+1)[:, None]
+    l2 = np.arange(2, lmax+1)[None, :]
+
+    cost = 2*np.minimum(l1, l2) + 1 + overhead
+    if half:
+        cost = np.where(l2 >= l1, cost, 0)
+
+    return cost.sum(axis=1)
+
+
+def _l1_schedule(comm, lmax, schedule, costs):
+    '''The rows l1 that this rank calculates, given the modelled costs of
+    the rows l1 = 2..lmax
+
+    'cyclic' deals the rows out to the ranks in turn. 'static' assigns the
+    rows, most expensive first, to the rank with the smallest total cost so
+    far. 'dynamic' returns a generator of the rows this rank takes from a
+    shared counter, in chunks and most expensive first (see _dynamic_rows).
     '''
 
     rank = comm.Get_rank()
     size = comm.Get_size()
 
-    if lmax is None:
-        lmax = H.Alm.getlmax(len(wEBlm[0, :]))
-    
-    l, m = H.Alm.getlm(lmax)
+    l1_vals = np.arange(2, lmax+1)
+    order = np.argsort(-costs, kind='stable')
+
+    if schedule == 'cyclic':
+        return range(2+rank, lmax+1, size)
+    elif schedule == 'static':
+        load = np.zeros(size)
+        owner = np.zeros(len(l1_vals), dtype=int)
+        for i in order:
+            owner[i] = np.argmin(load)
+            load[owner[i]] += costs[i]
+        return l1_vals[owner == rank]
+    elif schedule == 'dynamic':
+        chunk = max(1, len(l1_vals) // (16*size))
+        return _dynamic_rows(comm, l1_vals[order], chunk)
+    else:
+        raise ValueError("Unknown schedule: " + str(schedule))
+
+
+def _dynamic_rows(comm, rows, chunk):
+    '''Yields the rows this rank takes, chunk at a time, from a counter in
+    an MPI window on rank 0 that is shared by all ranks, until all of the
+    rows are taken. All ranks must exhaust the generator since freeing the
+    window is collective, so this is not exception safe: _calc_Mall aborts
+    all of the ranks if one of them fails while it takes rows.
+    '''
+
+    from mpi4py import MPI
+
+    itemsize = np.dtype(np.int64).itemsize
+    win = MPI.Win.Allocate(itemsize if comm.Get_rank() == 0 else 0,
+                           itemsize, comm=comm)
+
+    start = np.zeros(1, dtype=np.int64)
+    step = np.array([chunk], dtype=np.int64)
+
+    if comm.Get_rank() == 0:
+        win.Lock(0)
+        win.Put(start, 0)
+        win.Unlock(0)
+    comm.Barrier()
+
+    try:
+        while True:
+            win.Lock(0, MPI.LOCK_SHARED)
+            win.Fetch_and_op(step, start, 0, 0, MPI.SUM)
+            win.Unlock(0)
+
+            if start[0] >= len(rows):
+                break
+
+            for l1 in rows[start[0]:start[0]+chunk]:
+                yield int(l1)
+    finally:
+        win.Free()
+
+
+def _mirror_blocks(M, lmax):
+    '''Fills the l2 < l1 half of every (lmax+1, lmax+1) block of M from the
+    l2 > l1 half, assuming M[l1, l2] / (2*l2+1) is symmetric in each block
+    '''
+
+    ells = np.arange(lmax+1)
+    iu1, iu2 = np.triu_indices(lmax+1, 1)
+    ratio = (2.0*ells[iu1]+1.0) / (2.0*ells[iu2]+1.0)
+
+    nblocks = len(M) // (lmax+1)
+    for i in range(nblocks):
+        for j in range(nblocks):
+            block = M[i*(lmax+1):(i+1)*(lmax+1), j*(lmax+1):(j+1)*(lmax+1)]
+            block[iu2, iu1] = block[iu1, iu2] * ratio
+
+
+def _window_spectra(wEBlm, lmax, cross_spectra=True):
+    '''The power spectrum of the scalar window alms and, if cross_spectra is
+    True, the cross-spectra of all of the window alm components (see
+    _window_cross_spectra), which are all that the kernels need of the
+    window. Otherwise the cross-spectra are None.
+    '''
 
-    Mcross = np.zeros([2*lmax+2, 2*lmax+2])
+    wl = H.alm2cl(wEBlm[0, :])
+
+    if cross_spectra:
+        Cw = _window_cross_spectra(wEBlm, lmax)
+    else:
+        Cw = None
+
+    return wl, Cw
+
+
+def _bcast_window_spectra(comm, window, lmax, cross_spectra=True,
+                          harmonic=False):
+    '''Calculates the window alms (see _get_wEBlm) and their spectra (see
+    _window_spectra) on rank 0 only and broadcasts the spectra to the other
+    ranks, so that the spherical harmonic transforms of the window are only
+    done once
+    '''
+
+    if comm.Get_rank() == 0:
+        wEBlm = _get_wEBlm(window, lmax=lmax, harmonic=harmonic)
+        wl, Cw = _window_spectra(wEBlm, lmax, cross_spectra)
+    else:
+        # There are 5 window alm components, see _get_wEBlm
+        wl = np.empty(lmax+1)
+        Cw = np.empty([5, 5, lmax+1]) if cross_spectra else None
+
+    comm.Bcast(wl, root=0)
+
+    if cross_spectra:
+        comm.Bcast(Cw, root=0)
+
+    return wl, Cw
+
+
+def _window_cross_spectra(wEBlm, lmax):
+    '''Sums over m of the products of all pairs of window alm components
+    for every l, as a (5, 5, lmax+1) array
+
+    Notes
+    -----
+    Element [i, j, l] is sum_m Re(wEBlm[i, l, m] * conj(wEBlm[j, l, m]))
+    over m = -l..l, i.e. twice the sum over m > 0 plus the m = 0 term. The
+    component indices are the same as those of wEBlm, so that [0, -2] pairs
+    the scalar and the tensor B-type alms.
+    '''
+
+    # With the alms of each l contiguous, the sums over m for all of the
+    # pairs of components are one small matrix product per l. The m = 0
+    # alm, which only counts once, is the first of each slice.
+    ncomp = len(wEBlm)
+    walm, offsets = H_ext.alm2lmajor(np.concatenate([wEBlm.real,
+                                                     wEBlm.imag]), lmax)
+
+    Cw = np.zeros([ncomp, ncomp, lmax+1])
+
+    for ell in range(lmax+1):
+        wslice = walm[:, offsets[ell]:offsets[ell+1]]
+        prod = 2*np.dot(wslice, wslice.T) - np.outer(wslice[:, 0],
+                                                     wslice[:, 0])
+        Cw[:, :, ell] = prod[:ncomp, :ncomp] + prod[ncomp:, ncomp:]
+
+    return Cw
+
+
+# Number of (l2, l3) elements in each block of l2 that the Mpol and Mcross
+# kernels work on at once
+_L2_BLOCK_SIZE = 2**15
+
+
+def _l2_block(l1, lmax):
+    '''Number of l2 in each block of the Mpol and Mcross kernels for row l1
+    '''
+
+    return max(1, _L2_BLOCK_SIZE // (2*min(l1, lmax) + 1))
+
+
+def _l3_slab(families, offsets, width):
+    '''Places Wigner 3j families, one per l2, that start offsets values above
+    l3min on rows of a (len(families), width) slab, each on the grid
+    l3min..l3min+width-1 of its l2, with zeros outside of the families
+    '''
+
+    offsets = np.broadcast_to(offsets, (len(families), ))
+
+    slab = np.zeros([len(families), width])
+    for i, (J, offset) in enumerate(zip(families, offsets)):
+        n = max(min(len(J), width-offset), 0)
+        slab[i, offset:offset+n] = J[:n]
+
+    return slab
+
+
+def _quad(Cl3, terms):
+    '''Sum over l3 and m of |sum_i A_i(l3) wEBlm[i, l3, m]|**2 for the
+    (i, A_i) in terms, from the window cross-spectra over l3 (the last axis)
+    '''
+
+    total = 0.0
+    for i, Ai in terms:
+        for j, Aj in terms:
+            total += np.sum(Ai*Aj*Cl3[i, j], axis=-1)
+
+    return total
+
+
+def _fill_Mscal_row(Mscal, l1, l2_vals, lmax, wl, JT_rows):
+    '''Fills the (l1, l2) elements of the temperature/V polarization
+    mode-mixing matrix for all l2 in l2_vals at once
+
+    The squared m = 0 families are scattered into a dense (l2, l3) slab over
+    l3 = 0..lmax, which is contracted with (2*l3+1)*wl in a single
+    matrix-vector product.
+    '''
+
+    l2_vals = np.asarray(l2_vals)
+
+    nj = np.array([len(JT) for JT in JT_rows])
+    start = np.cumsum(nj) - nj
+
+    rows = np.repeat(np.arange(len(l2_vals)), nj)
+    l3vals = (np.repeat(np.abs(l1-l2_vals), nj) +
+              np.arange(nj.sum()) - np.repeat(start, nj))
+
+    # Since we only have wl up to lmax we must ignore all terms that
+    # have l3 > lmax
+    idx = l3vals <= lmax
+
+    slab = np.zeros([len(l2_vals), lmax+1])
+    slab[rows[idx], l3vals[idx]] = np.concatenate(JT_rows)[idx]**2
+
+    ells = np.arange(lmax+1)
+    normfact = (2.0*l2_vals+1.0) / (4.0*np.pi)
+
+    Mscal[l1, l2_vals] = slab.dot((2*ells+1)*wl[:lmax+1]) * normfact
+
+
+def _fill_Mpol(Mpol, l1, l2, lmax, cl_type, fact0, fact1, Jpm, Cl3):
+    '''Fills the (l1, l2) elements of the polarization mode-mixing matrix
+    for an array of l2 from the (Jp, Jm) of the m=0,1,2 families and the
+    window cross-spectra, all as (l2, l3) slabs on the same l3 grids
+    '''
 
     a0 = 1.0
     a1 = 2.0
     a2 = 1.0
 
-    l1_vals = range(2+rank, lmax+1, size)
+    Jp0, Jm0, Jp1, Jm1, Jp2, Jm2 = Jpm
+    C = Cl3
 
-    # Don't need to calculate this if we are looking at pseudo Cls, but it
-    # is not the bottleneck in the calculation so I don't care
-    Nl12 = H_ext._nfunc(l1_vals, 2)
-    Nl11 = H_ext._nfunc(l1_vals, 1)
-    Nl10 = H_ext._nfunc(l1_vals, 0)
-    fact0s = Nl10 / Nl12
-    fact1s = Nl11 / Nl12
+    # EE,EE and BB,BB (2/9)
+    termE = [(0, a2*Jp0)]
+    termB = []
 
-    for l1, fact0, fact1 in zip(l1_vals, fact0s, fact1s):
-        if verbose:
-            print("Cross l1 = ", l1)
+    if cl_type == 'pseudo' or cl_type == 'hybrid':
+        Mpol[l1, l2] = _quad(C, termE)
 
-        for l2 in range(2, lmax+1):
-            l3min = np.abs(l1-l2)
-            l3max = np.abs(l1+l2)
+    if cl_type == 'pure' or cl_type == 'hybrid':
+        termE += [(1, a1*fact1*Jp1), (2, a0*fact0*Jp2)]
+        termB += [(-1, a1*fact1*Jm1), (-2, a0*fact0*Jm2)]
 
-            # Minimum l3 for case when m3=1,2
-            l3min2 = np.max([l3min, 2])
-            l3min1 = np.max([l3min, 1])
+    Mpol[l1+lmax+1, l2+lmax+1] = _quad(C, termE) + _quad(C, termB)
 
-            wc_0 = wc.wigner3j_vect(2*l1, 2*l2, -2*2, 2*2)
-            wc_1 = wc.wigner3j_vect(2*l1, 2*l2, 2*2, -2*2)
-            Jp0 = wc_0 + wc_1
-#           Jm0 = wc_0 - wc_1
-            JT = wc.wigner3j_vect(2*l1, 2*l2, 0, 0)
+    if cl_type == 'pure':
+        Mpol[l1, l2] = Mpol[l1+lmax+1, l2+lmax+1]
 
-            if cl_type == 'pure' or cl_type == 'hybrid':
-                wc_0 = wc.wigner3j_vect(2*l1, 2*l2, (-2+1)*2, 2*2)
-                wc_1 = wc.wigner3j_vect(2*l1, 2*l2, (2-1)*2, -2*2)
-                Jp1 = wc_0 + wc_1
-#               Jm1 = wc_0 - wc_1
+    # EE,BB and BB,EE (4/9)
+    termE = [(0, a2*Jm0)]
+    termB = []
 
-                wc_0 = wc.wigner3j_vect(2*l1, 2*l2, (-2+2)*2, 2*2)
-                wc_1 = wc.wigner3j_vect(2*l1, 2*l2, (2-2)*2, -2*2)
-                Jp2 = wc_0 + wc_1
-#               Jm2 = wc_0 - wc_1
+    if cl_type == 'pseudo' or cl_type == 'hybrid':
+        Mpol[l1, l2+lmax+1] = _quad(C, termE)
 
-            idx = np.all([l >= l3min, l <= l3max], axis=0)
-            l_tmp = l[idx]
-            m_tmp = m[idx]
-            m0 = m_tmp == 0
+    if cl_type == 'pseudo':
+        Mpol[l1+lmax+1, l2] = Mpol[l1, l2+lmax+1]
 
-            # sub array of wEBlm that have valid l (for l = l3)
-            wEBlm_tmp = wEBlm[:, idx]
+    if cl_type == 'pure' or cl_type == 'hybrid':
+        termE += [(1, a1*fact1*Jm1), (2, a0*fact0*Jm2)]
+        termB += [(-1, a1*fact1*Jp1), (-2, a0*fact0*Jp2)]
 
-            idx_l3_0 = np.array(l_tmp - l3min, dtype=int)  # Jp0,Jm0
-            idx_l3_1 = np.array(l_tmp - l3min1, dtype=int)  # Jp1,Jm1
-            idx_l3_2 = np.array(l_tmp - l3min2, dtype=int)  # Jp2,Jm2
+        Mpol[l1+lmax+1, l2] = _quad(C, termE) + _quad(C, termB)
 
-            # Subsets of the subset. When l3min is 0 or 1 and take the whole
-            # range, Jp1(Jm1) and/or Jp2(Jm2) get non-zero values when
-            # they should be zero (when l3 = 0 or 1) because negative indices
-            # in idx_l3_1 and idx_l3_2 wrap around to the end
-            idx1 = l_tmp >= l3min1
-            idx2 = l_tmp >= l3min2
+    if cl_type == 'pure':
+        Mpol[l1, l2+lmax+1] = Mpol[l1+lmax+1, l2]
+
+    # EB,EB (5/9)
+    if cl_type == 'pseudo' or cl_type == 'pure':
+        # EE,EE - EE,BB
+        Mpol[l1+2*lmax+2, l2+2*lmax+2] = Mpol[l1, l2] - Mpol[l1, l2+lmax+1]
+    else:
+        termE = a0*fact0*(Jp0*Jp2 - Jm0*Jm2)*C[0, 2]
+        termE += a1*fact1*(Jp0*Jp1 - Jm0*Jm1)*C[0, 1]
+        termE += a2*(Jp0*Jp0 - Jm0*Jm0)*C[0, 0]
+        Mpol[l1+2*lmax+2, l2+2*lmax+2] = np.sum(termE, axis=-1)
+
+    # EE,EB and BB,EB (7/9)
+    if cl_type == 'pure' or cl_type == 'hybrid':
+        # only non-zero for pure (and B is pure in hybrid).
+        termE = a0*a0*fact0*fact0*(Jp2*Jp2 - Jm2*Jm2)*C[2, -2]
+        termE += a0*a1*fact0*fact1*(Jp2*Jp1*C[2, -1] - Jm2*Jm1*C[-2, 1])
+        termE += a0*a2*fact0*(-Jm2*Jm0*C[-2, 0])
+        termE += a1*a0*fact1*fact0*(Jp1*Jp2*C[1, -2] - Jm1*Jm2*C[-1, 2])
+        termE += a1*a1*fact1*fact1*(Jp1*Jp1 - Jm1*Jm1)*C[1, -1]
+        termE += a1*a2*fact1*(-Jm1*Jm0*C[-1, 0])
+        termE += a2*a0*fact0*(Jp0*Jp2*C[0, -2])
+        termE += a2*a1*fact1*(Jp0*Jp1*C[0, -1])
+
+        Mpol[l1+lmax+1, l2+2*lmax+2] = np.sum(termE, axis=-1)
+
+    if cl_type == 'pure':
+        Mpol[l1, l2+2*lmax+2] = Mpol[l1+lmax+1, l2+2*lmax+2]
+
+    # EB,EE and EB,BB (9/9)
+    if cl_type == 'pure':
+        Mpol[l1+2*lmax+2, l2] = Mpol[l1, l2+2*lmax+2]
+        Mpol[l1+2*lmax+2, l2+lmax+1] = Mpol[l1, l2+2*lmax+2]
+    elif cl_type == 'hybrid':
+        termE = a0*fact0*Jp0*Jp2*C[0, -2] + a1*fact1*Jp0*Jp1*C[0, -1]
+        termB = a0*fact0*Jm0*Jm2*C[-2, 0] + a1*fact1*Jm0*Jm1*C[-1, 0]
+
+        Mpol[l1+2*lmax+2, l2] = np.sum(termE, axis=-1)
+        Mpol[l1+2*lmax+2, l2+lmax+1] = np.sum(termB, axis=-1)
+
+    normfact = (2.0*l2+1.0) / (4.0*np.pi)
+    Mpol[l1, l2] *= normfact / 4.0
+    Mpol[l1+lmax+1, l2+lmax+1] *= normfact / 4.0
+    Mpol[l1, l2+lmax+1] *= normfact / 4.0
+    Mpol[l1+lmax+1, l2] *= normfact / 4.0
+    Mpol[l1+2*lmax+2, l2+2*lmax+2] *= normfact / 4.0
+    Mpol[l1, l2+2*lmax+2] *= normfact / 2.0
+    Mpol[l1+lmax+1, l2+2*lmax+2] *= -normfact / 2.0
+    Mpol[l1+2*lmax+2, l2] *= -normfact / 4.0
+    Mpol[l1+2*lmax+2, l2+lmax+1] *= normfact / 4.0
+
+
+def _fill_Mcross(Mcross, l1, l2, lmax, cl_type, fact0, fact1, JT, Jpm,
+                 Cl3):
+    '''Fills the (l1, l2) elements of the temp-pol mode-mixing matrix for an
+    array of l2 from the m=0 family, the Jp of the m=0,1,2 families and the
+    window cross-spectra, all as (l2, l3) slabs on the same l3 grids
+    '''
 
-            # TE,TE, and TB,TB (2/4)
-            termE = a2 * JT[idx_l3_0]*Jp0[idx_l3_0] * np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[0, :]))
+    a0 = 1.0
+    a1 = 2.0
+    a2 = 1.0
 
-            if cl_type == 'hybrid' or cl_type == 'pseudo':
-                Mcross[l1, l2] = 2*np.sum(termE) - np.sum(termE[m0])
+    Jp0, Jm0, Jp1, Jm1, Jp2, Jm2 = Jpm
+    C = Cl3
 
-            if cl_type == 'pure' or cl_type == 'hybrid':
-                termE[idx1] += a1*fact1 * (JT[idx_l3_0]*Jp1[idx_l3_1] * np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[1, :])))[idx1]
-                termE[idx2] += a0*fact0 * (JT[idx_l3_0]*Jp2[idx_l3_2] * np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[2, :])))[idx2]
+    # TE,TE, and TB,TB (2/4)
+    termE = a2*JT*Jp0*C[0, 0]
 
-            Mcross[l1+lmax+1, l2+lmax+1] = 2*np.sum(termE) - np.sum(termE[m0])
+    if cl_type == 'hybrid' or cl_type == 'pseudo':
+        Mcross[l1, l2] = np.sum(termE, axis=-1)
 
-            if cl_type == 'pure':
-                Mcross[l1, l2] = Mcross[l1+lmax+1, l2+lmax+1]
+    if cl_type == 'pure' or cl_type == 'hybrid':
+        termE = termE + a1*fact1*JT*Jp1*C[0, 1] + a0*fact0*JT*Jp2*C[0, 2]
 
-            # TE,TB and TB,TE (4/4)
-            if cl_type == 'pure' or cl_type == 'hybrid':
-                termE = np.zeros_like(JT[idx_l3_0], dtype=np.float64)
-                termE[idx1] += a1*fact1 * (JT[idx_l3_0]*Jp1[idx_l3_1] * np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[-1, :])))[idx1]
-                termE[idx2] += a0*fact0 * (JT[idx_l3_0]*Jp2[idx_l3_2] * np.real(wEBlm_tmp[0, :]*np.conj(wEBlm_tmp[-2, :])))[idx2]
-                Mcross[l1+lmax+1, l2] = 2*np.sum(termE) - np.sum(termE[m0])
+    Mcross[l1+lmax+1, l2+lmax+1] = np.sum(termE, axis=-1)
 
-            if cl_type == 'pure':
-                Mcross[l1, l2+lmax+1] = Mcross[l1+lmax+1, l2]
+    if cl_type == 'pure':
+        Mcross[l1, l2] = Mcross[l1+lmax+1, l2+lmax+1]
 
-            normfact = (2.0*l2+1.0) / (4.0*np.pi)
+    # TE,TB and TB,TE (4/4)
+    if cl_type == 'pure' or cl_type == 'hybrid':
+        termE = a1*fact1*JT*Jp1*C[0, -1] + a0*fact0*JT*Jp2*C[0, -2]
+        Mcross[l1+lmax+1, l2] = np.sum(termE, axis=-1)
 
-            Mcross[l1, l2] *= normfact / 2.0
-            Mcross[l1+lmax+1, l2+lmax+1] *= normfact / 2.0
-            Mcross[l1, l2+lmax+1] *= normfact / 2.0
-            Mcross[l1+lmax+1, l2] *= -normfact / 2.0
+    if cl_type == 'pure':
+        Mcross[l1, l2+lmax+1] = Mcross[l1+lmax+1, l2]
 
-    Mcross = comm.allreduce(Mcross)
+    normfact = (2.0*l2+1.0) / (4.0*np.pi)
 
-    return Mcross
+    Mcross[l1, l2] *= normfact / 2.0
+    Mcross[l1+lmax+1, l2+lmax+1] *= normfact / 2.0
+    Mcross[l1, l2+lmax+1] *= normfact / 2.0
+    Mcross[l1+lmax+1, l2] *= -normfact / 2.0
@@ -7,14 +7,21 @@
 of the PolSpice code by Challinor, Chon, Colombi, Hivon, Prunet, and Szapudi
 to Python.'''
 
+import os
+from concurrent import futures
+
 import numpy as np
 import healpy as H
 import scipy.special
-from mpi4py import MPI
 
 import cmb_analysis.util.wignercoupling as wc
 
-comm = MPI.COMM_WORLD
+try:
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+except ImportError:
+    MPI = None
+    comm = None
 
 def spice(map1, map2=None, window=None, mask=None, window2=None, mask2=None,
           apodizesigma=0.0, apodizetype=0, thetamax=180.0, decouple=False,
@@ -591,7 +598,7 @@ def get_xi_from_cl(cls, thetas=None, return_leggauss=False, thetamax=180.0):
     else:
         return thetas, xi
 
-def _correct_TE(apfunction, x, w):
+def _correct_TE(apfunction, x, w, comm=comm):
     '''Calculate an amplitude correction of the TE cross-correlation
     due to the apodization of the correlation function.
 
@@ -607,6 +614,12 @@ def _correct_TE(apfunction, x, w):
     w : array
         the weights needed for the Legendre-Gauss quadrature
 
+    comm : mpi4py.MPI.Intracomm, concurrent.futures.Executor, or None
+        MPI communicator to split the calculation over (COMM_WORLD by
+        default, if mpi4py is available). If an Executor is given the rows
+        are calculated in chunks by it instead, and if None by a local
+        process pool.
+
     Returns
     -------
     fact : array
@@ -615,7 +628,6 @@ def _correct_TE(apfunction, x, w):
     '''
 
     nell = len(apfunction)
-    lmax = nell - 1
 
     #Calculate f_l from apodizing function in real space
     fl = np.zeros(nell)
@@ -623,18 +635,41 @@ def _correct_TE(apfunction, x, w):
         Pl0 = scipy.special.lpmv(0, i, x)
         fl[i] = np.sum(w*apfunction*Pl0)*2*np.pi * (2*i+1) / (4*np.pi)
 
-    kcross = np.zeros([nell, nell])
+    if comm is not None and not isinstance(comm, futures.Executor):
+        # Only the sums over l2 are needed, so those are summed over the
+        # ranks
+        fact = _kcross_sums(range(2+comm.rank, nell, comm.size), fl)
+        comm.Allreduce(MPI.IN_PLACE, fact, op=MPI.SUM)
+        return fact
+
+    nchunks = 4*(os.cpu_count() or 1)
+    chunks = [range(2+i, nell, nchunks) for i in range(nchunks)]
+
+    if comm is None:
+        with futures.ProcessPoolExecutor() as executor:
+            fact = sum(executor.map(_kcross_sums, chunks, [fl]*nchunks))
+    else:
+        fact = sum(comm.map(_kcross_sums, chunks, [fl]*nchunks))
+
+    return fact
+
+def _kcross_sums(l1_vals, fl):
+    '''Sums over l2 of the TE correction kernel, kcross[l1, l2], from the
+    elements with l1 in l1_vals and l2 >= l1 and their symmetric ones
+    '''
 
-    rank = comm.rank
-    size = comm.size
+    nell = len(fl)
+    lmax = nell - 1
 
-    for l1 in range(2+rank, nell, size):
+    fact = np.zeros(nell)
+
+    for l1 in l1_vals:
         for l2 in range(l1, nell):
             l3min = np.abs(l1-l2)
             l3max = np.abs(l1+l2)
 
             #runs from l3min to l3max
-            wigner00 = wc.wigner3j_vect(2*l1, 2*l2, 2*0, 2*0)
+            wigner00 = wc.wigner3j_000_vect(2*l1, 2*l2)
             wigner22 = wc.wigner3j_vect(2*l1, 2*l2, 2*2, -2*2)
 
             if l3max > lmax:
@@ -642,17 +677,12 @@ def _correct_TE(apfunction, x, w):
                 wigner00 = wigner00[:tmp]
                 wigner22 = wigner22[:tmp]
 
-            kcross[l1, l2] = np.sum(wigner00*wigner22*fl[l3min:l3max+1])
-            kcross[l2, l1] = kcross[l1, l2]
+            kcross = np.sum(wigner00*wigner22*fl[l3min:l3max+1])
 
-            kcross[l1, l2] *= 2*l2 + 1
+            fact[l1] += kcross * (2*l2 + 1)
 
             if l2 != l1:
-                kcross[l2, l1] *= 2*l1 + 1
-
-    kcross = comm.allreduce(kcross)
-
-    fact = np.sum(kcross, axis=1)
+                fact[l2] += kcross * (2*l1 + 1)
 
     return fact
 
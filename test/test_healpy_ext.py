@@ -26,7 +26,24 @@ class TestPureCl(unittest.TestCase):
         cls_pure = H_ext.pureanafast(testmap, window_scal, mask=mask, iter=0)
 
         np.testing.assert_almost_equal(cls_pure, cls_good)
-    
+
+
+class TestAlmLmajor(unittest.TestCase):
+
+    def test_alm2lmajor(self):
+
+        lmax = 12
+        alm = np.arange(H.Alm.getsize(lmax)) + 0.5j
+        alm_l, offsets = H_ext.alm2lmajor(np.array([alm, 2*alm]))
+
+        self.assertEqual(offsets[-1], len(alm))
+        np.testing.assert_array_equal(alm_l[1], 2*alm_l[0])
+
+        for ell in [0, 1, 7, lmax]:
+            idx = H.Alm.getidx(lmax, ell, np.arange(ell+1))
+            np.testing.assert_array_equal(
+                alm_l[0, offsets[ell]:offsets[ell+1]], alm[idx])
+
 
 if __name__ == '__main__':
     unittest.main()
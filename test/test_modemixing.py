@@ -7,7 +7,11 @@ These matrices have also been tested by comparing plots of expected Cls
 pseudo/pure/hybrid Cls) and not seeing a bias.
 '''
 
+import json
+import os
+import tempfile
 import unittest
+from concurrent import futures
 
 import numpy as np
 import pylab as pl
@@ -186,6 +190,258 @@ class TestModeMixing(unittest.TestCase):
         np.testing.assert_almost_equal(mm_cross[42, 59], 0.0)
         np.testing.assert_almost_equal(mm_cross[89, 78], 7.85910067304e-05)
 
+    def test_fused(self):
+        mm_all = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                    verbose=False)
+        mm_pol = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                    scal=False, cross=False, verbose=False)[0]
+        mm_cross = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                      scal=False, pol=False, verbose=False)[0]
+
+        self.assertEqual(len(mm_all), 3)
+        np.testing.assert_array_equal(mm_all[1], mm_pol)
+        np.testing.assert_array_equal(mm_all[2], mm_cross)
+
+    def test_window_cross_spectra(self):
+        lmax = 3*16 - 1
+        wEBlm = mm._get_wEBlm(window_scal, lmax=lmax)
+        Cw = mm._window_cross_spectra(wEBlm, lmax)
+        ell = np.arange(lmax+1)
+
+        np.testing.assert_almost_equal(Cw[0, 0] / (2*ell+1),
+                                       H.alm2cl(wEBlm[0]))
+        np.testing.assert_almost_equal(Cw[2, -2] / (2*ell+1),
+                                       H.alm2cl(wEBlm[2], wEBlm[-2]))
+        np.testing.assert_array_equal(Cw[1, -1], Cw[-1, 1])
+
+    def test_harmonic_window(self):
+        lmax = 3*16 - 1
+        wEBlm = mm._get_wEBlm(window_scal, lmax=lmax)
+        wEBlm_harm = mm._get_wEBlm(window_scal, lmax=lmax, harmonic=True)
+
+        np.testing.assert_array_equal(wEBlm_harm[0], wEBlm[0])
+        np.testing.assert_array_equal(wEBlm_harm[-1], 0.0)
+        np.testing.assert_array_equal(wEBlm_harm[-2], 0.0)
+
+        # Without the masking the spin windows follow from the scalar one
+        ell = H.Alm.getlm(lmax)[0]
+        np.testing.assert_allclose(wEBlm_harm[2],
+                                   H_ext._nfunc(ell, 2)*wEBlm[0])
+
+    def test_bcast_window_spectra(self):
+        lmax = 3*16 - 1
+        wEBlm = mm._get_wEBlm(window_scal, lmax=lmax)
+        wl, Cw = mm._window_spectra(wEBlm, lmax)
+        wl_bcast, Cw_bcast = mm._bcast_window_spectra(comm, window_scal, lmax)
+
+        np.testing.assert_array_equal(wl_bcast, wl)
+        np.testing.assert_array_equal(Cw_bcast, Cw)
+        self.assertIsNone(mm._bcast_window_spectra(comm, window_scal, lmax,
+                                                   False)[1])
+
+    def test_symmetric(self):
+        for cl_type in ['pseudo', 'hybrid']:
+            mm_half = mm.calc_modemixing(comm, window_scal, cl_type=cl_type,
+                                         verbose=False, symmetric=True)
+            mm_full = mm.calc_modemixing(comm, window_scal, cl_type=cl_type,
+                                         verbose=False, symmetric=False)
+
+            for M_half, M_full in zip(mm_half, mm_full):
+                np.testing.assert_allclose(M_half, M_full, rtol=1e-12,
+                                           atol=1e-15)
+
+    def test_schedule(self):
+        mm_cyclic = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                       verbose=False)
+
+        for schedule in ['static', 'dynamic']:
+            mm_sched = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                          verbose=False, schedule=schedule)
+            for M_sched, M_cyclic in zip(mm_sched, mm_cyclic):
+                np.testing.assert_array_equal(M_sched, M_cyclic)
+
+        with self.assertRaises(ValueError):
+            mm.calc_modemixing(comm, window_scal, verbose=False,
+                               schedule='random')
+
+    def test_reduce(self):
+        mm_all = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                    verbose=False)
+
+        for reduce in ['root', 'rows']:
+            mm_red = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                        verbose=False, reduce=reduce)
+            for M_red, M_all in zip(mm_red, mm_all):
+                if rank == 0:
+                    np.testing.assert_array_equal(M_red, M_all)
+                else:
+                    self.assertIsNone(M_red)
+
+    def test_pool(self):
+        mm_mpi = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                    verbose=False)
+        mm_pool = mm.calc_modemixing(None, window_scal, cl_type='hybrid',
+                                     verbose=False)
+
+        with futures.ThreadPoolExecutor(2) as executor:
+            mm_exec = mm.calc_modemixing(executor, window_scal,
+                                         cl_type='hybrid', verbose=False,
+                                         nthreads=2)
+
+        for M_mpi, M_pool, M_exec in zip(mm_mpi, mm_pool, mm_exec):
+            np.testing.assert_array_equal(M_pool, M_mpi)
+            np.testing.assert_array_equal(M_exec, M_mpi)
+
+        # The workers only hold the rows of their chunk
+        lmax = len(mm_mpi[0]) - 1
+        l1_vals = np.array([7, 3, 20])
+        wEBlm = mm._get_wEBlm(window_scal, lmax=lmax)
+        row_args = ((lmax, 'hybrid', True) +
+                    tuple(mm._window_spectra(wEBlm, lmax, True)) +
+                    (None, False))
+        l1_out, Mrows = mm._pool_rows(l1_vals, [True, True, True], row_args)
+        for M_mpi, Mrow in zip(mm_mpi, Mrows):
+            rows = mm._block_rows(M_mpi, l1_vals, lmax)
+            self.assertEqual(Mrow.shape, (len(rows), len(M_mpi)))
+
+    def test_checkpoint(self):
+        mm_ref = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                    verbose=False)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mm_ckpt = mm.calc_modemixing(comm, window_scal, cl_type='hybrid',
+                                         verbose=False, checkpoint_dir=tmpdir,
+                                         checkpoint_interval=0.0)
+
+            # Forget the last checkpoints, as if the run was interrupted
+            manifest = os.path.join(tmpdir, 'manifest_rank%d.json' % rank)
+            with open(manifest) as fin:
+                saved = json.load(fin)
+            saved['files'] = saved['files'][:len(saved['files'])//2]
+            with open(manifest, 'w') as fout:
+                json.dump(saved, fout)
+
+            mm_resumed = mm.calc_modemixing(comm, window_scal,
+                                            cl_type='hybrid', verbose=False,
+                                            checkpoint_dir=tmpdir)
+
+            with self.assertRaises(ValueError):
+                mm.calc_modemixing(comm, window_scal, cl_type='pure',
+                                   verbose=False, checkpoint_dir=tmpdir)
+
+        for M_ref, M_ckpt, M_resumed in zip(mm_ref, mm_ckpt, mm_resumed):
+            np.testing.assert_array_equal(M_ckpt, M_ref)
+            np.testing.assert_array_equal(M_resumed, M_ref)
+
+    def test_cache(self):
+        mm_ref = mm.calc_modemixing(comm, window_scal, cl_type='pure',
+                                    verbose=False)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = mm.ModeMixingCache(tmpdir)
+            mm_stored = mm.calc_modemixing(comm, window_scal, cl_type='pure',
+                                           verbose=False, pol=False,
+                                           cache=cache)
+            mm_cached = mm.calc_modemixing(comm, window_scal, cl_type='pure',
+                                           verbose=False, cache=tmpdir)
+
+            self.assertIsInstance(mm_cached[0], np.memmap)
+            self.assertNotIsInstance(mm_cached[1], np.memmap)
+
+            # Only the most recently used matrix, Mpol, fits
+            filenames = os.listdir(tmpdir)
+            self.assertEqual(len(filenames), 3)
+            pol_file = [name for name in filenames
+                        if name.endswith('_pol.mmx')][0]
+            cache.maxbytes = os.path.getsize(os.path.join(tmpdir, pol_file))
+            cache.evict()
+            self.assertEqual(os.listdir(tmpdir), [pol_file])
+
+        np.testing.assert_array_equal(mm_stored[0], mm_ref[0])
+        np.testing.assert_array_equal(mm_stored[1], mm_ref[2])
+        for M_cached, M_ref in zip(mm_cached, mm_ref):
+            np.testing.assert_array_equal(M_cached, M_ref)
+
+    def test_cache_misses(self):
+        M = np.arange(16.0).reshape(4, 4)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = mm.ModeMixingCache(tmpdir)
+            cache.store('k', 'scal', M, 'pure')
+
+            np.testing.assert_array_equal(cache.load('k', 'scal', 'pure'), M)
+            self.assertIsNone(cache.load('k', 'scal', 'hybrid'))
+            self.assertIsNone(cache.load('k', 'pol'))
+
+            # Marking a matrix as used may fail on read-only file systems
+            def _read_only(path, times):
+                raise OSError("Read-only file system")
+
+            utime = mm.os.utime
+            try:
+                mm.os.utime = _read_only
+                np.testing.assert_array_equal(cache.load('k', 'scal'), M)
+            finally:
+                mm.os.utime = utime
+
+            path = os.path.join(tmpdir, 'k_scal.mmx')
+            with open(path, 'r+b') as fout:
+                fout.truncate(os.path.getsize(path) - 8)
+            self.assertIsNone(cache.load('k', 'scal'))
+
+            # A matrix that disappears before it is loaded is calculated
+            mm_ref = mm.calc_modemixing(comm, window_scal, verbose=False,
+                                        cache=cache)
+            load = cache.load
+            cache.load = lambda key, name, cl_type=None: (
+                None if name == 'pol' else load(key, name, cl_type))
+            mm_lost = mm.calc_modemixing(comm, window_scal, verbose=False,
+                                         cache=cache)
+
+        self.assertIsInstance(mm_lost[0], np.memmap)
+        self.assertNotIsInstance(mm_lost[1], np.memmap)
+        for M_lost, M_ref in zip(mm_lost, mm_ref):
+            np.testing.assert_array_equal(M_lost, M_ref)
+
+    def test_cache_key(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = mm.ModeMixingCache(tmpdir)
+            args = (window_scal, 47, 'pure', None, False)
+            key = cache.key(*args)
+            self.assertEqual(cache.key(*args), key)
+
+            window = window_scal.copy()
+            window[0] += 1e-10
+            for changed in [(window,) + args[1:],
+                            args[:1] + (46,) + args[2:],
+                            args[:2] + ('hybrid',) + args[3:],
+                            args[:3] + (mm._wigner_key(
+                                mm.wc.Wigner3jAsymptotic(1e-6)), False),
+                            args[:4] + (True,)]:
+                self.assertNotEqual(cache.key(*changed), key)
+
+            # A change to the code gives a new key
+            digest = mm._code_version()
+            try:
+                mm._code_digest = 'changed'
+                self.assertNotEqual(cache.key(*args), key)
+            finally:
+                mm._code_digest = digest
+
+    def test_uncached_families(self):
+        info = mm.wc.default_cache.info()
+        mm.calc_modemixing(comm, window_scal, cl_type='pure', verbose=False)
+        self.assertEqual(mm.wc.default_cache.info(), info)
+
+    def test_threads(self):
+        mm_one = mm.calc_modemixing(comm, window_scal, cl_type='pure',
+                                    verbose=False)
+        mm_threads = mm.calc_modemixing(comm, window_scal, cl_type='pure',
+                                        verbose=False, nthreads=3)
+
+        for M_threads, M_one in zip(mm_threads, mm_one):
+            np.testing.assert_array_equal(M_threads, M_one)
+
 if __name__ == '__main__':
     unittest.main()
 
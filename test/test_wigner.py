@@ -1,3 +1,6 @@
+import os
+import pickle
+import tempfile
 import unittest
 
 import numpy as np
@@ -41,6 +44,321 @@ class TestWigner3j(unittest.TestCase):
     def test_racahv(self):
         pass
 
+    def test_gaunt(self):
+        self.assertAlmostEqual(wc.gaunt(2, 1, 1, 0, 0, 0), 0.252313252202016)
+        self.assertAlmostEqual(wc.gaunt(3, 2, 1, -1, 0, 1),
+                               -0.2023006594034206)
+
+    def test_racah_formula(self):
+        np.testing.assert_almost_equal(
+            wc.wigner3j_racah([2*4, 5, 10, 3], [2*5, 3, 12, 9], [2*3, 4, 8, 6],
+                              [2*2, 1, 2, 1], [-2*2, 1, -4, 3],
+                              [0, -2, 2, -4]),
+            [0.0215917, -0.243975, np.sqrt(143)/429, 0.146385], decimal=6)
+        np.testing.assert_almost_equal(
+            wc.wigner3j_racah(2, 2, [0, 2, 6], 0, 0, 0),
+            [-np.sqrt(1.0/3.0), 0, 0])
+        j3 = np.arange(7, 34)
+        np.testing.assert_almost_equal(wc.wigner3j_racah(2*20, 2*13, 2*j3, 4,
+                                                         -4, 0),
+                                       wc.wigner3j_vect(2*20, 2*13, 4, -4))
+
+    def test_racah_formula_highj(self):
+        # Reference values from exact rational arithmetic
+        np.testing.assert_allclose(
+            wc.wigner3j_racah([400, 4000, 600, 4000], [400, 4000, 500, 4000],
+                              [400, 4000, 240, 4002], [4, 0, 6, 0],
+                              [-4, 0, -2, 0], [0, 0, -4, 0]),
+            [-0.001512020008704059, 0.0003030548100976346,
+             0.0002336544676912562, 0], rtol=1e-10)
+        self.assertAlmostEqual(wc.wigner3j(4000, 4000, 4000, 0, 0, 0),
+                               0.0003030548100976346, places=14)
+
+        for l1, l2, m1, m2 in [(300, 250, 2, -4), (180, 420, 0, 0),
+                               (650, 600, -2, 3)]:
+            jmax, jmin, Nj = wc.get_jrange_3j(l1, l2, m1, m2)
+            j3 = np.arange(jmin, jmax+1)
+            family = wc.wigner3j_vect(2*l1, 2*l2, 2*m1, 2*m2)
+            np.testing.assert_allclose(
+                wc.wigner3j_racah(2*l1, 2*l2, 2*j3, 2*m1, 2*m2,
+                                  -2*(m1+m2)), family, rtol=0,
+                atol=1e-10*np.max(np.abs(family)))
+
+class TestWignerKernels(unittest.TestCase):
+
+    @unittest.skipIf(wc.JIT_BACKEND is None, "no JIT backend installed")
+    def test_jit(self):
+        for args in [(20, 30, -4, 4), (40, 40, 0, 0), (60, 20, -2, 4),
+                     (31, 9, 3, -1)]:
+            j1, j2, m1, m2 = [val/2.0 for val in args]
+            jmax, jmin, Nj = wc.get_jrange_3j(j1, j2, m1, m2)
+            jvals = np.arange(jmin, jmax+1)
+            Xjvect = wc._Xj3j(j1, j2, jvals, m1, m2, 0)
+            Yjvect = wc._Yj3j(j1, j2, jvals, m1, m2, 0)
+            Zjvect = wc._Zj3j(j1, j2, jvals, m1, m2, 0)
+            for kernel in [wc._spec_case_2_kernel, wc._spec_case_3_kernel,
+                           wc._norm_case_kernel]:
+                np.testing.assert_array_equal(
+                    kernel(Xjvect, Yjvect, Zjvect),
+                    kernel.py_func(Xjvect, Yjvect, Zjvect))
+            np.testing.assert_array_equal(
+                wc._spec_case_1_kernel(Xjvect, Zjvect),
+                wc._spec_case_1_kernel.py_func(Xjvect, Zjvect))
+
+class TestWigner3jBatch(unittest.TestCase):
+
+    def test_families(self):
+        l2 = np.arange(2, 40)
+        for tm1, tm2 in [(-4, 4), (4, -4), (-2, 4), (2, -4), (0, 4)]:
+            wigvals, jmin, Nj = wc.wigner3j_vect_batch(2*17, 2*l2, tm1, tm2)
+            for i in range(len(l2)):
+                np.testing.assert_almost_equal(
+                    wigvals[i, :Nj[i]],
+                    wc.wigner3j_vect(2*17, 2*l2[i], tm1, tm2))
+                self.assertTrue(np.all(wigvals[i, Nj[i]:] == 0))
+
+    def test_values(self):
+        wigvals, jmin, Nj = wc.wigner3j_vect_batch([6*2, 3, 2*4, 2*3],
+                                                   [4*2, 9, 2*5, 2*3],
+                                                   [0, 1, 2*2, 1*2],
+                                                   [0, 3, -2*2, -1*2])
+        np.testing.assert_array_equal(jmin, [2, 3, 1, 0])
+        self.assertAlmostEqual(wigvals[0, 0], np.sqrt(5.0/143.0))
+        self.assertAlmostEqual(wigvals[1, 0], 0.146385)
+        self.assertAlmostEqual(wigvals[2, 2], 0.0215917)
+        self.assertAlmostEqual(wigvals[3, 3], -0.1543033)
+
+    def test_highl(self):
+        # The values at jmax underflow for these, reference from sympy
+        self.assertAlmostEqual(wc.wigner3j(2*1442, 2*3558, 2*3787, 2*1440,
+                                           2*11, -2*1451),
+                               -0.0011743934485496357, places=12)
+        self.assertAlmostEqual(wc.wigner3j(2*1371, 2*2257, 2*2515, -2*1370,
+                                           2*176, 2*1194),
+                               0.0015830923323289022, places=12)
+
+        # Orthogonality over j3 for different m1 at l of a few 10^4
+        l1, l2 = 20000, 23000
+        wigvals, jmin, Nj = wc.wigner3j_vect_batch(2*l1, 2*l2,
+                                                   [2*5000, 2*5001],
+                                                   [-2*3000, -2*3001])
+        Nmin = min(Nj)
+        j3 = jmin[0] + np.arange(Nmin)
+        gram = np.dot(wigvals[:, :Nmin]*(2*j3+1), wigvals[:, :Nmin].T)
+        np.testing.assert_almost_equal(gram, np.eye(2), decimal=10)
+
+    def test_invalid(self):
+        wigvals, jmin, Nj = wc.wigner3j_vect_batch(4, [4, 3], [6, 0], 0)
+        np.testing.assert_array_equal(Nj, [0, 0])
+        self.assertTrue(np.all(wigvals == 0))
+
+class TestWigner3jM(unittest.TestCase):
+
+    def test_m_family(self):
+        for tj1, tj2, tj3, tm3 in [(4, 6, 8, 2), (20, 14, 10, -4), (7, 5, 4, 2),
+                                   (40, 40, 6, 6), (5, 3, 2, 0)]:
+            mmax, mmin, Nm = wc.get_mrange_3j(tj1/2.0, tj2/2.0, tm3/2.0)
+            family = wc.wigner3j_m_vect(tj1, tj2, tj3, tm3)
+            self.assertEqual(len(family), Nm)
+            for i in range(Nm):
+                tm1 = int(round(2*(mmin+i)))
+                np.testing.assert_almost_equal(
+                    family[i], wc.wigner3j_racah(tj1, tj2, tj3, tm1, -tm1-tm3,
+                                                 tm3))
+
+    def test_highl(self):
+        l1, l2, l3, m3 = 3000, 2500, 1200, 7
+        family = wc.wigner3j_m_vect(2*l1, 2*l2, 2*l3, 2*m3)
+        mmax, mmin, Nm = wc.get_mrange_3j(l1, l2, m3)
+        for m1 in [-2407, 0, 300]:
+            jmax, jmin, Nj = wc.get_jrange_3j(l1, l2, m1, -m1-m3)
+            np.testing.assert_almost_equal(
+                family[int(m1-mmin)]*1e4,
+                wc.wigner3j_vect(2*l1, 2*l2, 2*m1, -2*m1-2*m3)[int(l3-jmin)]*1e4)
+
+    def test_invalid(self):
+        self.assertEqual(wc.wigner3j_m_vect(4, 6, 12, 0), 0)
+        self.assertEqual(wc.wigner3j_m_vect(4, 6, 8, 10), 0)
+        WigVals, mmin, Nm = wc.wigner3j_m_vect_batch(20, [10, 14, 32], 10, 2)
+        np.testing.assert_array_equal(Nm, [11, 15, 0])
+
+class TestWigner3j000(unittest.TestCase):
+
+    def test_000(self):
+        np.testing.assert_almost_equal(wc.wigner3j_000_vect(6*2, 4*2)[0],
+                                       np.sqrt(5.0/143.0))
+        np.testing.assert_almost_equal(wc.wigner3j_000_vect(2, 2)[0],
+                                       -np.sqrt(1.0/3.0))
+        self.assertEqual(wc.wigner3j_000_vect(3, 8), 0)
+
+    def test_000_batch(self):
+        l2 = np.arange(0, 50)
+        for l1 in [0, 1, 13, 40]:
+            wigvals, jmin, Nj = wc.wigner3j_000_batch(2*l1, 2*l2)
+            wigvals_ref, jmin_ref, Nj_ref = wc.wigner3j_vect_batch(2*l1, 2*l2,
+                                                                   0, 0)
+            np.testing.assert_almost_equal(wigvals, wigvals_ref)
+            np.testing.assert_array_equal(jmin, jmin_ref)
+            np.testing.assert_array_equal(Nj, Nj_ref)
+
+class TestWigner3jPM(unittest.TestCase):
+
+    def test_pm(self):
+        for args in [(2*7, 2*12, -4, 4), (2*12, 2*7, -2, 4), (2*9, 2*9, 0, 4),
+                     (5, 9, 1, -3)]:
+            wc_0 = wc.wigner3j_vect(*args)
+            wc_1 = wc.wigner3j_vect(args[0], args[1], -args[2], -args[3])
+            Jp, Jm = wc.wigner3j_pm_vect(*args)
+            np.testing.assert_almost_equal(Jp, wc_0 + wc_1)
+            np.testing.assert_almost_equal(Jm, wc_0 - wc_1)
+
+    def test_pm_batch(self):
+        l2 = np.arange(2, 30)
+        Jp, Jm, jmin, Nj = wc.wigner3j_pm_vect_batch(2*11, 2*l2, -2, 4)
+        for i in range(len(l2)):
+            Jp_ref, Jm_ref = wc.wigner3j_pm_vect(2*11, 2*l2[i], -2, 4)
+            np.testing.assert_almost_equal(Jp[i, :Nj[i]], Jp_ref)
+            np.testing.assert_almost_equal(Jm[i, :Nj[i]], Jm_ref)
+
+        cache = wc.Wigner3jCache()
+        for i in range(2):
+            Jp_cached, Jm_cached, jmin_cached, Nj_cached = \
+                wc.wigner3j_pm_vect_batch(2*11, 2*l2, -2, 4, cache=cache)
+            np.testing.assert_array_equal(Jp_cached, Jp)
+            np.testing.assert_array_equal(Jm_cached, Jm)
+        self.assertEqual(cache.info()['hits'], len(l2))
+
+class TestWigner3jCache(unittest.TestCase):
+
+    def test_symmetries(self):
+        cache = wc.Wigner3jCache()
+        for args in [(20, 30, -4, 4), (30, 20, 4, -4), (20, 30, 4, -4),
+                     (30, 20, -4, 4), (21, 9, 3, -1), (9, 21, -1, 3)]:
+            np.testing.assert_almost_equal(wc.wigner3j_vect_cached(*args,
+                                                                   cache=cache),
+                                           wc.wigner3j_vect(*args))
+
+        info = cache.info()
+        self.assertEqual(info['misses'], 2)
+        self.assertEqual(info['hits'], 4)
+        self.assertEqual(info['nfamilies'], 2)
+
+    def test_batch(self):
+        cache = wc.Wigner3jCache()
+        l2 = np.arange(2, 30)
+        for tm1, tm2 in [(-4, 4), (4, -4)]:
+            wigvals, jmin, Nj = cache.batch(2*12, 2*l2, tm1, tm2)
+            wigvals_ref, jmin_ref, Nj_ref = wc.wigner3j_vect_batch(2*12, 2*l2,
+                                                                   tm1, tm2)
+            np.testing.assert_almost_equal(wigvals, wigvals_ref)
+            np.testing.assert_array_equal(Nj, Nj_ref)
+
+        self.assertEqual(cache.info()['hits'], len(l2))
+
+    def test_eviction(self):
+        cache = wc.Wigner3jCache(maxbytes=2000)
+        for l in range(2, 30):
+            cache.vect(2*l, 2*l, 0, 4)
+
+        info = cache.info()
+        self.assertTrue(info['nbytes'] <= 2000)
+        self.assertEqual(info['evictions'], 28 - info['nfamilies'])
+
+class TestWigner3jTable(unittest.TestCase):
+
+    def test_table(self):
+        lmax = 20
+        with tempfile.TemporaryDirectory() as tmpdir:
+            table = wc.build_wigner3j_table(os.path.join(tmpdir, 'w3j.tab'),
+                                            lmax)
+            for l1, l2 in [(2, 2), (7, 15), (15, 7), (20, 3), (10, 20)]:
+                for tm1, tm2 in [(0, 0), (-4, 4), (4, -4), (-2, 4), (2, -4),
+                                 (0, 4), (0, -4)]:
+                    family = table.vect(2*l1, 2*l2, tm1, tm2)
+                    np.testing.assert_almost_equal(
+                        family,
+                        wc.wigner3j_vect(2*l1, 2*l2, tm1, tm2)[:len(family)])
+                    self.assertEqual(len(family), min(l1+l2, lmax) + 1
+                                     - max(abs(l1-l2), abs(tm1+tm2)//2))
+
+            self.assertRaises(ValueError, table.vect, 2*lmax+2, 4, 0, 0)
+            self.assertRaises(ValueError, table.vect, 4, 4, 2, 2)
+
+            # Pickling reopens the file instead of copying the payload
+            table2 = pickle.loads(pickle.dumps(table))
+            self.assertLess(len(pickle.dumps(table)), 1000)
+            np.testing.assert_array_equal(table2.vect(14, 30, -4, 4),
+                                          table.vect(14, 30, -4, 4))
+            del table, table2
+
+class TestWigner3jAsymptotic(unittest.TestCase):
+
+    def test_asymptotic(self):
+        l2 = np.arange(1000, 2600, 75)
+        for tm1, tm2 in [(-4, 4), (-2, 4), (0, 4)]:
+            wigvals, jmin, Nj = wc.wigner3j_vect_batch_asymptotic(
+                2*1800, 2*l2, tm1, tm2, tol=1e-6)
+            wigvals_ref, jmin_ref, Nj_ref = wc.wigner3j_vect_batch(2*1800,
+                                                                   2*l2,
+                                                                   tm1, tm2)
+            np.testing.assert_array_equal(Nj, Nj_ref)
+            np.testing.assert_array_equal(jmin, jmin_ref)
+            np.testing.assert_allclose(wigvals, wigvals_ref, rtol=0,
+                                       atol=1e-7)
+
+    def test_fallback(self):
+        l2 = np.arange(2, 40)
+        for tm1, tm2 in [(-4, 4), (3, -1)]:
+            wigvals, jmin, Nj = wc.wigner3j_vect_batch_asymptotic(
+                2*20+tm1 % 2, 2*l2+tm2 % 2, tm1, tm2, lmin=0)
+            wigvals_ref, jmin_ref, Nj_ref = wc.wigner3j_vect_batch(
+                2*20+tm1 % 2, 2*l2+tm2 % 2, tm1, tm2)
+            np.testing.assert_array_equal(Nj, Nj_ref)
+            np.testing.assert_almost_equal(wigvals, wigvals_ref)
+
+    def test_pm_families(self):
+        source = wc.Wigner3jAsymptotic(tol=1e-6, lmin=1000)
+        l2 = np.arange(5, 1500, 150)
+        Jp, Jm, jmin, Nj = wc.wigner3j_pm_vect_batch(2*1200, 2*l2, -4, 4)
+        for i, (Jp_i, Jm_i) in enumerate(source.pm_families(2*1200, 2*l2,
+                                                            -4, 4)):
+            np.testing.assert_allclose(Jp_i, Jp[i, :Nj[i]], rtol=0, atol=1e-7)
+            np.testing.assert_allclose(Jm_i, Jm[i, :Nj[i]], rtol=0, atol=1e-7)
+
+class TestGauntTensor(unittest.TestCase):
+
+    def test_tensor(self):
+        lmax = 8
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tensor = wc.build_gaunt_tensor(os.path.join(tmpdir, 'gaunt.bin'),
+                                           lmax, dtype=np.float32)
+            for l1, l2, l3, m1, m2 in [(2, 1, 1, 0, 0), (3, 2, 1, -1, 0),
+                                       (8, 3, 7, 2, -3), (3, 8, 7, -3, 2),
+                                       (5, 5, 6, -5, 1), (6, 4, 4, 0, -4),
+                                       (4, 4, 3, 1, 1), (7, 1, 3, 0, 0)]:
+                self.assertAlmostEqual(tensor.gaunt(l1, l2, l3, m1, m2,
+                                                    -m1-m2),
+                                       wc.gaunt(l1, l2, l3, m1, m2, -m1-m2),
+                                       places=6)
+
+            l3, values = tensor.family(6, 3, -2, 1)
+            np.testing.assert_array_equal(l3, [3, 5, 7, 9])
+            np.testing.assert_almost_equal(
+                values, [wc.gaunt(6, 3, l, -2, 1, 1) for l in l3], decimal=6)
+
+            self.assertEqual(tensor.gaunt(2, 2, 2, 1, 1, 1), 0)
+
+            # l3 runs up to l1+l2, so up to 2*lmax
+            l3, values = tensor.family(lmax, lmax, 0, 0)
+            np.testing.assert_array_equal(l3, np.arange(0, 2*lmax+1, 2))
+            self.assertAlmostEqual(tensor.gaunt(lmax, lmax, 2*lmax, 1, 2, -3),
+                                   wc.gaunt(lmax, lmax, 2*lmax, 1, 2, -3),
+                                   places=6)
+            self.assertNotEqual(values[-1], 0)
+            self.assertRaises(ValueError, tensor.gaunt, lmax+1, 2, lmax, 0,
+                              0, 0)
+            del tensor, values
+
 class TestWigner6j(unittest.TestCase):
 
     def test_special1(self):
@@ -67,8 +385,29 @@ class TestWigner6j(unittest.TestCase):
         self.assertAlmostEqual(wc.racah_w(8*2, 10*2, 6*2, 8*2, 6*2, 4*2),
                                -635*np.sqrt(26)/176358)
 
+class TestWigner6jBatch(unittest.TestCase):
+
+    def test_families(self):
+        args = [(2*10, 2*6, 2*9, 2*7, 2*6), (2*2, 2*2, 2*2, 2*2, 2*2),
+                (2*8, 2*8, 2*10, 2*6, 2*6), (2, 4, 2, 4, 4), (3, 5, 4, 2, 3)]
+        wigvals, jmin, Nj = wc.wigner6j_vect_batch(*np.array(args).T)
+        for i, arg in enumerate(args):
+            np.testing.assert_almost_equal(wigvals[i, :Nj[i]],
+                                           wc.wigner6j_vect(*arg))
+
+    def test_invalid(self):
+        wigvals, jmin, Nj = wc.wigner6j_vect_batch(2, 2, 2, 2, [8, 3])
+        np.testing.assert_array_equal(Nj, [0, 0])
+
 class TestWigner9j(unittest.TestCase):
 
+    def test_9j_batch(self):
+        np.testing.assert_almost_equal(
+            wc.wigner9j_batch([2*1, 2*1, 2*1], [2*2, 2*1, 2*1], [2*1, 2*1, 2*1],
+                              [2*2, 2*1, 2*1], [2*2, 2*1, 2*1], [2*2, 2*1, 2*1],
+                              [2*1, 2*1, 2*1], [2*2, 2*1, 2*1], [2*1, 2*0, 2*1]),
+            [-1.0/150, 1.0/18, 0.0])
+
     def test_9j(self):
         self.assertAlmostEqual(wc.wigner9j(2*1 ,2*2, 2*1, 2*2, 2*2, 2*2, 2*1, 2*2, 2*1),
                                -1.0/150)
@@ -9,8 +9,18 @@ recursion formulas. Following Luscombe and Luban.
 
 from __future__ import print_function
 
+import math
+import struct
+import threading
+from collections import OrderedDict
+
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 
 def _A(j1, j2, j, m1, m2):
     '''Auxiliary function used in 3j recursion
@@ -55,6 +65,38 @@ def _Xj3j(j1, j2, j, m1, m2, m3):
     return j*_A(j1, j2, j+1, m1, m2)
 
 
+def _C(j1, j2, m1, m3):
+    '''Auxiliary function used in the 3j recursion over m1
+    '''
+
+    m2 = -m1-m3
+
+    return np.sqrt((j1+m1)*(j1-m1+1)*(j2-m2)*(j2+m2+1))
+
+
+def _Zm3j(j1, j2, m1, j3, m3, dummy):
+    '''Auxiliary function used in the 3j recursion over m1
+    '''
+
+    return _C(j1, j2, m1, m3)
+
+
+def _Ym3j(j1, j2, m1, j3, m3, dummy):
+    '''Auxiliary function used in the 3j recursion over m1
+    '''
+
+    m2 = -m1-m3
+
+    return 2*m1*m2 + j1*(j1+1) + j2*(j2+1) - j3*(j3+1)
+
+
+def _Xm3j(j1, j2, m1, j3, m3, dummy):
+    '''Auxiliary function used in the 3j recursion over m1
+    '''
+
+    return _C(j1, j2, m1+1, m3)
+
+
 def _E(j1, j2, j3, k1, k2, k3):
     '''Auxiliary function used in 6j recursion
     '''
@@ -134,6 +176,13 @@ def _sign_6j(j1, j2, k1, k2):
     return (-1.0)**(j1+j2+k1+k2)
 
 
+def _sign_m3j(j1, j2, j3, m3):
+    '''The multiplicative sign of the 3j vector over m1 given the inputs
+    '''
+
+    return (-1.0)**(j1-j2-m3)
+
+
 def get_jrange_3j(j1, j2, m1, m2):
     '''Calculates the valid range of j3 in Wigner 3j given the input values
     for j1, j2, m1, and m2.
@@ -226,6 +275,47 @@ def get_jrange_6j(j1, j2, k1, k2):
     return jmax, jmin, Nj
 
 
+def get_mrange_3j(j1, j2, m3):
+    '''Calculates the valid range of m1 in Wigner 3j with m2 = -m1-m3 given
+    the input values for j1, j2, and m3.
+
+    Parameters
+    ----------
+    j1 : float
+        j1, integer or half-integer
+
+    j2 : float
+        j2, integer or half-integer
+
+    m3 : float
+        m3, integer or half-integer
+
+    Returns
+    -------
+    mmax : float
+        Maximum value of m1
+
+    mmin : float
+        Minimum value of m1
+
+    Nm : int
+        Number of valid m1 values
+    '''
+
+    mmax = min(j1, j2-m3)
+    mmin = max(-j1, -j2-m3)
+
+    Nm = int(mmax - mmin + 1)
+
+    return mmax, mmin, Nm
+
+
+# Largest j3 (j) for which wigner3j_vect (wigner6j_vect) use the scalar
+# recursion. Larger families use the rescaled recursion of _batch_generic,
+# which stays accurate for j of a few times 10^4.
+SCALAR_JMAX = 500
+
+
 def wigner3j_vect(tj1, tj2, tm1, tm2, verbose=False):
     '''Calculates a family of Wigner 3j symbols. Given the input values, it
     determines the range of valid j3 and calculates the Wigner 3j symbol for
@@ -256,7 +346,8 @@ def wigner3j_vect(tj1, tj2, tm1, tm2, verbose=False):
     Notes
     -----
     Calculates the Wigner 3j symbols using recursion and normalization.
-    Input values are rounded to the nearest integer.
+    Input values are rounded to the nearest integer. Families that extend
+    past SCALAR_JMAX are calculated with the rescaled batch recursion.
     '''
     
     tj1 = int(round(tj1))
@@ -285,6 +376,12 @@ def wigner3j_vect(tj1, tj2, tm1, tm2, verbose=False):
 
     jmax, jmin, Nj = get_jrange_3j(j1, j2, m1, m2)
 
+    if jmax > SCALAR_JMAX:
+        WigVals, jmin, Nj = _batch_generic(np.array([j1]), np.array([j2]),
+                                           np.array([m1]), np.array([m2]),
+                                           wignertype='3j')
+        return WigVals[0]
+
     Yjmax = _Yj3j(j1, j2, jmax, m1, m2, 0)
     Yjmin = _Yj3j(j1, j2, jmin, m1, m2, 0)
 
@@ -306,89 +403,61 @@ def wigner3j_vect(tj1, tj2, tm1, tm2, verbose=False):
     return WigVal
 
 
-def wigner6j_vect(tj1, tj2, tk1, tk2, tk3, verbose=False):
-    '''Calculates a family a Wigner 6j symbols
+def wigner3j_vect_batch(tj1, tj2, tm1, tm2):
+    '''Calculates many families of Wigner 3j symbols at once. Each family is
+    the set of all valid j3 for one combination of the inputs, as returned by
+    wigner3j_vect.
 
-    tj1 : int
+    Parameters
+    ----------
+    tj1 : int or array-like
         2*j1
 
-    tj2 : int
+    tj2 : int or array-like
         2*j2
 
-    tk1 : int
-        2*k1
-
-    tk2 : int
-        2*k2
+    tm1 : int or array-like
+        2*m1
 
-    tk3 : int
-        2*k3
+    tm2 : int or array-like
+        2*m2
 
     Returns
     -------
-    WigVal : int or array-like
-        Returns an array of the Wigner 6j values or 0 is there is no valid j3
+    WigVals : array-like (nfamily, Njmax)
+        Wigner 3j values. Row i holds the family for the i-th set of inputs
+        starting at j3 = jmin[i] and is zero padded after Nj[i] values.
+
+    jmin : array-like (nfamily)
+        Minimum value of j3 for each family
+
+    Nj : array-like (nfamily)
+        Number of valid j3 values for each family. This is 0 when the inputs
+        do not lead to any non-zero Wigner 3j symbols.
 
     Notes
     -----
-    Calculates the Wigner 6j symbols using the same algorithm as the 3j
-    symbols, excepts uses a different recursion relation. Input values
-    are rounded to the nearest integer.
+    The inputs are broadcast against each other, so a scalar tj1 with an
+    array of tj2 gives all families for a fixed j1. The recursion is the same
+    as in wigner3j_vect, but it is run in lockstep over the j3 index for all
+    of the families, so that the Python loops are over j3 only and not over
+    the families.
     '''
-    
-    tj1 = int(round(tj1))
-    tj2 = int(round(tj2))
-    tk1 = int(round(tk1))
-    tk2 = int(round(tk2))
-    tk3 = int(round(tk3))
-
-    j1 = tj1 / 2.0
-    j2 = tj2 / 2.0
-    k1 = tk1 / 2.0
-    k2 = tk2 / 2.0
-    k3 = tk3 / 2.0
-
-#   Testing whether this can lead to valid Wigner 6j symbols
-    Triad = np.zeros([2, 3])
-    Triad[0, 0] = j1
-    Triad[0, 1] = k2
-    Triad[0, 2] = k3
-    Triad[1, 0] = k1
-    Triad[1, 1] = j2
-    Triad[1, 2] = k3
-
-    for i in range(2):
-        TriadSum = int(2*(Triad[i, 0]+Triad[i, 1]+Triad[i, 2]))
-        TriadM = np.abs(Triad[i, 0] - Triad[i, 1])
-        TriadP = Triad[i, 0]+Triad[i, 1]
-        if (Triad[i, 2] < TriadM) or (Triad[i, 2] > TriadP) or \
-                (np.mod(TriadSum, 2) == 1):
-            return 0
-
-    jmax, jmin, Nj = get_jrange_6j(j1, j2, k1, k2)
 
-    Yjmin = _Yj6j(j1, j2, jmin, k1, k2, k3)
-    Yjmax = _Yj6j(j1, j2, jmax, k1, k2, k3)
+    tj1, tj2, tm1, tm2 = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                               for val in (tj1, tj2, tm1, tm2)])
 
-#   The values of Yjmax ans Yjmin determine how we do the recursion.
-    if Yjmax == 0 and Yjmin == 0:
-        WigVal = _spec_case_1_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
-                                      wignertype='6j')
-    elif Yjmax == 0:
-        WigVal = _spec_case_2_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
-                                      wignertype='6j')
-    elif Yjmin == 0:
-        WigVal = _spec_case_3_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
-                                      wignertype='6j')
-    else:
-        WigVal = _norm_case_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
-                                    wignertype='6j')
+    valid = (tj1 >= 0) & (tj2 >= 0) & (np.abs(tm1) <= tj1) & \
+        (np.abs(tm2) <= tj2) & (np.mod(tj1, 2) == np.mod(np.abs(tm1), 2)) & \
+        (np.mod(tj2, 2) == np.mod(np.abs(tm2), 2))
 
-    return WigVal
+    return _batch_generic(tj1/2.0, tj2/2.0, tm1/2.0, tm2/2.0, valid=valid,
+                          wignertype='3j')
 
 
-def wigner3j(tj1, tj2, tj3, tm1, tm2, tm3, verbose=False):
-    '''Calculation of a Wigner 3j symbol
+def wigner3j_m_vect(tj1, tj2, tj3, tm3):
+    '''Calculates a family of Wigner 3j symbols over m1 for fixed j1, j2, j3
+    and m3, with m2 = -m1-m3.
 
     Parameters
     ----------
@@ -401,185 +470,1535 @@ def wigner3j(tj1, tj2, tj3, tm1, tm2, tm3, verbose=False):
     tj3 : int
         2*j3
 
-    tm1 : int
-        2*m1
-
-    tm2 : int
-        2*m2
-
     tm3 : int
         2*m3
 
-    verbose : bool
-        Whether there is verbose output
-
     Returns
     -------
-    wigner3j : float
-        Wigner3j(j1,j2,j3,m1,m2,m3)
+    WigVal : int or array-like
+        Wigner 3j values for m1 = mmin, ..., mmax (see get_mrange_3j) or 0 if
+        there are no valid m1
 
     Notes
     -----
-    The input values are double the requested j, m values because they are
-    integers or half-integers. Code will round to the nearest integer.
+    The recursion over m1 follows from the action of J^2 on the coupled
+    state (Schulten and Gordon). It has the same structure as the recursion
+    over j3, and is calculated in the same way, so the values have the
+    usual normalization (2*j3+1) sum_m1 WigVal**2 = 1 and the usual sign.
     '''
-    
-    tj1 = int(round(tj1))
-    tj2 = int(round(tj2))
-    tj3 = int(round(tj3))
-    tm1 = int(round(tm1))
-    tm2 = int(round(tm2))
-    tm3 = int(round(tm3))
-
-#   Do testing that is not done in wigner3j_vect
-    if tm1+tm2+tm3 != 0:
-        return 0
-
-    t3 = np.abs(tm3)
-
-    if np.mod(tj3, 2) != np.mod(t3, 2):
-        return 0
 
-    if (tm3 > tj3) or (tm3 < -tj3):
-        return 0
-
-    jmax, jmin, Nj = get_jrange_3j(tj1/2.0, tj2/2.0, tm1/2.0, tm2/2.0)
+    WigVals, mmin, Nm = wigner3j_m_vect_batch(tj1, tj2, tj3, tm3)
 
-    j3 = tj3 / 2.0
-    if (j3 > jmax) or (j3 < jmin):
+    if Nm[0] == 0:
         return 0
 
-    WigVal = wigner3j_vect(tj1, tj2, tm1, tm2, verbose=verbose)
-
-    if isinstance(WigVal, int):
-        return WigVal
-    else:
-        return WigVal[int(j3-jmin)]
+    return WigVals[0, :Nm[0]]
 
 
-def wigner6j(tj1, tj2, tj3, tk1, tk2, tk3, verbose=False):
-    '''Calculation of a Wigner 6j Symbol
+def wigner3j_m_vect_batch(tj1, tj2, tj3, tm3):
+    '''Calculates many families of Wigner 3j symbols over m1 at once, as
+    returned by wigner3j_m_vect
 
     Parameters
     ----------
-    tj1 : int
+    tj1 : int or array-like
         2*j1
 
-    tj2 : int
+    tj2 : int or array-like
         2*j2
 
-    tj3 : int
+    tj3 : int or array-like
         2*j3
 
-    tk1 : int
-        2*k1
+    tm3 : int or array-like
+        2*m3
 
-    tk2 : int
-        2*k2
+    Returns
+    -------
+    WigVals : array-like (nfamily, Nmmax)
+        Wigner 3j values. Row i holds the family for the i-th set of inputs
+        starting at m1 = mmin[i] and is zero padded after Nm[i] values.
 
-    tk3 : int
-        2*k3
+    mmin : array-like (nfamily)
+        Minimum value of m1 for each family
 
-    verbose : bool
-        Whether there is verbose output
+    Nm : array-like (nfamily)
+        Number of valid m1 values for each family. This is 0 when the inputs
+        do not lead to any non-zero Wigner 3j symbols.
+    '''
+
+    tj1, tj2, tj3, tm3 = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                               for val in (tj1, tj2, tj3, tm3)])
+
+    valid = (tj1 >= 0) & (tj2 >= 0) & (tj3 >= np.abs(tj1-tj2)) & \
+        (tj3 <= tj1+tj2) & (np.mod(tj1+tj2+tj3, 2) == 0) & \
+        (np.abs(tm3) <= tj3) & (np.mod(tj3, 2) == np.mod(np.abs(tm3), 2))
+
+    return _batch_generic(tj1/2.0, tj2/2.0, tj3/2.0, tm3/2.0, valid=valid,
+                          wignertype='3jm')
+
+
+def _canonical_3j(tj1, tj2, tm1, tm2):
+    '''Maps the inputs of a Wigner 3j family to a canonical key using the
+    symmetries that keep the j3 range the same. Swapping the first two
+    columns or flipping the sign of all m both multiply the family by
+    (-1)**(j1+j2+j3), so doing both leaves it unchanged.
 
     Returns
     -------
-    wigner6j : float
-        Wigner6j(j1,j2,j3;k1,k2,k3)
+    key : tuple
+        Canonical (tj1, tj2, tm1, tm2)
 
-    Notes
-    -----
-    We input 2*j because j can be an integer or half-integer, so this
-    combination must be an integer. Code will round to the nearest
-    integer.
+    phase : bool
+        Whether the family of the inputs is the family of the key times
+        (-1)**(j1+j2+j3)
     '''
 
-    tj1 = int(round(tj1))
-    tj2 = int(round(tj2))
-    tj3 = int(round(tj3))
-    tk1 = int(round(tk1))
-    tk2 = int(round(tk2))
-    tk3 = int(round(tk3))
-
-    j1 = tj1 / 2.0
-    j2 = tj2 / 2.0
-    j3 = tj3 / 2.0
-    k1 = tk1 / 2.0
-    k2 = tk2 / 2.0
-    k3 = tk3 / 2.0
+    return min(((tj1, tj2, tm1, tm2), False),
+               ((tj2, tj1, tm2, tm1), True),
+               ((tj1, tj2, -tm1, -tm2), True),
+               ((tj2, tj1, -tm2, -tm1), False))
 
-#   Each triad must satisfy triangle inequalities
-#   Each triad must have the sum of its elements be an integer (or 2*sum is
-#   even). Only testing ones with j3 since ones with k3 are tested in
-#   wigner6j_vect which will always be called.
 
-    triad = np.zeros([2, 3])
+def _phase_3j(tj1, tj2, tm1, tm2):
+    '''(-1)**(j1+j2+j3) for all valid j3 of a family
+    '''
 
-    triad[0, 0] = j1
-    triad[0, 1] = j2
-    triad[0, 2] = j3
-    triad[1, 0] = k1
-    triad[1, 1] = k2
-    triad[1, 2] = j3
+    jmax, jmin, Nj = get_jrange_3j(tj1/2.0, tj2/2.0, tm1/2.0, tm2/2.0)
+    L = int(round((tj1+tj2)/2.0 + jmin))
 
-    for i in range(2):
-        triadsum = int(2*(triad[i, 0] + triad[i, 1] + triad[i, 2]))
-        triadM = np.abs(triad[i, 0] - triad[i, 1])
-        triadP = triad[i, 0]+triad[i, 1]
-        if (triad[i, 2] < triadM) or (triad[i, 2] > triadP) or \
-                (np.mod(triadsum, 2) == 1):
-            return 0
+    phase = np.ones(Nj)
+    phase[(L+1) % 2::2] = -1.0
 
-    jmax, jmin, Nj = get_jrange_6j(j1, j2, k1, k2)
+    return phase
 
-    WigVal = wigner6j_vect(tj1, tj2, tk1, tk2, tk3, verbose=verbose)
 
-    if isinstance(WigVal, int):
-        return WigVal
-    else:
-        return WigVal[int(j3-jmin)]
+class Wigner3jCache(object):
+    '''Memory bounded least recently used cache of Wigner 3j families.
 
+    Each request is mapped to a canonical family using the symmetries under
+    swapping (j1, m1) with (j2, m2) and flipping the sign of all m. Only the
+    canonical family is stored and the others are rebuilt from it by a sign
+    change. The families are stored read-only and should not be modified.
+    The cache can be shared between threads.
 
-def wigner9j(tj1, tj2, tj3, tj4, tj5, tj6, tj7, tj8, tj9, verbose=False):
-    '''Calculation of the Wigner 9j symbol.
+    Caching is opt-in: it only pays off for callers that request the same
+    or symmetry related families again, such as repeated single symbols
+    from wigner3j (which uses default_cache). The mode-mixing and TE
+    correction kernels request each family once and do not use it.
 
     Parameters
     ----------
-    tj1 : int
-        2*j1
+    maxbytes : int, optional
+        Maximum number of bytes of Wigner 3j values that are kept. A value
+        of 0 turns off caching.
+    '''
 
-    tj2 : int
-        2*j2
+    def __init__(self, maxbytes=256*2**20):
+        self.maxbytes = int(maxbytes)
+        self._families = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        '''Returns a stored family (and marks it as most recently used) or
+        None if it is not in the cache.'''
+
+        with self._lock:
+            family = self._families.get(key)
+
+            if family is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._families.move_to_end(key)
+
+        return family
+
+    def _store(self, key, family):
+        '''Adds a family to the cache'''
+
+        if family.nbytes > self.maxbytes:
+            return
+
+        family.flags.writeable = False
+
+        with self._lock:
+            if key in self._families:
+                return
+
+            self._families[key] = family
+            self._nbytes += family.nbytes
+
+            self._evict()
+
+    def _evict(self):
+        '''Removes the least recently used families until the cache fits
+        within maxbytes.'''
+
+        with self._lock:
+            while self._nbytes > self.maxbytes:
+                key_old, family_old = self._families.popitem(last=False)
+                self._nbytes -= family_old.nbytes
+                self.evictions += 1
+
+    def vect(self, tj1, tj2, tm1, tm2):
+        '''Cached version of wigner3j_vect. Returns an array of the Wigner 3j
+        values for all valid j3 or 0 if there is no valid j3.
+        '''
+
+        tj1 = int(round(tj1))
+        tj2 = int(round(tj2))
+        tm1 = int(round(tm1))
+        tm2 = int(round(tm2))
+
+        key, phase = _canonical_3j(tj1, tj2, tm1, tm2)
+
+        family = self._lookup(key)
+        if family is None:
+            family = wigner3j_vect(*key)
+            if not isinstance(family, np.ndarray):
+                return family
+            self._store(key, family)
+
+        if phase:
+            family = family * _phase_3j(tj1, tj2, tm1, tm2)
+
+        return family
+
+    def batch(self, tj1, tj2, tm1, tm2):
+        '''Cached version of wigner3j_vect_batch. Only the families that are
+        not in the cache are calculated, in one batched recursion.
+        '''
+
+        tj1, tj2, tm1, tm2 = np.broadcast_arrays(
+            *[np.rint(np.ravel(val)).astype(int)
+              for val in (tj1, tj2, tm1, tm2)])
+
+        nfam = len(tj1)
+        canon = [_canonical_3j(*args) for args in
+                 zip(tj1.tolist(), tj2.tolist(), tm1.tolist(), tm2.tolist())]
+        families = [self._lookup(key) for key, phase in canon]
+
+        missing = [i for i in range(nfam) if families[i] is None]
+        if len(missing) > 0:
+            args = np.array([canon[i][0] for i in missing]).T
+            wigvals, jmin, Nj = wigner3j_vect_batch(*args)
+            new = {}
+            for i, wigval, n in zip(missing, wigvals, Nj):
+                key = canon[i][0]
+                if n == 0:
+                    continue
+                if key not in new:
+                    new[key] = wigval[:n].copy()
+                    self._store(key, new[key])
+                families[i] = new[key]
+
+        jmax, jmin, Nj = _get_jrange_batch(tj1/2.0, tj2/2.0, tm1/2.0, tm2/2.0)
+        Nj = np.array([0 if family is None else len(family)
+                       for family in families], dtype=int)
+
+        WigVals = np.zeros([nfam, max(np.max(Nj, initial=0), 1)])
+        for i in range(nfam):
+            if Nj[i] == 0:
+                continue
+            WigVals[i, :Nj[i]] = families[i]
+            if canon[i][1]:
+                WigVals[i, :Nj[i]] *= _phase_3j(tj1[i], tj2[i], tm1[i],
+                                                 tm2[i])
 
-    tj3 : int
-        2*j3
+        return WigVals, jmin, Nj
+
+    def info(self):
+        '''Returns a dictionary with the hit, miss and eviction counts along
+        with the current and maximum size of the cache.'''
 
-    tj4 : int
-        2*j4
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'nfamilies': len(self._families), 'nbytes': self._nbytes,
+                'maxbytes': self.maxbytes}
+
+    def clear(self):
+        '''Removes all families from the cache and resets the counters.'''
+
+        with self._lock:
+            self._families.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def resize(self, maxbytes):
+        '''Changes the maximum size of the cache, evicting families if
+        needed.'''
+
+        self.maxbytes = int(maxbytes)
+
+        self._evict()
+
+
+# Cache shared by all callers in the process
+default_cache = Wigner3jCache()
+
+
+def wigner3j_vect_cached(tj1, tj2, tm1, tm2, cache=None):
+    '''Same as wigner3j_vect, but the families are kept in a least recently
+    used cache (default_cache unless another Wigner3jCache is given). The
+    returned array is read-only when it comes straight from the cache.
+    '''
 
-    tj5 : int
-        2*j5
+    if cache is None:
+        cache = default_cache
 
-    tj6 : int
-        2*j6
+    return cache.vect(tj1, tj2, tm1, tm2)
 
-    tj7 : int
-        2*j7
 
-    tj8 : int
-        2*j8
+def wigner3j_vect_batch_cached(tj1, tj2, tm1, tm2, cache=None):
+    '''Same as wigner3j_vect_batch, but each family is looked up in and added
+    to a least recently used cache (default_cache unless another
+    Wigner3jCache is given).
+    '''
 
-    tj9 : int
-        2*j9
+    if cache is None:
+        cache = default_cache
 
-    Returns
-    -------
-    wigner9j : float
-        Wigner9j(j1,j2,j3,j4,j5,j6,j7,j8,j9)
+    return cache.batch(tj1, tj2, tm1, tm2)
 
-    Notes
-    -----
+
+def wigner3j_pm_vect(tj1, tj2, tm1, tm2):
+    '''Calculates the sum and difference of the Wigner 3j families for
+    (m1, m2) and (-m1, -m2) from a single recursion
+
+    Parameters
+    ----------
+    tj1 : int
+        2*j1
+
+    tj2 : int
+        2*j2
+
+    tm1 : int
+        2*m1
+
+    tm2 : int
+        2*m2
+
+    Returns
+    -------
+    Jp : int or array-like
+        wigner3j_vect(tj1, tj2, tm1, tm2) + wigner3j_vect(tj1, tj2, -tm1, -tm2)
+        or 0 if there is no valid j3
+
+    Jm : int or array-like
+        wigner3j_vect(tj1, tj2, tm1, tm2) - wigner3j_vect(tj1, tj2, -tm1, -tm2)
+        or 0 if there is no valid j3
+
+    Notes
+    -----
+    The (-m1, -m2) family is the (m1, m2) family times (-1)**(j1+j2+j3), so
+    Jp is twice the family where j1+j2+j3 is even and zero otherwise, and
+    Jm is the opposite.
+    '''
+
+    WigVal = wigner3j_vect(tj1, tj2, tm1, tm2)
+
+    if not isinstance(WigVal, np.ndarray):
+        return 0, 0
+
+    phase = _phase_3j(int(round(tj1)), int(round(tj2)), int(round(tm1)),
+                      int(round(tm2)))
+
+    return WigVal*(1+phase), WigVal*(1-phase)
+
+
+def wigner3j_pm_vect_batch(tj1, tj2, tm1, tm2, cache=None):
+    '''Same as wigner3j_pm_vect for many families at once. The (m1, m2)
+    families are calculated with wigner3j_vect_batch, or looked up in and
+    added to cache if a Wigner3jCache is given. Only the (m1, m2) families
+    are used, so the cache only pays off when the same families are
+    requested again.
+
+    Returns
+    -------
+    Jp : array-like (nfamily, Njmax)
+        Sum of the (m1, m2) and (-m1, -m2) families, zero padded after Nj[i]
+        values
+
+    Jm : array-like (nfamily, Njmax)
+        Difference of the (m1, m2) and (-m1, -m2) families, zero padded after
+        Nj[i] values
+
+    jmin : array-like (nfamily)
+        Minimum value of j3 for each family
+
+    Nj : array-like (nfamily)
+        Number of valid j3 values for each family
+    '''
+
+    if cache is None:
+        WigVals, jmin, Nj = wigner3j_vect_batch(tj1, tj2, tm1, tm2)
+    else:
+        WigVals, jmin, Nj = cache.batch(tj1, tj2, tm1, tm2)
+
+    tj1, tj2, tm1, tm2 = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                               for val in (tj1, tj2, tm1, tm2)])
+
+    L = np.rint((tj1+tj2)/2.0 + jmin).astype(int)
+    phase = 1.0 - 2.0*((L[:, None] + np.arange(WigVals.shape[1])) % 2)
+
+    return WigVals*(1+phase), WigVals*(1-phase), jmin, Nj
+
+
+# log(n!) for n = 0, 1, ..., grown on demand by _logfact
+_logfact_table = np.zeros(1)
+
+
+def _logfact(n):
+    '''log(n!) for an integer array n, from a cached table of log-gamma
+    values
+    '''
+
+    global _logfact_table
+
+    nmax = int(np.max(n, initial=0))
+
+    # Use a local reference, since another thread can replace the table
+    table = _logfact_table
+    if nmax >= len(table):
+        size = max(nmax+1, 2*len(table))
+        table = np.array([math.lgamma(k+1.0) for k in range(size)])
+        _logfact_table = table
+
+    return table[n]
+
+
+def wigner3j_000_batch(tj1, tj2):
+    '''Calculates many families of the Wigner 3j symbols
+    (j1 j2 j3; 0 0 0) at once from their closed form
+
+    Parameters
+    ----------
+    tj1 : int or array-like
+        2*j1
+
+    tj2 : int or array-like
+        2*j2
+
+    Returns
+    -------
+    WigVals : array-like (nfamily, Njmax)
+        Wigner 3j values in the same layout as wigner3j_vect_batch: row i
+        starts at j3 = jmin[i] = |j1-j2| and is zero padded after Nj[i]
+        values.
+
+    jmin : array-like (nfamily)
+        Minimum value of j3 for each family
+
+    Nj : array-like (nfamily)
+        Number of valid j3 values for each family. This is 0 when j1 or j2
+        is negative or not an integer.
+
+    Notes
+    -----
+    With J = j1+j2+j3 and g = J/2, the symbol is zero for odd J and
+
+    (-1)**g sqrt((J-2j1)! (J-2j2)! (J-2j3)! / (J+1)!)
+        * g! / ((g-j1)! (g-j2)! (g-j3)!)
+
+    for even J. It is evaluated with a cached table of log-factorials, so
+    there is no recursion and no special casing.
+    '''
+
+    tj1, tj2 = np.broadcast_arrays(np.rint(np.ravel(tj1)).astype(int),
+                                   np.rint(np.ravel(tj2)).astype(int))
+
+    valid = (tj1 >= 0) & (tj2 >= 0) & (tj1 % 2 == 0) & (tj2 % 2 == 0)
+
+    jbig = np.where(valid, np.maximum(tj1, tj2)//2, 0)
+    jsmall = np.where(valid, np.minimum(tj1, tj2)//2, 0)
+
+    jmin = jbig - jsmall
+    Nj = np.where(valid, 2*jsmall+1, 0)
+
+#   J is even for every other j3 starting at jmin, j3 = jmin + 2i. Then
+#   g = jbig+i and the factorials are of i, jmin+i, jsmall-i and jbig+i.
+    i = np.arange(np.max(jsmall, initial=0) + 1)
+    i = np.minimum(i[None, :], jsmall[:, None])
+
+    a1 = jmin[:, None] + i
+    a3 = jsmall[:, None] - i
+    g = jbig[:, None] + i
+
+    logval = 0.5*(_logfact(2*i) + _logfact(2*a1) + _logfact(2*a3) -
+                  _logfact(2*g+1)) + _logfact(g) - _logfact(i) - \
+        _logfact(a1) - _logfact(a3)
+
+    WigVals = np.zeros([len(Nj), np.max(Nj, initial=0)])
+    WigVals[:, ::2] = (1.0 - 2.0*(g % 2))*np.exp(logval)
+    WigVals[np.arange(WigVals.shape[1]) >= Nj[:, None]] = 0.0
+
+    return WigVals, jmin.astype(float), Nj
+
+
+def wigner3j_000_vect(tj1, tj2):
+    '''Same as wigner3j_vect(tj1, tj2, 0, 0), but from the closed form of
+    wigner3j_000_batch. Returns 0 if there is no valid j3.
+    '''
+
+    WigVals, jmin, Nj = wigner3j_000_batch(tj1, tj2)
+
+    if Nj[0] == 0:
+        return 0
+
+    return WigVals[0, :Nj[0]]
+
+
+def _semiclassical_3j(j1, j2, j3, m1, m2):
+    '''Phase and envelope of the semiclassical (Ponzano-Regge) approximation
+    of the Wigner 3j symbols of integer j, and their derivatives with j3.
+
+    Returns
+    -------
+    Phi, dPhi : array-like
+        Phase and its derivative with j3
+
+    lnenv, dlnenv : array-like
+        Log of the envelope 1/sqrt(2 pi A) and its derivative with j3
+
+    allowed : array-like
+        Whether j3 is in the classically allowed region
+
+    Notes
+    -----
+    With vectors J_i of length j_i+1/2 and z components m_i that add up to
+    zero, A is the area of the projection of their triangle onto the xy
+    plane, theta_i is the angle between the plane of the triangle and the
+    vertical plane through J_i and psi_i is the angle of the projected
+    triangle opposite to J_i. Then
+
+    (j1 j2 j3; m1 m2 m3) ~ -(-1)**m2 cos(Phi) / sqrt(2 pi A)
+
+    Phi = sum_i (j_i+1/2) theta_i - m1 psi_3 + m3 psi_1 + pi/4
+
+    and dPhi/dj3 = theta_3.
+    '''
+
+    m3 = -(m1+m2)
+
+    L1 = j1 + 0.5
+    L2 = j2 + 0.5
+    L3 = j3 + 0.5
+    P1 = np.sqrt(L1**2 - m1**2)
+    P2 = np.sqrt(L2**2 - m2**2)
+    P3 = np.sqrt(L3**2 - m3**2)
+
+    A2 = (P1+P2+P3)*(-P1+P2+P3)*(P1-P2+P3)*(P1+P2-P3) / 16.0
+    allowed = A2 > 0
+    A2 = np.where(allowed, A2, 1.0)
+    A = np.sqrt(A2)
+
+    cpsi1 = (P2**2 + P3**2 - P1**2) / (2*P2*P3)
+    cpsi3 = (P1**2 + P2**2 - P3**2) / (2*P1*P2)
+
+#   J1 = (P1, 0, m1), J2 = (-P2 cos(psi3), P2 sin(psi3), m2), J3 = -J1-J2
+    x2 = -P2*cpsi3
+    y2 = 2*A/P1
+    nx = -m1*y2
+    ny = m1*x2 - P1*m2
+    nz = P1*y2
+    nnorm = np.sqrt(nx**2 + ny**2 + nz**2)
+
+    Phi = np.pi/4 - m1*np.arccos(np.clip(cpsi3, -1, 1)) + \
+        m3*np.arccos(np.clip(cpsi1, -1, 1))
+    for x, y, L, P in [(P1, 0.0, L1, P1), (x2, y2, L2, P2),
+                       (-P1-x2, -y2, L3, P3)]:
+        theta = np.arccos(np.clip((nx*y - ny*x) / (nnorm*P), -1, 1))
+        Phi = Phi + L*theta
+
+    lnenv = -0.5*np.log(2*np.pi*A)
+    dlnenv = -L3*(P1**2 + P2**2 - P3**2) / (16*A2)
+
+    return Phi, theta, lnenv, dlnenv, allowed
+
+
+def _asymptotic_3j(j1, j2, j3, m1, m2):
+    '''Semiclassical approximation of the Wigner 3j symbols of integer j
+    and its envelope, both zero where j3 is classically forbidden
+    '''
+
+    Phi, dPhi, lnenv, dlnenv, allowed = _semiclassical_3j(j1, j2, j3, m1, m2)
+
+    env = np.where(allowed, np.exp(lnenv), 0.0)
+    sign = np.where(np.rint(m2) % 2 == 0, -1.0, 1.0)
+
+    return sign*env*np.cos(Phi), env
+
+
+def _asymptotic_3j_grid(j1, j2, jstart, m1, m2, ncol, step=8):
+    '''Semiclassical approximation of the Wigner 3j symbols for
+    j3 = jstart + (0, ..., ncol-1), as an (ncol, nfamily) array. The phase
+    and the log of the envelope are only calculated every step values and
+    cubic Hermite interpolated in between.
+    '''
+
+    nodes = np.arange(0, ncol + step, step)[:, None]
+    Phi, dPhi, lnenv, dlnenv, allowed = _semiclassical_3j(j1, j2,
+                                                          jstart + nodes,
+                                                          m1, m2)
+
+    cols = np.arange(ncol)
+    k = cols // step
+    t = ((cols - k*step) / float(step))[:, None]
+
+    h00 = (1 + 2*t)*(1 - t)**2
+    h10 = t*(1 - t)**2*step
+    h01 = t**2*(3 - 2*t)
+    h11 = t**2*(t - 1)*step
+
+    Phi = h00*Phi[k] + h10*dPhi[k] + h01*Phi[k+1] + h11*dPhi[k+1]
+    lnenv = h00*lnenv[k] + h10*dlnenv[k] + h01*lnenv[k+1] + h11*dlnenv[k+1]
+
+    sign = np.where(np.rint(m2) % 2 == 0, -1.0, 1.0)
+
+    return sign*np.exp(lnenv)*np.cos(Phi)
+
+
+def _batch_asymptotic_3j(j1, j2, m1, m2, tol, chunk=16, maxfrac=0.25):
+    '''Wigner 3j families of integer j in the layout of _batch_generic, from
+    the semiclassical approximation in the middle of each family and the
+    exact three term recursion near the ends. Families for which the two do
+    not agree to tol within maxfrac of the family from each end are
+    returned with Nj = -1.
+
+    Notes
+    -----
+    The recursion is run upwards from jmin and downwards from jmax, where it
+    is stable, with unnormalized values that are rescaled when they get
+    large. Every chunk values, the unnormalized values are fitted to the
+    approximation by least squares over the last chunk. The recursion stops
+    once they agree to tol (relative to the largest value in the chunk) and
+    the fitted values are used up to there.
+    '''
+
+    jmax, jmin, Nj = _get_jrange_batch(j1, j2, m1, m2)
+
+    nfam = len(Nj)
+    ncol = max(np.max(Nj, initial=0), 1)
+    families = np.arange(nfam)
+    top = np.maximum(Nj - 1, 0)
+    nmax = np.where(Nj > 4*chunk, (maxfrac*Nj).astype(int), 0)
+
+    um = np.zeros([ncol, nfam])
+    fact = np.ones([2, nfam])
+    splice = np.zeros([2, nfam], dtype=int)
+    done = np.zeros([2, nfam], dtype=bool)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        for end in range(2):
+            # Columns in the order of the recursion: upwards from jmin for
+            # end == 0 and downwards from jmax for end == 1
+            if end == 0:
+                cstart = np.zeros(nfam, dtype=int)
+                step = 1
+            else:
+                cstart = top
+                step = -1
+
+            active = nmax > 0
+            uprev = np.zeros(nfam)
+            ucur = np.where(active, 1.0, 0.0)
+            um[cstart, families] = ucur
+
+            for i in range(1, np.max(nmax, initial=0)):
+                active &= i < nmax
+                if not np.any(active):
+                    break
+
+                args = (j1, j2, jmin + cstart + step*(i-1), m1, m2, 0)
+                if end == 0:
+                    val = -(_Yj3j(*args)*ucur + _Zj3j(*args)*uprev) / \
+                        _Xj3j(*args)
+                else:
+                    val = -(_Yj3j(*args)*ucur + _Xj3j(*args)*uprev) / \
+                        _Zj3j(*args)
+
+                active &= np.isfinite(val)
+                uprev = np.where(active, ucur, uprev)
+                ucur = np.where(active, val, ucur)
+                um[cstart[active] + step*i, families[active]] = val[active]
+
+                for ifam in families[active & (np.abs(val) > _HUGE)]:
+                    cols = cstart[ifam] + step*np.arange(i+1)
+                    um[cols, ifam] /= _HUGE
+                    uprev[ifam] /= _HUGE
+                    ucur[ifam] /= _HUGE
+
+                if (i+1) % chunk != 0:
+                    continue
+
+                # Fit to the approximation over the last chunk
+                idx = families[active]
+                cols = cstart[idx] + step*np.arange(i+1-chunk, i+1)[:, None]
+                V, env = _asymptotic_3j(j1[idx], j2[idx], jmin[idx] + cols,
+                                        m1[idx], m2[idx])
+                u = um[cols, idx]
+                cfit = np.sum(u*V, axis=0) / np.sum(u*u, axis=0)
+                mismatch = np.max(np.abs(cfit*u - V), axis=0) / \
+                    np.max(np.abs(V), axis=0)
+
+                ok = np.all(env > 0, axis=0) & (mismatch < tol)
+                idx = idx[ok]
+                fact[end, idx] = cfit[ok]
+                splice[end, idx] = i + 1
+                done[end, idx] = True
+                active[idx] = False
+
+        good = done[0] & done[1] & (splice[0] <= Nj - splice[1])
+
+        # Scale the ends and fill in the approximation in the middle, in
+        # blocks of columns to limit the size of the temporary arrays
+        for c0 in range(0, ncol, 256):
+            cols = np.arange(c0, min(c0+256, ncol))[:, None]
+            block = um[c0:c0+len(cols)]
+            block *= np.where(cols < splice[0], fact[0], 1.0)
+            block *= np.where(cols > top - splice[1], fact[1], 1.0)
+
+            middle = good & (cols >= splice[0]) & (cols <= top - splice[1])
+            idx = families[np.any(middle, axis=0)]
+            if len(idx) == 0:
+                continue
+            V = _asymptotic_3j_grid(j1[idx], j2[idx], jmin[idx] + c0,
+                                    m1[idx], m2[idx], len(cols))
+            block[:, idx] = np.where(middle[:, idx], V, block[:, idx])
+
+    um[np.arange(ncol)[:, None] >= Nj] = 0.0
+    Nj = np.where(good | (Nj <= 0), Nj, -1)
+
+    return np.ascontiguousarray(um.T), jmin, Nj
+
+
+# Smallest min(j1, j2) for which wigner3j_vect_batch_asymptotic tries the
+# semiclassical approximation. Below that the families are too short for the
+# exact ends to reach the region where it is accurate.
+ASYMPTOTIC_LMIN = 1000
+
+
+def wigner3j_vect_batch_asymptotic(tj1, tj2, tm1, tm2, tol=1e-6,
+                                   lmin=ASYMPTOTIC_LMIN):
+    '''Same as wigner3j_vect_batch, but using the semiclassical
+    (Ponzano-Regge) approximation in the middle of the families with
+    min(j1, j2) >= lmin
+
+    Parameters
+    ----------
+    tj1, tj2, tm1, tm2 : int or array-like
+        2*j1, 2*j2, 2*m1, 2*m2 as in wigner3j_vect_batch
+
+    tol : float, optional
+        Tolerance of the approximation, relative to the local amplitude of
+        the Wigner 3j symbols
+
+    lmin : int, optional
+        Smallest min(j1, j2) for which the approximation is used
+
+    Returns
+    -------
+    WigVals, jmin, Nj : array-like
+        As in wigner3j_vect_batch
+
+    Notes
+    -----
+    The exact recursion is run from both ends of each family until its
+    values agree with the approximation to tol, and the approximation is
+    used in between. Families where this does not happen within a quarter
+    of the family from each end (short families, small tol, large m) and
+    families with half-integer j are calculated exactly. The approximation
+    is accurate to about 1e-7 in the middle of the families at j ~ 1000, so
+    tol much smaller than 1e-6 falls back to the exact recursion.
+    '''
+
+    tj1, tj2, tm1, tm2 = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                               for val in (tj1, tj2, tm1, tm2)])
+
+    valid = (tj1 >= 0) & (tj2 >= 0) & (np.abs(tm1) <= tj1) & \
+        (np.abs(tm2) <= tj2) & (np.mod(tj1, 2) == np.mod(np.abs(tm1), 2)) & \
+        (np.mod(tj2, 2) == np.mod(np.abs(tm2), 2))
+
+    asym = valid & (np.minimum(tj1, tj2) >= 2*lmin) & (tj1 % 2 == 0) & \
+        (tj2 % 2 == 0) & (tm1 % 2 == 0) & (tm2 % 2 == 0)
+
+    jmax, jmin, Nj = _get_jrange_batch(tj1/2.0, tj2/2.0, tm1/2.0, tm2/2.0)
+    Nj = np.where(valid, Nj, 0)
+    WigVals = np.zeros([len(Nj), max(np.max(Nj, initial=0), 1)])
+
+    if np.any(asym):
+        vals, jmin_a, Nj_a = _batch_asymptotic_3j(tj1[asym]/2.0, tj2[asym]/2.0,
+                                                  tm1[asym]/2.0, tm2[asym]/2.0,
+                                                  tol)
+        WigVals[asym, :vals.shape[1]] = vals
+        asym[asym] = Nj_a >= 0
+
+    exact = valid & ~asym
+    if np.any(exact):
+        vals, jmin_e, Nj_e = wigner3j_vect_batch(tj1[exact], tj2[exact],
+                                                 tm1[exact], tm2[exact])
+        WigVals[exact, :vals.shape[1]] = vals
+
+    return WigVals, jmin, Nj
+
+
+class Wigner3jAsymptotic(object):
+    '''Source of Wigner 3j families for the mode-mixing matrices, with the
+    same interface as Wigner3jTable, that uses
+    wigner3j_vect_batch_asymptotic for the (m1, m2) != (0, 0) families and
+    the closed form for the (0, 0) ones.
+
+    Parameters
+    ----------
+    tol : float, optional
+        Tolerance of the approximation
+
+    lmin : int, optional
+        Smallest min(l1, l2) for which the approximation is used
+    '''
+
+    # The families are not cut at any lmax
+    lmax = None
+
+    def __init__(self, tol=1e-6, lmin=ASYMPTOTIC_LMIN):
+        self.tol = tol
+        self.lmin = lmin
+
+    def batch(self, tj1, tj2, tm1, tm2):
+        '''Returns WigVals, jmin, Nj like wigner3j_vect_batch
+        '''
+
+        if np.all(np.ravel(tm1) == 0) and np.all(np.ravel(tm2) == 0):
+            tj1, tj2 = np.broadcast_arrays(np.ravel(tj1), np.ravel(tj2))
+            return wigner3j_000_batch(tj1, tj2)
+
+        return wigner3j_vect_batch_asymptotic(tj1, tj2, tm1, tm2,
+                                              tol=self.tol, lmin=self.lmin)
+
+    def families(self, tj1, tj2, tm1, tm2):
+        '''Returns a list of families, one for each element of the broadcast
+        inputs.
+        '''
+
+        WigVals, jmin, Nj = self.batch(tj1, tj2, tm1, tm2)
+
+        return [WigVals[i, :Nj[i]] for i in range(len(Nj))]
+
+    def pm_families(self, tj1, tj2, tm1, tm2):
+        '''Returns a list of (Jp, Jm) pairs like wigner3j_pm_vect_batch, one
+        for each element of the broadcast inputs.
+        '''
+
+        WigVals, jmin, Nj = self.batch(tj1, tj2, tm1, tm2)
+
+        tj1, tj2, tm1, tm2 = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                                   for val in (tj1, tj2, tm1, tm2)])
+
+        L = np.rint((tj1+tj2)/2.0 + jmin).astype(int)
+        phase = 1.0 - 2.0*((L[:, None] + np.arange(WigVals.shape[1])) % 2)
+
+        Jp = WigVals*(1+phase)
+        Jm = WigVals*(1-phase)
+
+        return [(Jp[i, :Nj[i]], Jm[i, :Nj[i]]) for i in range(len(Nj))]
+
+
+# (2*m1, 2*m2) pairs needed by the coupling matrices. With the sign flip
+# symmetry these cover (m1, m2) = (0, 0), (-/+2, +/-2), (-/+1, +/-2) and
+# (0, +/-2) for l1 <= l2 and, with the column swap, also for l1 > l2.
+COUPLING_PAIRS = ((0, 0), (-4, 4), (-2, 4), (-4, 2), (0, 4), (-4, 0))
+
+_TABLE_MAGIC = b'CMBW3JTB'
+_TABLE_VERSION = 1
+_TABLE_HEADER = '<8sIIII'
+
+
+def _table_lengths(lmax, tm1, tm2):
+    '''Number of stored j3 values (j3 <= lmax) of every l1 <= l2 <= lmax
+    family of a table, in the order they are stored.
+    '''
+
+    l1, l2 = np.triu_indices(lmax+1)
+    jmax, jmin, Nj = _get_jrange_batch(l1, l2, tm1/2.0, tm2/2.0)
+
+    valid = (np.abs(tm1) <= 2*l1) & (np.abs(tm2) <= 2*l2)
+
+    return np.where(valid, np.maximum(np.minimum(jmax, lmax) - jmin + 1, 0),
+                    0).astype(np.int64)
+
+
+def build_wigner3j_table(filename, lmax, pairs=COUPLING_PAIRS,
+                         dtype=np.float64):
+    '''Calculates all l1 <= l2 <= lmax Wigner 3j families of the given
+    (2*m1, 2*m2) pairs and writes them to a file that can be memory-mapped
+    with Wigner3jTable.
+
+    Parameters
+    ----------
+    filename : str
+        Output filename
+
+    lmax : int
+        Maximum l1, l2 and l3 of the table. Families are only stored up to
+        l3 = lmax.
+
+    pairs : list of tuples, optional
+        (2*m1, 2*m2) pairs to store. Default: COUPLING_PAIRS
+
+    dtype : np.float64 or np.float32, optional
+        Type of the stored values
+
+    Returns
+    -------
+    table : Wigner3jTable
+        The memory-mapped table
+
+    Notes
+    -----
+    The file has a versioned header, the (2*m1, 2*m2) pairs, the offset of
+    each family into the payload and the payload itself. The families are
+    calculated with wigner3j_vect_batch one l1 at a time.
+    '''
+
+    lmax = int(lmax)
+    dtype = np.dtype(dtype)
+    pairs = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+
+    offsets = np.zeros([len(pairs), (lmax+1)*(lmax+2)//2 + 1], dtype=np.int64)
+    for i, (tm1, tm2) in enumerate(pairs):
+        offsets[i, 1:] = np.cumsum(_table_lengths(lmax, tm1, tm2))
+    offsets[1:, :] += np.cumsum(offsets[:-1, -1])[:, None]
+
+    with open(filename, 'wb') as fout:
+        fout.write(struct.pack(_TABLE_HEADER, _TABLE_MAGIC, _TABLE_VERSION,
+                               lmax, len(pairs), dtype.itemsize))
+        fout.write(pairs.astype('<i4').tobytes())
+        fout.write(offsets.astype('<i8').tobytes())
+
+        for tm1, tm2 in pairs:
+            for l1 in range(lmax+1):
+                l2 = np.arange(l1, lmax+1)
+                wigvals, jmin, Nj = wigner3j_vect_batch(2*l1, 2*l2, tm1, tm2)
+                Nj = np.clip(lmax - jmin + 1, 0, Nj).astype(int)
+                wigvals = wigvals[np.arange(wigvals.shape[1])[None, :] <
+                                  Nj[:, None]]
+                fout.write(wigvals.astype(dtype.newbyteorder('<')).tobytes())
+
+    return Wigner3jTable(filename)
+
+
+class Wigner3jTable(object):
+    '''Read-only memory-mapped table of Wigner 3j families written by
+    build_wigner3j_table. Families are returned as zero-copy slices of the
+    file when they are stored directly, and rebuilt with the column swap and
+    sign flip symmetries otherwise.
+
+    Parameters
+    ----------
+    filename : str
+        Table filename
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as fin:
+            header = fin.read(struct.calcsize(_TABLE_HEADER))
+
+        magic, version, lmax, npairs, itemsize = struct.unpack(_TABLE_HEADER,
+                                                               header)
+
+        if magic != _TABLE_MAGIC:
+            raise ValueError("%s is not a Wigner 3j table" % filename)
+
+        if version != _TABLE_VERSION:
+            raise ValueError("Wigner 3j table version %d is not supported"
+                             % version)
+
+        self.lmax = lmax
+        self.dtype = np.dtype('<f%d' % itemsize)
+
+        offset = len(header)
+        pairs = np.memmap(filename, dtype='<i4', mode='r', offset=offset,
+                          shape=(npairs, 2))
+        self.pairs = [tuple(int(tm) for tm in pair) for pair in pairs]
+
+        offset += pairs.nbytes
+        nfam = (lmax+1)*(lmax+2)//2
+        self.offsets = np.memmap(filename, dtype='<i8', mode='r',
+                                 offset=offset, shape=(npairs, nfam+1))
+
+        offset += self.offsets.nbytes
+        self.payload = np.memmap(filename, dtype=self.dtype, mode='r',
+                                 offset=offset,
+                                 shape=(int(self.offsets[-1, -1]),))
+
+    def __reduce__(self):
+        # Reopen the file when unpickled, e.g. in a process pool worker,
+        # instead of copying the memory-mapped payload
+        return (Wigner3jTable, (self.filename,))
+
+    def _find(self, tj1, tj2, tm1, tm2):
+        '''Finds the stored family related to the input one. Returns the
+        pair index, l1, l2 and whether the (-1)**(j1+j2+j3) phase is needed.
+        '''
+
+        if (tj1 % 2 != 0) or (tj2 % 2 != 0):
+            raise ValueError("Wigner 3j tables only hold integer j1, j2")
+
+        if max(tj1, tj2) > 2*self.lmax:
+            raise ValueError("j1, j2 larger than the lmax of the table")
+
+        if tj1 <= tj2:
+            variants = [((tm1, tm2), False), ((-tm1, -tm2), True)]
+            l1, l2 = tj1//2, tj2//2
+        else:
+            variants = [((tm2, tm1), True), ((-tm2, -tm1), False)]
+            l1, l2 = tj2//2, tj1//2
+
+        for pair, phase in variants:
+            if pair in self.pairs:
+                return self.pairs.index(pair), l1, l2, phase
+
+        raise ValueError("(2*m1, 2*m2) = (%d, %d) is not in the table"
+                         % (tm1, tm2))
+
+    def vect(self, tj1, tj2, tm1, tm2):
+        '''Returns the family of Wigner 3j symbols for all valid j3 up to
+        the lmax of the table, like wigner3j_vect but cut at j3 = lmax.
+        '''
+
+        tj1 = int(round(tj1))
+        tj2 = int(round(tj2))
+        tm1 = int(round(tm1))
+        tm2 = int(round(tm2))
+
+        ipair, l1, l2, phase = self._find(tj1, tj2, tm1, tm2)
+
+        k = l1*(self.lmax+1) - l1*(l1-1)//2 + (l2-l1)
+        family = self.payload[self.offsets[ipair, k]:
+                              self.offsets[ipair, k+1]]
+
+        if phase and len(family) > 0:
+            family = family * _phase_3j(tj1, tj2, tm1, tm2)[:len(family)]
+
+        return family
+
+    def pm_vect(self, tj1, tj2, tm1, tm2):
+        '''Returns Jp and Jm like wigner3j_pm_vect, but cut at j3 = lmax
+        '''
+
+        family = self.vect(tj1, tj2, tm1, tm2)
+        phase = _phase_3j(int(round(tj1)), int(round(tj2)), int(round(tm1)),
+                          int(round(tm2)))[:len(family)]
+
+        return family*(1+phase), family*(1-phase)
+
+    def families(self, tj1, tj2, tm1, tm2):
+        '''Returns a list of families, one for each element of the broadcast
+        inputs.
+        '''
+
+        args = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                     for val in (tj1, tj2, tm1, tm2)])
+
+        return [self.vect(*arg) for arg in zip(*[val.tolist()
+                                                 for val in args])]
+
+    def pm_families(self, tj1, tj2, tm1, tm2):
+        '''Returns a list of (Jp, Jm) pairs, one for each element of the
+        broadcast inputs.
+        '''
+
+        args = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                     for val in (tj1, tj2, tm1, tm2)])
+
+        return [self.pm_vect(*arg) for arg in zip(*[val.tolist()
+                                                    for val in args])]
+
+
+def wigner6j_vect(tj1, tj2, tk1, tk2, tk3, verbose=False):
+    '''Calculates a family a Wigner 6j symbols
+
+    tj1 : int
+        2*j1
+
+    tj2 : int
+        2*j2
+
+    tk1 : int
+        2*k1
+
+    tk2 : int
+        2*k2
+
+    tk3 : int
+        2*k3
+
+    Returns
+    -------
+    WigVal : int or array-like
+        Returns an array of the Wigner 6j values or 0 is there is no valid j3
+
+    Notes
+    -----
+    Calculates the Wigner 6j symbols using the same algorithm as the 3j
+    symbols, excepts uses a different recursion relation. Input values
+    are rounded to the nearest integer.
+    '''
+    
+    tj1 = int(round(tj1))
+    tj2 = int(round(tj2))
+    tk1 = int(round(tk1))
+    tk2 = int(round(tk2))
+    tk3 = int(round(tk3))
+
+    j1 = tj1 / 2.0
+    j2 = tj2 / 2.0
+    k1 = tk1 / 2.0
+    k2 = tk2 / 2.0
+    k3 = tk3 / 2.0
+
+#   Testing whether this can lead to valid Wigner 6j symbols
+    Triad = np.zeros([2, 3])
+    Triad[0, 0] = j1
+    Triad[0, 1] = k2
+    Triad[0, 2] = k3
+    Triad[1, 0] = k1
+    Triad[1, 1] = j2
+    Triad[1, 2] = k3
+
+    for i in range(2):
+        TriadSum = int(2*(Triad[i, 0]+Triad[i, 1]+Triad[i, 2]))
+        TriadM = np.abs(Triad[i, 0] - Triad[i, 1])
+        TriadP = Triad[i, 0]+Triad[i, 1]
+        if (Triad[i, 2] < TriadM) or (Triad[i, 2] > TriadP) or \
+                (np.mod(TriadSum, 2) == 1):
+            return 0
+
+    jmax, jmin, Nj = get_jrange_6j(j1, j2, k1, k2)
+
+    if jmax > SCALAR_JMAX:
+        WigVals, jmin, Nj = _batch_generic(np.array([j1]), np.array([j2]),
+                                           np.array([k1]), np.array([k2]),
+                                           m3=np.array([k3]), wignertype='6j')
+        return WigVals[0]
+
+    Yjmin = _Yj6j(j1, j2, jmin, k1, k2, k3)
+    Yjmax = _Yj6j(j1, j2, jmax, k1, k2, k3)
+
+#   The values of Yjmax ans Yjmin determine how we do the recursion.
+    if Yjmax == 0 and Yjmin == 0:
+        WigVal = _spec_case_1_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
+                                      wignertype='6j')
+    elif Yjmax == 0:
+        WigVal = _spec_case_2_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
+                                      wignertype='6j')
+    elif Yjmin == 0:
+        WigVal = _spec_case_3_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
+                                      wignertype='6j')
+    else:
+        WigVal = _norm_case_generic(j1, j2, k1, k2, m3=k3, verbose=verbose,
+                                    wignertype='6j')
+
+    return WigVal
+
+
+def wigner6j_vect_batch(tj1, tj2, tk1, tk2, tk3):
+    '''Calculates many families of Wigner 6j symbols at once. Each family is
+    the set of all valid j3 for one combination of the inputs, as returned by
+    wigner6j_vect.
+
+    Parameters
+    ----------
+    tj1 : int or array-like
+        2*j1
+
+    tj2 : int or array-like
+        2*j2
+
+    tk1 : int or array-like
+        2*k1
+
+    tk2 : int or array-like
+        2*k2
+
+    tk3 : int or array-like
+        2*k3
+
+    Returns
+    -------
+    WigVals : array-like (nfamily, Njmax)
+        Wigner 6j values. Row i holds the family for the i-th set of inputs
+        starting at j3 = jmin[i] and is zero padded after Nj[i] values.
+
+    jmin : array-like (nfamily)
+        Minimum value of j3 for each family
+
+    Nj : array-like (nfamily)
+        Number of valid j3 values for each family. This is 0 when the inputs
+        do not lead to any non-zero Wigner 6j symbols.
+
+    Notes
+    -----
+    The inputs are broadcast against each other. The recursion is run in
+    lockstep over j3 for all of the families, as in wigner3j_vect_batch.
+    '''
+
+    tj1, tj2, tk1, tk2, tk3 = np.broadcast_arrays(
+        *[np.rint(np.ravel(val)).astype(int)
+          for val in (tj1, tj2, tk1, tk2, tk3)])
+
+#   The triads (j1, k2, k3) and (k1, j2, k3) have to be valid
+    valid = np.ones(len(tj1), dtype=bool)
+    for ta, tb in [(tj1, tk2), (tk1, tj2)]:
+        valid &= (ta >= 0) & (tb >= 0) & (tk3 >= np.abs(ta-tb)) & \
+            (tk3 <= ta+tb) & ((ta+tb+tk3) % 2 == 0)
+
+    return _batch_generic(tj1/2.0, tj2/2.0, tk1/2.0, tk2/2.0, m3=tk3/2.0,
+                          valid=valid, wignertype='6j')
+
+
+def wigner3j(tj1, tj2, tj3, tm1, tm2, tm3, verbose=False):
+    '''Calculation of a Wigner 3j symbol
+
+    Parameters
+    ----------
+    tj1 : int
+        2*j1
+
+    tj2 : int
+        2*j2
+
+    tj3 : int
+        2*j3
+
+    tm1 : int
+        2*m1
+
+    tm2 : int
+        2*m2
+
+    tm3 : int
+        2*m3
+
+    verbose : bool
+        Whether there is verbose output
+
+    Returns
+    -------
+    wigner3j : float
+        Wigner3j(j1,j2,j3,m1,m2,m3)
+
+    Notes
+    -----
+    The input values are double the requested j, m values because they are
+    integers or half-integers. Code will round to the nearest integer.
+    Symbols with all j <= RACAH_JMAX, or with a j above SCALAR_JMAX (where
+    a single Racah sum is cheaper than a family from the rescaled
+    recursion), are evaluated directly with wigner3j_racah. The others are
+    taken from the cached j3 family.
+    '''
+    
+    tj1 = int(round(tj1))
+    tj2 = int(round(tj2))
+    tj3 = int(round(tj3))
+    tm1 = int(round(tm1))
+    tm2 = int(round(tm2))
+    tm3 = int(round(tm3))
+
+#   Do testing that is not done in wigner3j_vect
+    if tm1+tm2+tm3 != 0:
+        return 0
+
+    t3 = np.abs(tm3)
+
+    if np.mod(tj3, 2) != np.mod(t3, 2):
+        return 0
+
+    if (tm3 > tj3) or (tm3 < -tj3):
+        return 0
+
+    jmax, jmin, Nj = get_jrange_3j(tj1/2.0, tj2/2.0, tm1/2.0, tm2/2.0)
+
+    j3 = tj3 / 2.0
+    if (j3 > jmax) or (j3 < jmin):
+        return 0
+
+#   Small and large j are evaluated directly, the others from the (cached)
+#   family
+    if max(tj1, tj2, tj3) <= 2*RACAH_JMAX or \
+            max(tj1, tj2, tj3) > 2*SCALAR_JMAX:
+        return float(wigner3j_racah(tj1, tj2, tj3, tm1, tm2, tm3))
+
+    WigVal = wigner3j_vect_cached(tj1, tj2, tm1, tm2)
+
+    if isinstance(WigVal, int):
+        return WigVal
+    else:
+        return WigVal[int(j3-jmin)]
+
+
+# Largest j for which wigner3j evaluates single symbols with wigner3j_racah
+# instead of the j3 family. Up to here the floating point Racah sum keeps
+# ~1e-11 relative accuracy, so its exact fallback is rarely needed.
+RACAH_JMAX = 20
+
+# Relative accuracy that is required of the floating point Racah sum. Symbols
+# whose estimated error is larger are summed exactly.
+_RACAH_RTOL = 1e-11
+
+
+def _racah_exact(a, p, q, x, y, kmin, kmax):
+    '''log|S| and the sign of S = sum_k (-1)^k t_k / t_kmin over
+    k = kmin..kmax of the Racah sum, with
+    t_k = 1/(k! (x+k)! (y+k)! (a-k)! (p-k)! (q-k)!), in exact integer
+    arithmetic
+
+    Notes
+    -----
+    S = 1 + r_kmin (1 + r_kmin+1 (1 + ...)) with the ratios
+    r_k = -(a-k)(p-k)(q-k) / ((k+1)(x+k+1)(y+k+1)) of consecutive terms,
+    which is evaluated from the inside out as a fraction of integers.
+    '''
+
+    num = 1
+    den = 1
+    for k in range(kmax-1, kmin-1, -1):
+        P = -(a-k)*(p-k)*(q-k)
+        Q = (k+1)*(x+k+1)*(y+k+1)
+        num, den = den*Q + P*num, den*Q
+
+    if num == 0:
+        return -np.inf, 0.0
+
+    return math.log(abs(num)) - math.log(den), (1.0 if num > 0 else -1.0)
+
+
+def wigner3j_racah(tj1, tj2, tj3, tm1, tm2, tm3):
+    '''Direct evaluation of single Wigner 3j symbols from the Racah formula
+
+    Parameters
+    ----------
+    tj1, tj2, tj3 : int or array-like
+        2*j1, 2*j2, 2*j3
+
+    tm1, tm2, tm3 : int or array-like
+        2*m1, 2*m2, 2*m3
+
+    Returns
+    -------
+    WigVals : array-like
+        Wigner3j(j1,j2,j3,m1,m2,m3) for each element of the broadcast inputs
+        (0 where the symbol vanishes by the selection rules)
+
+    Notes
+    -----
+    The factorials are taken from the cached log-factorial table, so each
+    symbol costs O(1) table lookups plus a sum over at most
+    min(j1+j2-j3, j1-m1, j2+m2)+1 terms. The terms of the sum alternate in
+    sign and cancel for large j, so the symbols for which the floating point
+    sum is not accurate to _RACAH_RTOL are summed again in exact integer
+    arithmetic (_racah_exact), which is slower but accurate for any j.
+    '''
+
+    args = np.broadcast_arrays(*[np.rint(val).astype(int)
+                                 for val in (tj1, tj2, tj3, tm1, tm2, tm3)])
+    shape = args[0].shape
+    tj1, tj2, tj3, tm1, tm2, tm3 = [val.ravel() for val in args]
+
+    valid = (tm1+tm2+tm3 == 0) & (tj1 >= 0) & (tj2 >= 0) & (tj3 >= 0) & \
+        (np.abs(tm1) <= tj1) & (np.abs(tm2) <= tj2) & (np.abs(tm3) <= tj3) & \
+        ((tj1+tm1) % 2 == 0) & ((tj2+tm2) % 2 == 0) & ((tj3+tm3) % 2 == 0) & \
+        (tj3 >= np.abs(tj1-tj2)) & (tj3 <= tj1+tj2) & ((tj1+tj2+tj3) % 2 == 0)
+
+#   All factorial arguments, as integers (zero where the symbol vanishes)
+    def _half(val):
+        return np.where(valid, val, 0)//2
+
+    a = _half(tj1+tj2-tj3)
+    b = _half(tj1-tj2+tj3)
+    c = _half(-tj1+tj2+tj3)
+    J1 = _half(tj1+tj2+tj3) + 1
+
+    logpref = 0.5*(_logfact(a) + _logfact(b) + _logfact(c) - _logfact(J1) +
+                   _logfact(_half(tj1+tm1)) + _logfact(_half(tj1-tm1)) +
+                   _logfact(_half(tj2+tm2)) + _logfact(_half(tj2-tm2)) +
+                   _logfact(_half(tj3+tm3)) + _logfact(_half(tj3-tm3)))
+
+    kmin = np.maximum(0, np.maximum(_half(tj2-tj3-tm1), _half(tj1-tj3+tm2)))
+    kmax = np.minimum(a, np.minimum(_half(tj1-tm1), _half(tj2+tm2)))
+
+    nterm = np.where(valid, kmax-kmin+1, 0)
+
+    p = _half(tj1-tm1)
+    q = _half(tj2+tm2)
+    x = _half(tj3-tj2+tm1)
+    y = _half(tj3-tj1-tm2)
+
+    def _logterm(k):
+        return -(_logfact(k) + _logfact(x+k) + _logfact(y+k) +
+                 _logfact(a-k) + _logfact(p-k) + _logfact(q-k))
+
+    WigVals = np.zeros(len(valid))
+    AbsSum = np.zeros(len(valid))
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        for i in range(np.max(nterm, initial=0)):
+            k = np.minimum(kmin + i, kmax)
+            term = np.where(i < nterm, np.exp(logpref + _logterm(k)), 0.0)
+            WigVals += (1.0 - 2.0*(k % 2))*term
+            AbsSum += term
+
+        # Each term is off by about eps times the log-factorials it is the
+        # exponential of. The comparison also catches sums that overflowed.
+        error = AbsSum*np.finfo(float).eps*(16.0 + 8.0*_logfact(J1))
+        inexact = valid & ~(error <= _RACAH_RTOL*np.abs(WigVals))
+
+    logfirst = logpref + _logterm(kmin)
+    for i in np.flatnonzero(inexact):
+        logsum, sign = _racah_exact(int(a[i]), int(p[i]), int(q[i]),
+                                    int(x[i]), int(y[i]), int(kmin[i]),
+                                    int(kmax[i]))
+        WigVals[i] = sign*(1.0 - 2.0*(kmin[i] % 2))*np.exp(logfirst[i] +
+                                                          logsum)
+
+    WigVals *= 1.0 - 2.0*(_half(tj1-tj2-tm3) % 2)
+
+    return WigVals.reshape(shape)
+
+
+def wigner6j(tj1, tj2, tj3, tk1, tk2, tk3, verbose=False):
+    '''Calculation of a Wigner 6j Symbol
+
+    Parameters
+    ----------
+    tj1 : int
+        2*j1
+
+    tj2 : int
+        2*j2
+
+    tj3 : int
+        2*j3
+
+    tk1 : int
+        2*k1
+
+    tk2 : int
+        2*k2
+
+    tk3 : int
+        2*k3
+
+    verbose : bool
+        Whether there is verbose output
+
+    Returns
+    -------
+    wigner6j : float
+        Wigner6j(j1,j2,j3;k1,k2,k3)
+
+    Notes
+    -----
+    We input 2*j because j can be an integer or half-integer, so this
+    combination must be an integer. Code will round to the nearest
+    integer.
+    '''
+
+    tj1 = int(round(tj1))
+    tj2 = int(round(tj2))
+    tj3 = int(round(tj3))
+    tk1 = int(round(tk1))
+    tk2 = int(round(tk2))
+    tk3 = int(round(tk3))
+
+    j1 = tj1 / 2.0
+    j2 = tj2 / 2.0
+    j3 = tj3 / 2.0
+    k1 = tk1 / 2.0
+    k2 = tk2 / 2.0
+    k3 = tk3 / 2.0
+
+#   Each triad must satisfy triangle inequalities
+#   Each triad must have the sum of its elements be an integer (or 2*sum is
+#   even). Only testing ones with j3 since ones with k3 are tested in
+#   wigner6j_vect which will always be called.
+
+    triad = np.zeros([2, 3])
+
+    triad[0, 0] = j1
+    triad[0, 1] = j2
+    triad[0, 2] = j3
+    triad[1, 0] = k1
+    triad[1, 1] = k2
+    triad[1, 2] = j3
+
+    for i in range(2):
+        triadsum = int(2*(triad[i, 0] + triad[i, 1] + triad[i, 2]))
+        triadM = np.abs(triad[i, 0] - triad[i, 1])
+        triadP = triad[i, 0]+triad[i, 1]
+        if (triad[i, 2] < triadM) or (triad[i, 2] > triadP) or \
+                (np.mod(triadsum, 2) == 1):
+            return 0
+
+    jmax, jmin, Nj = get_jrange_6j(j1, j2, k1, k2)
+
+    WigVal = wigner6j_vect(tj1, tj2, tk1, tk2, tk3, verbose=verbose)
+
+    if isinstance(WigVal, int):
+        return WigVal
+    else:
+        return WigVal[int(j3-jmin)]
+
+
+def wigner9j(tj1, tj2, tj3, tj4, tj5, tj6, tj7, tj8, tj9, verbose=False):
+    '''Calculation of the Wigner 9j symbol.
+
+    Parameters
+    ----------
+    tj1 : int
+        2*j1
+
+    tj2 : int
+        2*j2
+
+    tj3 : int
+        2*j3
+
+    tj4 : int
+        2*j4
+
+    tj5 : int
+        2*j5
+
+    tj6 : int
+        2*j6
+
+    tj7 : int
+        2*j7
+
+    tj8 : int
+        2*j8
+
+    tj9 : int
+        2*j9
+
+    Returns
+    -------
+    wigner9j : float
+        Wigner9j(j1,j2,j3,j4,j5,j6,j7,j8,j9)
+
+    Notes
+    -----
     Calculation is done following the reduction to 6j symbols seen at
     http://en.wikipedia.org/wiki/9-j_symbol and symmetry of rows/columns are
     done to move the x in the sum to the upper right part of the three terms
@@ -595,32 +2014,68 @@ def wigner9j(tj1, tj2, tj3, tj4, tj5, tj6, tj7, tj8, tj9, verbose=False):
     tj8 = int(round(tj8))
     tj9 = int(round(tj9))
 
-    jmax1, jmin1, Nj1 = get_jrange_6j(tj1/2.0, tj9/2.0, tj8/2.0, tj4/2.0)
-    sixJ1 = wigner6j_vect(tj1, tj9, tj8, tj4, tj7, verbose=verbose)
-    jmax2, jmin2, Nj2 = get_jrange_6j(tj2/2.0, tj6/2.0, tj4/2.0, tj8/2.0)
-    sixJ2 = wigner6j_vect(tj2, tj6, tj4, tj8, tj5, verbose=verbose)
-    jmax3, jmin3, Nj3 = get_jrange_6j(tj2/2.0, tj6/2.0, tj9/2.0, tj1/2.0)
-    sixJ3 = wigner6j_vect(tj2, tj6, tj9, tj1, tj3, verbose=verbose)
+    return float(wigner9j_batch(tj1, tj2, tj3, tj4, tj5, tj6, tj7, tj8,
+                                tj9)[0])
+
+
+def wigner9j_batch(tj1, tj2, tj3, tj4, tj5, tj6, tj7, tj8, tj9):
+    '''Calculation of many Wigner 9j symbols at once
+
+    Parameters
+    ----------
+    tj1, ..., tj9 : int or array-like
+        2*j1, ..., 2*j9
+
+    Returns
+    -------
+    WigVals : array-like
+        Wigner9j(j1,j2,j3,j4,j5,j6,j7,j8,j9) for each element of the
+        broadcast inputs
 
-    x1 = np.arange(jmin1, jmax1+1)
-    x2 = np.arange(jmin2, jmax2+1)
-    x3 = np.arange(jmin3, jmax3+1)
+    Notes
+    -----
+    Uses the same reduction to three 6j families over x as wigner9j. All of
+    the 6j families are calculated in one call to wigner6j_vect_batch, then
+    each family is sliced to the common x range and the sum over x is done
+    for all of the symbols at once.
+    '''
 
-    # Determine common x values in all three symbols and sum over them
-    x_good = np.intersect1d(x1, x2)
-    x_good = np.intersect1d(x_good, x3)
+    tjs = np.broadcast_arrays(*[np.rint(np.ravel(val)).astype(int)
+                                for val in (tj1, tj2, tj3, tj4, tj5, tj6, tj7,
+                                            tj8, tj9)])
+    tj1, tj2, tj3, tj4, tj5, tj6, tj7, tj8, tj9 = tjs
+    n9j = len(tj1)
 
-    # Could probably determine the valid range for x, the slice for each 6j
-    # symbol and then use np.sum
-    WigVal = 0
-    for x in x_good:
-        idx1 = np.where(x1 == x)[0]
-        idx2 = np.where(x2 == x)[0]
-        idx3 = np.where(x3 == x)[0]
+    sixJ, jmin, Nj = wigner6j_vect_batch(np.concatenate([tj1, tj2, tj2]),
+                                         np.concatenate([tj9, tj6, tj6]),
+                                         np.concatenate([tj8, tj4, tj9]),
+                                         np.concatenate([tj4, tj8, tj1]),
+                                         np.concatenate([tj7, tj5, tj3]))
 
-        WigVal += (-1.0)**(2*x) * (2*x+1) * sixJ1[idx1]*sixJ2[idx2]*sixJ3[idx3]
+    tjmin = np.rint(2*jmin).reshape(3, n9j).astype(int)
+    tjmax = tjmin + 2*(Nj.reshape(3, n9j) - 1)
+    Nj = Nj.reshape(3, n9j)
 
-    return WigVal
+#   Common range of x for the three families. The x of the three families
+#   only line up when their jmin differ by integers.
+    txmin = np.max(tjmin, axis=0)
+    txmax = np.min(tjmax, axis=0)
+    aligned = np.all((txmin - tjmin) % 2 == 0, axis=0) & np.all(Nj > 0, axis=0)
+    Nx = np.where(aligned, np.maximum((txmax - txmin)//2 + 1, 0), 0)
+
+    kvals = np.arange(max(np.max(Nx, initial=0), 1))
+    inrange = kvals[None, :] < Nx[:, None]
+    tx = txmin[:, None] + 2*kvals[None, :]
+
+    WigVals = np.where(inrange, (1.0 - 2.0*(tx % 2)) * (tx + 1.0), 0.0)
+
+    rows = np.arange(3*n9j).reshape(3, n9j)
+    for i in range(3):
+        idx = (tx - tjmin[i][:, None])//2
+        idx = np.where(inrange, idx, 0)
+        WigVals *= sixJ[rows[i][:, None], idx]
+
+    return np.sum(WigVals, axis=1)
 
 
 def clebsch_gordon(tj1, tj2, tm1, tm2, tj, tm):
@@ -703,12 +2158,166 @@ def gaunt(l1, l2, l3, m1, m2, m3):
     m2 = int(round(m2))
     m3 = int(round(m3))
 
-    threej_1 = wigner3j(2*l1, 2*l2, 2*l3, 0, 0, 0)
-    threej_2 = wigner3j(2*l2, 2*l2, 2*l3, 2*m1, 2*m2, 2*m3)
+    threej_1 = wigner3j(2*l1, 2*l2, 2*l3, 0, 0, 0)
+    threej_2 = wigner3j(2*l1, 2*l2, 2*l3, 2*m1, 2*m2, 2*m3)
+
+    gauntval = np.sqrt((2*l1+1)*(2*l2+1)*(2*l3+1)/(4*np.pi))*threej_1*threej_2
+
+    return gauntval
+
+
+_GAUNT_MAGIC = b'CMBGAUNT'
+_GAUNT_VERSION = 1
+_GAUNT_HEADER = '<8sIII'
+
+
+def _gaunt_offsets(lmax):
+    '''Offset of the block of every l1 <= l2 <= lmax in a Gaunt tensor
+    file payload, as an (lmax+1, lmax+1) array, and the total size of the
+    payload. The block of (l1, l2) holds (l1+1)*(2*l2+1)*(l1+1) values.
+    '''
+
+    l1, l2 = np.triu_indices(lmax+1)
+    sizes = (l1+1)**2*(2*l2+1)
+
+    offsets = np.zeros([lmax+1, lmax+1], dtype=np.int64)
+    offsets[l1, l2] = np.cumsum(sizes) - sizes
+
+    return offsets, int(np.sum(sizes))
+
+
+def build_gaunt_tensor(filename, lmax, dtype=np.float64):
+    '''Calculates all of the Gaunt coefficients with l1, l2 <= lmax, for all
+    of the l3 they couple to (up to 2*lmax), that are not zero by symmetry
+    and writes them to a file that can be memory-mapped with GauntTensor.
+
+    Parameters
+    ----------
+    filename : str
+        Output filename
+
+    lmax : int
+        Maximum l1 and l2 of the tensor. l3 goes up to 2*lmax.
+
+    dtype : np.float64 or np.float32, optional
+        Type of the stored values
+
+    Returns
+    -------
+    tensor : GauntTensor
+        The memory-mapped tensor
+
+    Notes
+    -----
+    Only l1 <= l2 and m1 >= 0 are stored, since the Gaunt coefficients are
+    symmetric under permutations of the (l, m) pairs and, with l1+l2+l3
+    even, under changing the signs of all m. For every (l1, l2) the
+    values are stored as an (m1 = 0..l1, m2 = -l2..l2, l3 = l2-l1, l2-l1+2,
+    ..., l1+l2) block, so the l3 with odd l1+l2+l3 are left out and l3 and
+    m3 = -m1-m2 are implicit. Each block is the product of one 000 family and
+    (l1+1)*(2*l2+1) families over l3 from wigner3j_vect_batch. The file is
+    about 0.13*lmax**5 values at high lmax.
+    '''
+
+    lmax = int(lmax)
+    dtype = np.dtype(dtype)
+
+    with open(filename, 'wb') as fout:
+        fout.write(struct.pack(_GAUNT_HEADER, _GAUNT_MAGIC, _GAUNT_VERSION,
+                               lmax, dtype.itemsize))
+
+        for l1 in range(lmax+1):
+            k = np.arange(l1+1)
+            for l2 in range(l1, lmax+1):
+                m1, m2 = np.meshgrid(np.arange(l1+1), np.arange(-l2, l2+1),
+                                     indexing='ij')
+                m1 = m1.ravel()
+                m2 = m2.ravel()
+
+                wigvals, jmin, Nj = wigner3j_vect_batch(2*l1, 2*l2, 2*m1,
+                                                        2*m2)
+                w000, jmin0, Nj0 = wigner3j_000_batch(2*l1, 2*l2)
+
+                l3 = l2 - l1 + 2*k
+                idx = l3[None, :] - np.rint(jmin[:, None]).astype(int)
+                block = np.where(idx >= 0, wigvals[np.arange(len(m1))[:, None],
+                                                   np.maximum(idx, 0)], 0.0)
+                block *= w000[0, 2*k]*np.sqrt((2*l1+1)*(2*l2+1)*(2*l3+1) /
+                                              (4*np.pi))
+
+                fout.write(block.astype(dtype.newbyteorder('<')).tobytes())
+
+    return GauntTensor(filename)
+
+
+class GauntTensor(object):
+    '''Read-only memory-mapped tensor of Gaunt coefficients written by
+    build_gaunt_tensor
+
+    Parameters
+    ----------
+    filename : str
+        Tensor filename
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as fin:
+            header = fin.read(struct.calcsize(_GAUNT_HEADER))
+
+        magic, version, lmax, itemsize = struct.unpack(_GAUNT_HEADER, header)
+
+        if magic != _GAUNT_MAGIC:
+            raise ValueError("%s is not a Gaunt tensor" % filename)
+
+        if version != _GAUNT_VERSION:
+            raise ValueError("Gaunt tensor version %d is not supported"
+                             % version)
+
+        self.lmax = lmax
+        self.dtype = np.dtype('<f%d' % itemsize)
+
+        self.offsets, size = _gaunt_offsets(lmax)
+        self.payload = np.memmap(filename, dtype=self.dtype, mode='r',
+                                 offset=len(header), shape=(size,))
+
+    def gaunt(self, l1, l2, l3, m1, m2, m3):
+        r'''Gaunt coefficients \int Y_{l1, m1} Y_{l2, m2} Y_{l3, m3} for the
+        broadcast inputs, like gaunt. Zero where they vanish by symmetry.
+        '''
+
+        l1, l2, l3, m1, m2, m3 = np.broadcast_arrays(
+            *[np.rint(val).astype(int) for val in (l1, l2, l3, m1, m2, m3)])
+
+        if np.any(np.maximum(l1, l2) > self.lmax):
+            raise ValueError("l1, l2 larger than the lmax of the tensor")
+
+        valid = (m1+m2+m3 == 0) & (np.abs(m1) <= l1) & (np.abs(m2) <= l2) & \
+            (np.abs(m3) <= l3) & (l3 >= np.abs(l1-l2)) & (l3 <= l1+l2) & \
+            ((l1+l2+l3) % 2 == 0)
+
+        swap = l1 > l2
+        l1, l2 = np.where(swap, l2, l1), np.where(swap, l1, l2)
+        m1, m2 = np.where(swap, m2, m1), np.where(swap, m1, m2)
 
-    gauntval = np.sqrt((2*l1+1)*(2*l2+1)*(2*l3+1)/(4*np.pi))*threej_1*threej_2
+        flip = np.where(m1 < 0, -1, 1)
+        m1 = m1*flip
+        m2 = m2*flip
 
-    return gauntval
+        k = ((m1*(2*l2+1) + m2 + l2)*(l1+1) + (l3 - l2 + l1)//2)
+        k = np.where(valid, self.offsets[l1, l2] + k, 0)
+
+        return np.where(valid, self.payload[k], 0.0)
+
+    def family(self, l1, l2, m1, m2):
+        '''Returns the l3 values with l1+l2+l3 even and the Gaunt
+        coefficients for them and m3 = -m1-m2
+        '''
+
+        l3 = np.arange(abs(l1-l2), l1+l2+1, 2)
+
+        return l3, self.gaunt(l1, l2, l3, m1, m2, -m1-m2)
 
 
 def racah_v(tj1, tj2, tj, tm1, tm2, tm):
@@ -798,6 +2407,175 @@ def racah_w(ta, tb, tc, td, te, tf):
     return (-1.0)**powval * WigVal
 
 
+def _spec_case_1_kernel(Xjvect, Zjvect):
+    '''Unnormalized values of special case 1 from the three term recursion
+    downwards from jmax, where every other value is 0
+    '''
+
+    Nj = len(Xjvect)
+    wigvals = np.zeros(Nj)
+
+    # starting at top since that always has j1+j2+3 as even
+    wigvals[Nj-1] = 1
+
+    for n in range(Nj-2, 0, -2):
+        wigvals[n-1] = -Xjvect[n] * wigvals[n+1] / Zjvect[n]
+
+    return wigvals
+
+
+def _spec_case_2_kernel(Xjvect, Yjvect, Zjvect):
+    '''Unnormalized values of special case 2 from the two term recursion
+    for ratios from jmin and the three term recursion upwards
+    '''
+
+    Nj = len(Xjvect)
+    s = np.zeros(Nj)
+    um = np.zeros(Nj)
+
+    # Run the two term recursion equations for ratios from the left until the
+    # ratios become > 1. This will work even for n=0 because s[-1] = 0 and we
+    # just get - Xj / Yj
+    offset = Nj-1
+    for n in range(Nj-1):
+        s[n] = -Xjvect[n] / (Yjvect[n]+Zjvect[n]*s[n-1])
+        if np.abs(s[n]) > 1:
+            offset = n+1
+            break
+        if np.isnan(s[n]):
+            offset = n
+            break
+
+    um[offset] = 1
+
+    # Expand ratios into actual unnormalized values
+    for n in range(offset-1, -1, -1):
+        um[n] = um[n+1]*s[n]
+
+    # Run three term recursion over rest of j range
+    for n in range(offset, Nj-1):
+        num = -Yjvect[n]*um[n] - Zjvect[n]*um[n-1]
+        denom = Xjvect[n]
+        um[n+1] = num / denom
+
+    return um
+
+
+def _spec_case_3_kernel(Xjvect, Yjvect, Zjvect):
+    '''Unnormalized values of special case 3 from the two term recursion
+    for ratios from jmax and the three term recursion downwards
+    '''
+
+    Nj = len(Xjvect)
+    r = np.zeros(Nj)
+    um = np.zeros(Nj)
+
+    # Run two term recursion on ratios until the ratio is > 1
+    offset = Nj-1
+    for i in range(Nj-1):
+        r[-1-i] = -Zjvect[-i-1] / (Yjvect[-1-i]+Xjvect[-1-i]*r[-i])
+        if np.abs(r[-1-i]) > 1:
+            offset = i+1
+            break
+        if np.isnan(r[-1-i]):
+            offset = i
+            break
+
+    um[-1-offset] = 1
+
+    # Convert ratios into unnormalized Winger 3j values
+    for a in range(-offset, 0):
+        um[a] = um[a-1]*r[a]
+
+    # Do three term recursion over the rest of the j range
+    for n in range(Nj-offset-1, 0, -1):
+        num = - Yjvect[n]*um[n] - Xjvect[n]*um[n+1]
+        denom = Zjvect[n]
+        um[n-1] = num / denom
+
+    return um
+
+
+def _norm_case_kernel(Xjvect, Yjvect, Zjvect):
+    '''Unnormalized values of the normal case from the two term recursions
+    for ratios from both ends and the three term recursion in between
+    '''
+
+    Nj = len(Xjvect)
+    r = np.zeros(Nj)
+    s = np.zeros(Nj)
+    um = np.zeros(Nj)
+
+    offset_r = Nj-1
+    for i in range(Nj-1):
+        r[-1-i] = -Zjvect[-1-i] / (Yjvect[-1-i]+Xjvect[-1-i]*r[-i])
+        if not np.isfinite(r[-1-i]):
+            offset_r = i
+            break
+        if np.abs(r[-1-i]) > 1:
+            offset_r = i+1
+            break
+
+    offset_s = Nj-1
+    for n in range(Nj-1):
+        s[n] = -Xjvect[n] / (Yjvect[n]+Zjvect[n]*s[n-1])
+        if not np.isfinite(s[n]):
+            offset_s = n
+            break
+        if np.abs(s[n]) > 1:
+            offset_s = n+1
+            break
+
+    # Set one unnormalized value to start
+    um[offset_s] = 1
+
+    # Expand out lower set of ratios to unnormalized Wigner values
+    for n in range(offset_s-1, -1, -1):
+        um[n] = um[n+1]*s[n]
+
+    # Three term recursion up to where the higher end set of two-term
+    # recursion of ratios stopped
+    for n in range(offset_s, Nj-offset_r-1):
+        num = -Yjvect[n]*um[n] - Zjvect[n]*um[n-1]
+        denom = Xjvect[n]
+        um[n+1] = num/denom
+
+    # There is an isue connecting the last two parts when the last term
+    # in the 3 term part is 0 (i.e. num cancels). This continues the
+    # three term recursion when the ratio of the last two entries
+    # is small
+    n = max(offset_s-1, Nj-offset_r-2)
+    if np.abs(um[n+1]/um[n]) < 1e-5:
+        n += 1
+        offset_r -= 1
+        num = -Yjvect[n]*um[n] - Zjvect[n]*um[n-1]
+        denom = Xjvect[n]
+        um[n+1] = num/denom
+
+    # Expand out higher set of ratios to unnormalized values
+    for n in range(-offset_r, 0):
+        um[n] = um[n-1]*r[n]
+
+    return um
+
+
+# The scalar recursion kernels are compiled when numba is installed, with
+# numpy semantics for division by zero so that the results are the same as
+# with the plain Python kernels that are used otherwise
+if njit is not None:
+    JIT_BACKEND = 'numba'
+    _spec_case_1_kernel = njit(cache=True, error_model='numpy')(
+        _spec_case_1_kernel)
+    _spec_case_2_kernel = njit(cache=True, error_model='numpy')(
+        _spec_case_2_kernel)
+    _spec_case_3_kernel = njit(cache=True, error_model='numpy')(
+        _spec_case_3_kernel)
+    _norm_case_kernel = njit(cache=True, error_model='numpy')(
+        _norm_case_kernel)
+else:
+    JIT_BACKEND = None
+
+
 def _spec_case_1_generic(j1, j2, m1, m2, m3=None, verbose=False,
                          wignertype='3j'):
     '''
@@ -825,23 +2603,14 @@ def _spec_case_1_generic(j1, j2, m1, m2, m3=None, verbose=False,
     jmax, jmin, Nj = get_jrange(j1, j2, m1, m2)
     jvals = np.arange(jmin, jmax+1)
 
-    wigvals = np.zeros(Nj)
-
     if (j1 == 0 and m1 == 0) or (j2 == 0 and m2 == 0):
         wigvals = -1.0**(jmin+m1+m2) / np.sqrt(2.0*jmin+1.0)
         return wigvals
 
-    # starting at top since that always has j1+j2+3 as even
-    wigvals[-1] = 1
-
-    if Nj > 1:
-        wigvals[-2] = 0
-
     Xjvect = Xj(j1, j2, jvals, m1, m2, m3)
     Zjvect = Zj(j1, j2, jvals, m1, m2, m3)
 
-    for n in range(Nj-2, 0, -2):
-        wigvals[n-1] = -Xjvect[n] * wigvals[n+1] / Zjvect[n]
+    wigvals = _spec_case_1_kernel(Xjvect, Zjvect)
 
     # Normalization
     sval = sign(j1, j2, m1, m2)
@@ -879,38 +2648,11 @@ def _spec_case_2_generic(j1, j2, m1, m2, m3=None, verbose=False,
     jmax, jmin, Nj = get_jrange(j1, j2, m1, m2)
     jvals = np.arange(jmin, jmax+1)
 
-    s = np.zeros(Nj)
-    um = np.zeros(Nj)
-
     Xjvect = Xj(j1, j2, jvals, m1, m2, m3)
     Yjvect = Yj(j1, j2, jvals, m1, m2, m3)
     Zjvect = Zj(j1, j2, jvals, m1, m2, m3)
 
-    # Run the two term recursion equations for ratios from the left until the
-    # ratios become > 1
-    for n in range(Nj-1):
-        # This will work even for i=0 and Nj=1 because s[-1] = 0 and we just
-        # get  - Xj / Yj
-        s[n] = -Xjvect[n] / (Yjvect[n]+Zjvect[n]*s[n-1])
-        if np.abs(s[n]) > 1:
-            break
-        if np.isnan(s[n]):
-            n = n-1
-            break
-
-    offset = n+1
-
-    um[offset] = 1
-
-    # Expand ratios into actual unnormalized values
-    for n in range(offset-1, -1, -1):
-        um[n] = um[n+1]*s[n]
-
-    # Run three term recursion over rest of j range
-    for n in range(offset, Nj-1):
-        num = -Yjvect[n]*um[n] - Zjvect[n]*um[n-1]
-        denom = Xjvect[n]
-        um[n+1] = num / denom
+    um = _spec_case_2_kernel(Xjvect, Yjvect, Zjvect)
 
     # Calculate normalization
     sval = sign(j1, j2, m1, m2)
@@ -948,35 +2690,11 @@ def _spec_case_3_generic(j1, j2, m1, m2, m3=None, verbose=False,
     jmax, jmin, Nj = get_jrange(j1, j2, m1, m2)
     jvals = np.arange(jmin, jmax+1)
 
-    r = np.zeros(Nj)
-    um = np.zeros(Nj)
-
     Xjvect = Xj(j1, j2, jvals, m1, m2, m3)
     Yjvect = Yj(j1, j2, jvals, m1, m2, m3)
     Zjvect = Zj(j1, j2, jvals, m1, m2, m3)
 
-    # Run two term recursion on ratios until the ratio is > 1
-    for i in range(Nj-1):
-        r[-1-i] = -Zjvect[-i-1] / (Yjvect[-1-i]+Xjvect[-1-i]*r[-i])
-        if np.abs(r[-1-i]) > 1:
-            break
-        if np.isnan(r[-1-i]):
-            i = i-1
-            break
-
-    offset = i+1
-
-    um[-1-offset] = 1
-
-    # Convert ratios into unnormalized Winger 3j values
-    for a in range(-offset, 0):
-        um[a] = um[a-1]*r[a]
-
-    # Do three term recursion over the rest of the j range
-    for n in range(Nj-offset-1, 0, -1):
-        num = - Yjvect[n]*um[n] - Xjvect[n]*um[n+1]
-        denom = Zjvect[n]
-        um[n-1] = num / denom
+    um = _spec_case_3_kernel(Xjvect, Yjvect, Zjvect)
 
     # Calculate normalization
     sval = sign(j1, j2, m1, m2)
@@ -1015,73 +2733,262 @@ def _norm_case_generic(j1, j2, m1, m2, m3=None, verbose=False,
     jmax, jmin, Nj = get_jrange(j1, j2, m1, m2)
     jvals = np.arange(jmin, jmax+1)
 
-    r = np.zeros(Nj)
-    s = np.zeros(Nj)
-    um = np.zeros(Nj)
-
     Xjvect = Xj(j1, j2, jvals, m1, m2, m3)
     Yjvect = Yj(j1, j2, jvals, m1, m2, m3)
     Zjvect = Zj(j1, j2, jvals, m1, m2, m3)
 
-    for i in range(Nj-1):
-        r[-1-i] = -Zjvect[-1-i] / (Yjvect[-1-i]+Xjvect[-1-i]*r[-i])
-        if not np.isfinite(r[-1-i]):
-            i = i-1
-            break
-        if np.abs(r[-1-i]) > 1:
-            break
-#       if np.isnan(r[-1-i]):
-#           i = i-1
-#           break
+    um = _norm_case_kernel(Xjvect, Yjvect, Zjvect)
+
+    # Calculate normalization
+    sval = sign(j1, j2, m1, m2)
+    nval = norm(jvals, m3, um)
 
-    offset_r = i+1
+    um *= np.sign(um[-1])*sval / nval
 
-    for n in range(Nj-1):
-        s[n] = -Xjvect[n] / (Yjvect[n]+Zjvect[n]*s[n-1])
-        if not np.isfinite(s[n]):
-            n = n-1
-            break
-        if np.abs(s[n]) > 1:
-            break
-#       if np.isnan(s[n]):
-#           n = n-1
-#           break
+    return um
 
-    offset_s = n+1
 
-    # Set one unnormalized value to start
-    um[offset_s] = 1
+# Unnormalized values in the batched recursion are rescaled by this when they
+# get larger than it
+_HUGE = 1e100
 
-    # Expand out lower set of ratios to unnormalized Wigner values
-    for n in range(offset_s-1, -1, -1):
-        um[n] = um[n+1]*s[n]
 
-    # Three term recursion up to where the higher end set of two-term
-    # recursion of ratios stopped
-    for n in range(offset_s, Nj-offset_r-1):
-        num = -Yjvect[n]*um[n] - Zjvect[n]*um[n-1]
-        denom = Xjvect[n]
-        um[n+1] = num/denom
-   
-    # There is an isue connecting the last two parts when the last term
-    # in the 3 term part is 0 (i.e. num cancels). This continues the 
-    # three term recursion when the ratio of the last two entries 
-    # is small
-    if np.abs(um[n+1]/um[n]) < 1e-5:
-        n += 1
-        offset_r -= 1
-        num = -Yjvect[n]*um[n] - Zjvect[n]*um[n-1]
-        denom = Xjvect[n]
-        um[n+1] = num/denom
+def _get_jrange_batch(j1, j2, m1, m2, wignertype='3j'):
+    '''Array version of get_jrange_3j and get_jrange_6j. Returns jmax, jmin
+    and Nj for every element of the inputs.
+    '''
 
-    # Expand out higher set of ratios to unnormalized values
-    for n in range(-offset_r, 0):
-        um[n] = um[n-1]*r[n]
+    if wignertype == '3j':
+        jmax = j1 + j2
+        jmin = np.maximum(np.abs(j1-j2), np.abs(m1+m2))
+    elif wignertype == '6j':
+        jmax = np.minimum(j1+j2, m1+m2)
+        jmin = np.maximum(np.abs(j1-j2), np.abs(m1-m2))
+    elif wignertype == '3jm':
+        jmax = np.minimum(j1, j2-m2)
+        jmin = np.maximum(-j1, -j2-m2)
+
+    Nj = np.maximum(np.rint(jmax - jmin + 1).astype(int), 0)
+
+    return jmax, jmin, Nj
+
+
+def _batch_generic(j1, j2, m1, m2, m3=None, valid=None, wignertype='3j'):
+    '''
+    Algorithm to calculate many families of Wigner 3j/6j symbols at the same
+    time. The loops of _spec_case_1_generic, _spec_case_2_generic,
+    _spec_case_3_generic and _norm_case_generic are run in lockstep over the
+    j index for all of the families. Each family keeps its own stopping
+    points for the two-term recursions. With wignertype == '3jm' the
+    recursion is over m1 for fixed j1, j2, j3 (given as m1) and m3 (given as
+    m2) instead.
+
+    Notes
+    -----
+    The unnormalized values are rescaled during the three term recursions
+    whenever they get larger than _HUGE and the two parts of the normal case
+    are matched by least squares over three overlapping values, so that the
+    recursion is stable for j of a few times 10^4.
+
+    Families with Y(jmin) == 0 (special cases 1 and 3) do the three term
+    recursion downwards from the top and all others (normal case and special
+    case 2) do it upwards from the bottom, so that we never divide by the
+    X(jmin) or Z(jmax) that are 0. The work arrays are stored as
+    (j index, family) so that every step of a recursion is a contiguous
+    operation over all of the families.
+    '''
+
+    if wignertype == '3j':
+        Xj = _Xj3j
+        Yj = _Yj3j
+        Zj = _Zj3j
+        sign = _sign_3j
+    elif wignertype == '6j':
+        Xj = _Xj6j
+        Yj = _Yj6j
+        Zj = _Zj6j
+        sign = _sign_6j
+    elif wignertype == '3jm':
+        Xj = _Xm3j
+        Yj = _Ym3j
+        Zj = _Zm3j
+        sign = _sign_m3j
+
+    jmax, jmin, Nj = _get_jrange_batch(j1, j2, m1, m2, wignertype=wignertype)
+
+    if valid is not None:
+        Nj[~valid] = 0
+
+    nfam = len(Nj)
+    ncol = max(np.max(Nj, initial=0), 1)
+    families = np.arange(nfam)
+    good = Nj > 0
+    top = np.maximum(Nj-1, 0)
+
+    cols = np.arange(ncol)
+    cols_all = np.arange(ncol+1)
+    inrange = cols[:, None] < Nj[None, :]
+    jvals = cols[:, None] + jmin[None, :]
+
+    if m3 is None:
+        m3 = np.zeros(nfam)
+
+    args = (j1[None, :], j2[None, :], jvals, m1[None, :], m2[None, :],
+            m3[None, :])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Xjvect = np.where(inrange, Xj(*args), 0.0)
+        Yjvect = np.where(inrange, Yj(*args), 0.0)
+        Zjvect = np.where(inrange, Zj(*args), 0.0)
+
+    # The values of Yjmax and Yjmin determine how we do the recursion
+    down = good & (Yjvect[0] == 0)
+    up = good & ~down
+    no_r = up & (Yjvect[top, families] == 0)
+
+    r = np.zeros([ncol+1, nfam])
+    s = np.zeros([ncol, nfam])
+    um = np.zeros([ncol+1, nfam])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Two term recursion for ratios from the top until the ratio is > 1
+        # (or not finite). Not done for special case 2.
+        offset_r = np.where(no_r, 0, top)
+        active = (Nj > 1) & ~no_r
+        for i in range(ncol-1):
+            active &= i < Nj-1
+            if not np.any(active):
+                break
+            idx = families[active]
+            k = Nj[idx] - 1 - i
+            val = -Zjvect[k, idx] / (Yjvect[k, idx] +
+                                     Xjvect[k, idx]*r[k+1, idx])
+            r[k, idx] = val
+
+            bad = ~np.isfinite(val)
+            big = ~bad & (np.abs(val) > 1)
+            offset_r[idx[bad]] = i
+            offset_r[idx[big]] = i+1
+            active[idx[bad | big]] = False
+
+        # Two term recursion for ratios from the bottom. Only done for the
+        # families that use the upward three term recursion.
+        offset_s = np.where(up, top, 0)
+        active = up & (Nj > 1)
+        sprev = np.zeros(nfam)
+        for n in range(ncol-1):
+            active &= n < Nj-1
+            if not np.any(active):
+                break
+            val = -Xjvect[n] / (Yjvect[n] + Zjvect[n]*sprev)
+            s[n] = np.where(active, val, 0.0)
+            sprev = s[n]
+
+            bad = active & ~np.isfinite(val)
+            big = active & ~bad & (np.abs(val) > 1)
+            offset_s[bad] = n
+            offset_s[big] = n+1
+            active &= ~(bad | big)
+
+        # Set one unnormalized value to start
+        um[offset_s[up], families[up]] = 1
+        um[(Nj - offset_r - 1)[down], families[down]] = 1
+
+        # Expand out lower set of ratios to unnormalized Wigner values
+        for n in range(np.max(offset_s, initial=0)-1, -1, -1):
+            um[n] = np.where(n < offset_s, um[n+1]*s[n], um[n])
+
+        # Three term recursion up to where the higher end set of two-term
+        # recursion of ratios stopped, and two steps further so that the two
+        # parts overlap in up to three values. The values are rescaled
+        # whenever they get large, as they can grow by many orders of
+        # magnitude at high j.
+        nstop = Nj - offset_r - 1
+        nmatch = np.minimum(nstop + 2, top)
+        nlast = np.full(nfam, -1)
+        for n in range(np.min(offset_s[up], initial=0),
+                       np.max(nmatch[up], initial=0)):
+            running = up & (n >= offset_s) & (n < nmatch)
+            if n > 0:
+                num = -Yjvect[n]*um[n] - Zjvect[n]*um[n-1]
+            else:
+                num = -Yjvect[n]*um[n]
+            um[n+1] = np.where(running, num / Xjvect[n], um[n+1])
+            nlast[running] = n
+
+            big = running & (np.abs(um[n+1]) > _HUGE)
+            if np.any(big):
+                um[:n+2, big] /= _HUGE
+
+        # Match the values from the higher set of ratios to the three term
+        # recursion by least squares over the overlapping values, instead of
+        # joining them at one value that can be close to a zero
+        match = (nlast >= nstop) & (offset_r > 0)
+        overlap = np.zeros([3, nfam])
+        for d in range(3):
+            overlap[d] = np.where(match & (nstop + d <= nmatch),
+                                  um[np.minimum(nstop + d, ncol), families],
+                                  0.0)
+        um[nstop[match], families[match]] = 1.0
+
+        # Expand out higher set of ratios to unnormalized values
+        kstart = Nj - offset_r
+        for k in range(max(np.min(kstart[good], initial=1), 1), ncol):
+            running = good & (k >= kstart) & (k < Nj)
+            um[k] = np.where(running, um[k-1]*r[k], um[k])
+
+        if np.any(match):
+            vnum = np.zeros(nfam)
+            vden = np.zeros(nfam)
+            for d in range(3):
+                inmatch = match & (nstop + d <= nmatch)
+                v = np.where(inmatch, um[np.minimum(nstop + d, ncol),
+                                         families], 0.0)
+                vnum += v*overlap[d]
+                vden += v*v
+            fact = np.where(match, vnum / np.where(match, vden, 1.0), 1.0)
+            um *= np.where(cols_all[:, None] >= nstop[None, :], fact[None, :],
+                           1.0)
+
+        # Three term recursion downwards over the rest of the j range for
+        # special cases 1 and 3
+        for n in range(np.max(nstop[down], initial=0), 0, -1):
+            running = down & (n <= nstop)
+            num = -Yjvect[n]*um[n] - Xjvect[n]*um[n+1]
+            um[n-1] = np.where(running, num / Zjvect[n], um[n-1])
+
+            big = running & (np.abs(um[n-1]) > _HUGE)
+            if np.any(big):
+                um[n-1:, big] /= _HUGE
 
     # Calculate normalization
+    um = um[:ncol]
+    um[~inrange] = 0.0
+
+    # The sign is fixed by the value at jmax, which can underflow to zero at
+    # high j, so get its sign from the value where the higher set of ratios
+    # starts and the signs of the ratios
+    rsign = np.where((cols_all[:ncol, None] >= kstart[None, :]) & inrange,
+                     np.sign(r[:ncol]), 1.0)
+    topsign = np.sign(um[np.maximum(nstop, 0), families]) * \
+        np.prod(rsign, axis=0)
+
+    # Scale to a maximum of 1 so that the sum of squares can not overflow
+    with np.errstate(invalid='ignore', divide='ignore'):
+        um /= np.where(good, np.max(np.abs(um), axis=0, initial=0.0), 1.0)
+
     sval = sign(j1, j2, m1, m2)
-    nval = norm(jvals, m3, um)
+    if wignertype == '3jm':
+        nval = (2.0*m1+1.0)*np.sum(um**2, axis=0)
+    else:
+        nval = np.sum((2.0*jvals+1.0)*um**2, axis=0)
+    if wignertype == '6j':
+        nval *= 2.0*m3+1.0
+    nval = np.sqrt(nval)
 
-    um *= np.sign(um[-1])*sval / nval
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fact = np.where(good, topsign*sval / nval, 0.0)
 
-    return um
+    um *= fact[None, :]
+
+    return np.ascontiguousarray(um.T), jmin, Nj